@@ -1,6 +1,7 @@
 from api.blueprints import create_app
-app = create_app()
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # only here: spawned hashing and job workers re-import this module as
+    # `__mp_main__`, and must not connect, check migrations or sweep jobs
+    create_app().run(debug=True)
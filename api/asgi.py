@@ -0,0 +1,12 @@
+"""ASGI entry point for the same app `api/app.py` serves:
+
+    uvicorn api.asgi:application
+
+Handlers run on `ASGI_THREADS` threads, by default `DB_MAX_CONNECTIONS`,
+so a running request never queues for a pooled database connection.
+"""
+from api.blueprints import create_app
+from api.blueprints.asgi import WsgiToAsgi
+
+app = create_app()
+application = WsgiToAsgi(app, threads=app.config.get('ASGI_THREADS') or app.config.get('DB_MAX_CONNECTIONS', 20))
@@ -1,27 +1,95 @@
+import functools
+import os
 from pathlib import Path
 
 import yaml
 from flask import Flask
 
-from api.blueprints.models import create_tables
+from api.blueprints import feed, hashing, jobs, metrics, ratelimit, search, tokens
+from api.blueprints.models import close_connection, database, init_database, open_connection
 
+CONFIG_PATH = Path(__file__).parent / 'config.yml'
+ENV_PREFIX = 'API_'
 
-def get_config(testing):
-    file = Path('config.yml')
-    path = file
-    if testing:
-        path = '../..' / file
+
+@functools.lru_cache()
+def load_config(path):
     with open(path) as config:
-        c = yaml.load(config.read())
+        return yaml.safe_load(config.read())
+
+
+def get_config():
+    """config.yml, parsed once per process, with environment overrides.
+
+    `API_<KEY>` overrides `KEY` with a value of the type `KEY` has in the
+    file; strings, and keys the file lacks, are taken as they are.
+    `API_CONFIG_FILE` points at another file.
+    """
+    c = dict(load_config(os.environ.get(f'{ENV_PREFIX}CONFIG_FILE', CONFIG_PATH)))
+    for name, value in os.environ.items():
+        if name.startswith(ENV_PREFIX) and name != f'{ENV_PREFIX}CONFIG_FILE':
+            key = name[len(ENV_PREFIX):]
+            c[key] = coerce(name, value, c.get(key))
     return c
 
 
+def coerce(name, value, default):
+    """Environment value `value` as the type of `default`."""
+    if default is None or isinstance(default, str):
+        # passwords like 0777 or `no` must not turn into numbers or booleans
+        return value
+    if isinstance(default, bool):
+        parsed = yaml.safe_load(value)
+        if isinstance(parsed, bool):
+            return parsed
+        raise ValueError(f'{name} must be true or false.')
+    if isinstance(default, (int, float)):
+        try:
+            return type(default)(value)
+        except ValueError:
+            raise ValueError(f'{name} must be a number.')
+    try:
+        parsed = yaml.safe_load(value)
+    except yaml.YAMLError:
+        parsed = None
+    if isinstance(parsed, type(default)):
+        return parsed
+    raise ValueError(f'{name} must be a YAML {type(default).__name__}.')
+
+
+def trust_proxies(app, count):
+    """Takes the client address from X-Forwarded-For, as set by the `count` proxies in front."""
+    try:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count)
+    except ImportError:  # werkzeug < 0.15
+        from werkzeug.contrib.fixers import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=count)
+
+
 def create_app(testing=False):
     app = Flask(__name__)
-    app.config.from_mapping(get_config(testing))
+    app.config.from_mapping(get_config())
+    if app.config.get('TRUSTED_PROXIES'):
+        trust_proxies(app, app.config['TRUSTED_PROXIES'])
+    hashing.init_app(app)
+    metrics.init_app(app)
+    ratelimit.init_app(app)
+    tokens.init_app(app)
     from api.blueprints.api import api
     app.register_blueprint(api, url_prefix='/api')
-    db = create_tables(app, testing=testing)
+    from api.blueprints import migrations
+    db = init_database(app, testing=testing)
+    if testing:
+        # test cases drop their tables, so the test database starts over
+        migrations.migrate(app.config, reset=True)
+    else:
+        migrations.check()
+    app.before_request(open_connection)
+    app.teardown_request(close_connection)
+    search.init_app(app, database)
+    jobs.init_app(app, testing=testing)
+    feed.init_app(app)
     if testing:
         app.testing = True
         return app.test_client(), db
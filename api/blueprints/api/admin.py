@@ -1,9 +1,21 @@
-from flask import jsonify, request
+import json
+import os
 
-from api.blueprints.api.utils import create_user, data_required, error, message, token_required, user_exists
-from api.blueprints.models import Post, User
+import peewee
+from flask import Response, jsonify, request, send_file
+
+from api.blueprints import jobs, search, snapshots
+from api.blueprints.feed import feed
+from api.blueprints.metrics import metrics
+from api.blueprints.api.utils import (MAX_PAGE_SIZE, POST_VERSION, STREAM_BATCH_SIZE, create_posts, create_user,
+                                      data_required, error, iterate, message, missing_users_post, page, paginate,
+                                      parse_pub_date, post_page, post_response, read_only, stream, stream_format,
+                                      token_required, user_cache, users_post)
+from api.blueprints.models import Post, Stats, User, pool_stats, post_serializer, user_serializer
 from . import api
 
+DELETE_CHUNK_SIZE = 5000
+
 
 @api.route('/admin/register', methods=['POST'])
 @token_required(admin_required=True, return_user=False)
@@ -14,16 +26,67 @@ def register_admin():
 
 @api.route('/admin/users', methods=['GET'])
 @token_required(admin_required=True, return_user=False)
+@read_only
 def get_users():
-    users = [user.to_dict() for user in User.select()]
-    return jsonify(users), 200
+    try:
+        fmt = stream_format()
+        if fmt is not None:
+            return stream(iterate(User.compact(), User.id, descending=False), user_serializer.serialize_row, fmt)
+        users, next_cursor, limit = paginate(User.compact(), User.id, descending=False)
+    except ValueError as e:
+        return error(str(e), 400)
+    return page('users', [user_serializer.serialize_row(user) for user in users], next_cursor, limit)
+
+
+@api.route('/admin/db/pool', methods=['GET'])
+@token_required(admin_required=True, return_user=False)
+def get_pool_stats():
+    stats = pool_stats()
+    if stats is None:
+        return error('Connection pooling is disabled.', 404)
+    return jsonify(stats), 200
+
+
+@api.route('/admin/metrics', methods=['GET'])
+@token_required(admin_required=True, return_user=False)
+def get_metrics():
+    if not metrics.enabled:
+        return error('Metrics are disabled.', 404)
+    gauges = []
+    stats = pool_stats()
+    if stats is not None:
+        gauges = [
+            ('api_db_pool_connections', {'state': 'in_use'}, stats['in_use']),
+            ('api_db_pool_connections', {'state': 'available'}, stats['available']),
+            ('api_db_pool_max_connections', {}, stats['max_connections']),
+        ]
+    return Response(metrics.registry.render(gauges), mimetype='text/plain; version=0.0.4'), 200
+
+
+@api.route('/admin/stats', methods=['GET'])
+@token_required(admin_required=True, return_user=False)
+@read_only
+def get_stats():
+    stats = Stats.totals()
+    ids = request.args.get('users')
+    if ids:
+        try:
+            ids = [int(user_id) for user_id in ids.split(',')]
+        except ValueError:
+            return error('Users must be a comma-separated list of ids.', 400)
+        if len(ids) > MAX_PAGE_SIZE:
+            return error(f'At most {MAX_PAGE_SIZE} users at a time.', 400)
+        users = User.compact().where(User.id.in_(ids)).order_by(User.id)
+        stats['per_user'] = [user_serializer.serialize_row(user) for user in users]
+    return jsonify(stats), 200
 
 
 @api.route('/admin/user/<user_id>', methods=['GET'])
 @token_required(admin_required=True, return_user=False)
+@read_only
 def get_user(user_id):
-    user = user_exists(user_id, return_user=True)
-    if not user:
+    user = User.get_or_none(User.id == user_id)
+    if user is None:
         return error('User does not exist.', 404)
     return jsonify(user.to_dict()), 200
 
@@ -31,64 +94,185 @@ def get_user(user_id):
 @api.route('/admin/user/<user_id>', methods=['DELETE'])
 @token_required(admin_required=True, return_user=False)
 def delete_user(user_id):
-    data = request.get_json() or {}
-    user = user_exists(user_id, return_user=True)
-    if not user:
+    data = request.get_json(silent=True) or {}
+    user = User.get_or_none(User.id == user_id)
+    if user is None:
         return error('User does not exist.', 404)
-    if data.get('delete_posts'):
-        for post in user.posts:
-            post.delete_instance()
-    user.delete_instance()
+    if data.get('delete_posts') and data.get('background'):
+        return jsonify(jobs.queue.enqueue('delete_user', user.id).to_dict()), 202
+    try:
+        if data.get('delete_posts'):
+            user.delete_with_posts()
+        else:
+            user.delete_alone()
+    except peewee.IntegrityError:
+        return error('User has posts, set "delete_posts" to delete them.', 403)
+    search.backend.invalidate_author(user.id)
+    feed.invalidate()
     return message('Deleted.', 200)
 
 
+def forget_user(user_id):
+    search.backend.invalidate_author(user_id)
+    user_cache.invalidate(user_id)
+    feed.invalidate()
+
+
+@jobs.register('delete_user', after=forget_user)
+def delete_user_job(job, user_id):
+    user = User.get_or_none(User.id == user_id)
+    if user is None:
+        raise ValueError('User does not exist.')
+    user.delete_with_posts(chunk_size=DELETE_CHUNK_SIZE, progress=job.progress)
+
+
+def export(job, rows, serialize, total):
+    """Writes `rows` to the job's NDJSON result file and returns its path."""
+    path = job.result_path('.ndjson')
+    done = 0
+    with open(path, 'w') as f:
+        for done, row in enumerate(rows, 1):
+            f.write(json.dumps(serialize(row)) + '\n')
+            if done % STREAM_BATCH_SIZE == 0:
+                job.progress(done, total)
+    job.progress(done, total)
+    return path
+
+
+@jobs.register('export_users')
+def export_users_job(job):
+    return export(job, iterate(User.compact(), User.id, descending=False), user_serializer.serialize_row,
+                  User.select().count())
+
+
+@jobs.register('export_posts')
+def export_posts_job(job, user_id):
+    select_query = Post.compact().where(Post.author == user_id)
+    total = User.select(User.post_count).where(User.id == user_id).scalar()
+    return export(job, iterate(select_query, Post.pub_date, Post.id), post_serializer.serialize_row, total)
+
+
+@api.route('/admin/users/export', methods=['POST'])
+@token_required(admin_required=True, return_user=False)
+def export_users():
+    return jsonify(jobs.queue.enqueue('export_users').to_dict()), 202
+
+
+@api.route('/admin/user/<user_id>/posts/export', methods=['POST'])
+@token_required(admin_required=True, return_user=False)
+def export_users_posts(user_id):
+    user = User.get_or_none(User.id == user_id)
+    if user is None:
+        return error('User does not exist.', 404)
+    return jsonify(jobs.queue.enqueue('export_posts', user.id).to_dict()), 202
+
+
+@api.route('/admin/export/<table>', methods=['POST'])
+@token_required(admin_required=True, return_user=False)
+def export_table(table):
+    try:
+        fmt = snapshots.check(table, request.args.get('format'))
+    except ValueError as e:
+        return error(str(e), 400)
+    return jsonify(jobs.queue.enqueue('export_table', table, fmt).to_dict()), 202
+
+
+@api.route('/admin/import/<table>', methods=['POST'])
+@token_required(admin_required=True, return_user=False)
+def import_table(table):
+    try:
+        fmt = snapshots.check(table, request.args.get('format'))
+    except ValueError as e:
+        return error(str(e), 400)
+    path = snapshots.save_upload(request.stream, fmt)
+    return jsonify(jobs.queue.enqueue('import_table', table, fmt, path).to_dict()), 202
+
+
+# /admin/tasks/<id> is where background deletes used to report
+@api.route('/admin/tasks/<job_id>', methods=['GET'])
+@api.route('/admin/jobs/<job_id>', methods=['GET'])
+@token_required(admin_required=True, return_user=False)
+def get_job(job_id):
+    job = jobs.queue.get(job_id)
+    if job is None:
+        return error('Job does not exist.', 404)
+    return jsonify(job.to_dict()), 200
+
+
+@api.route('/admin/jobs/<job_id>/result', methods=['GET'])
+@token_required(admin_required=True, return_user=False)
+def get_job_result(job_id):
+    job = jobs.queue.get(job_id)
+    if job is None:
+        return error('Job does not exist.', 404)
+    if not job.has_result or not os.path.exists(job.result):
+        return error('Job has no result.', 404)
+    return send_file(job.result, as_attachment=True)
+
+
 @api.route('/admin/user/<user_id>/posts', methods=['GET'])
 @token_required(admin_required=True, return_user=False)
+@read_only
 def get_users_posts(user_id):
-    user = user_exists(user_id, return_user=True)
-    if not user:
+    by_user = Post.author == user_id
+    try:
+        fmt = stream_format()
+        if fmt is not None:
+            if not User.select().where(User.id == user_id).exists():
+                return error('User does not exist.', 404)
+            rows = iterate(Post.compact().where(by_user), Post.pub_date, Post.id)
+            return stream(rows, post_serializer.serialize_row, fmt)
+        posts, response = post_page(Post.select().where(by_user))
+    except ValueError as e:
+        return error(str(e), 400)
+    # an empty page is the only case where the user might not exist
+    if not posts and not User.select().where(User.id == user_id).exists():
+        return error('User does not exist.', 404)
+    return response
+
+
+@api.route('/admin/user/<user_id>/posts/bulk', methods=['POST'])
+@token_required(admin_required=True, return_user=False)
+def add_users_posts(user_id):
+    user = User.get_or_none(User.id == user_id)
+    if user is None:
         return error('User does not exist.', 404)
-    posts = [post.to_dict() for post in user.posts]
-    return jsonify(posts), 200
+    return create_posts(user)
 
 
 @api.route('/admin/user/<user_id>/post/<post_id>', methods=['POST'])
 @data_required
 @token_required(admin_required=True, return_user=False)
 def edit_users_post(user_id, post_id):
-    user = user_exists(user_id, return_user=True)
-    if not user:
-        return error('User does not exist.', 404)
-    if user.posts.where(Post.id == post_id).first() is None:
-        return error('Selected user does not have the post.', 404)
     data = request.get_json()
-    post_data = {field: data[field] for field in Post._meta.allowed_fields
-                 if data.get(field) is not None}
-    Post.update(post_data).where(Post.id == post_id).execute()
-    post = Post.get_by_id(post_id)
+    msg = parse_pub_date(data)
+    if msg is not None:
+        return error(msg, 403)
+    post = Post.edit(post_id, user_id, data)
+    if post is None:
+        return missing_users_post(user_id)
+    search.backend.index(post)
+    feed.add(post.id)
     return jsonify(post.to_dict()), 200
 
 
 @api.route('/admin/user/<user_id>/post/<post_id>', methods=['GET'])
 @token_required(admin_required=True, return_user=False)
+@read_only
 def get_users_post(user_id, post_id):
-    user = user_exists(user_id, return_user=True)
-    if not user:
+    row = users_post(user_id, post_id, *POST_VERSION)
+    if row is None:
         return error('User does not exist.', 404)
-    post = user.posts.where(Post.id == post_id).first()
-    if post is not None:
-        return jsonify(post.to_dict()), 200
-    return error('Selected user does not have the post.', 404)
+    if row['id'] is None:
+        return error('Selected user does not have the post.', 404)
+    return post_response(row)
 
 
 @api.route('/admin/user/<user_id>/post/<post_id>', methods=['DELETE'])
 @token_required(admin_required=True, return_user=False)
 def delete_users_post(user_id, post_id):
-    user = user_exists(user_id, return_user=True)
-    if not user:
-        return error('User does not exist.', 404)
-    post = user.posts.where(Post.id == post_id).first()
-    if post is not None:
-        post.delete_instance()
-        return message('Deleted.', 200)
-    return error('Selected user does not have the post.', 404)
+    if not Post.delete_own(post_id, user_id):
+        return missing_users_post(user_id)
+    search.backend.remove(int(post_id))
+    feed.remove(post_id)
+    return message('Deleted.', 200)
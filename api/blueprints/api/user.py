@@ -1,20 +1,27 @@
-import datetime
-
-import jwt
-from flask import current_app, jsonify, request
-
-from api.blueprints.api.utils import create_user, data_required, error, message, post_exists, token_required
-from api.blueprints.models import Post, User
+from flask import jsonify, request
+
+from api.blueprints import search
+from api.blueprints.api.utils import (POST_VERSION, create_posts, create_user, data_required, encode_cursor, error,
+                                      feed_page, iterate, login_accounts, message, missing_own_post, offset_args, page,
+                                      parse_pub_date, post_page, post_response, rate_limited, read_only, stream,
+                                      stream_format, token_required, validate_post)
+from api.blueprints.feed import feed
+from api.blueprints.metrics import span
+from api.blueprints.models import Post, User, post_serializer
+from api.blueprints.tokens import REFRESH, keyring
 from . import api
 
 
 @api.route('/auth/register', methods=['POST'])
+@rate_limited('register_ip')
 def auth_register():
     data = request.get_json()
     return create_user(data)
 
 
 @api.route('/auth/login', methods=['POST'])
+@rate_limited('login_ip')
+@rate_limited('login_account', login_accounts)
 def auth_login():
     data = request.get_json()
     email, username = data.get('email'), data.get('username')
@@ -28,12 +35,23 @@ def auth_login():
         return error('User does not exist.', 403)
     if not user.check_password(password):
         return error('Wrong password.', 403)
-    token = jwt.encode({
-        'id': user.get_id(),
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=2)
-    }, current_app.config['SECRET_KEY'], algorithm='HS256')
     data = user.to_dict()
-    data['token'] = token.decode('UTF-8')
+    data.update(keyring.issue(user.get_id()))
+    return jsonify(data), 200
+
+
+@api.route('/auth/refresh', methods=['POST'])
+@rate_limited('refresh_ip')
+def auth_refresh():
+    data = request.get_json(silent=True) or {}
+    claims = keyring.decode(str(data.get('refresh_token')), REFRESH)
+    if claims is None:
+        return error('Refresh token is invalid.', 401)
+    user = User.get_or_none(User.id == claims['id'])
+    if user is None:
+        return error('User does not exist.', 401)
+    data = user.to_dict()
+    data.update(keyring.issue(user.get_id()))
     return jsonify(data), 200
 
 
@@ -42,65 +60,98 @@ def auth_login():
 @token_required()
 def add_post(current_user):
     data = request.get_json()
-    if None in (data.get('title'), data.get('text')):
-        return error('Both title and text are required.', 403)
+    msg = validate_post(data)
+    if msg is not None:
+        return error(msg, 403)
     data['author'] = current_user
     post = Post.from_dict(data)
     return jsonify(post.to_dict()), 201
 
 
+@api.route('/me/posts/bulk', methods=['POST'])
+@token_required()
+def add_posts(current_user):
+    return create_posts(current_user)
+
+
 @api.route('/me/post/:<post_id>', methods=['GET'])
 @token_required(return_user=False)
+@read_only
 def get_post(post_id):
-    post = post_exists(post_id, return_post=True)
-    if not post:
+    row = Post.select(*POST_VERSION).where(Post.id == post_id).dicts().first()
+    if row is None:
         return error('Post does not exist.', 404)
-    return jsonify(post.to_dict()), 200
+    return post_response(row)
 
 
 @api.route('/me/post/:<post_id>', methods=['POST'])
 @data_required
-@token_required(return_user=False)
-def edit_post(post_id):
-    if not post_exists(post_id):
-        return error('Post does not exist.', 404)
+@token_required()
+def edit_post(current_user, post_id):
     data = request.get_json()
-    post_data = {field: data[field] for field in Post._meta.allowed_fields
-                 if data.get(field) is not None}
-    Post.update(post_data).where(Post.id == post_id).execute()
-    return jsonify(Post.get_by_id(post_id).to_dict()), 200
+    msg = parse_pub_date(data)
+    if msg is not None:
+        return error(msg, 403)
+    post = Post.edit(post_id, current_user.id, data)
+    if post is None:
+        return missing_own_post(post_id)
+    search.backend.index(post)
+    feed.add(post.id)
+    return jsonify(post.to_dict()), 200
 
 
 @api.route('/me/post/:<post_id>', methods=['DELETE'])
-@token_required(return_user=False)
-def delete_post(post_id):
-    if not post_exists(post_id):
-        return error('Post does not exist.', 404)
-    Post.delete_by_id(post_id)
+@token_required()
+def delete_post(current_user, post_id):
+    if not Post.delete_own(post_id, current_user.id):
+        return missing_own_post(post_id)
+    search.backend.remove(int(post_id))
+    feed.remove(post_id)
     return message('Deleted.', 200)
 
 
 @api.route('/posts', methods=['GET'])
 @token_required()
+@read_only
 def search_posts(current_user):
-    select_query = current_user.posts
     query = request.args.get('query')
     if query is not None:
-        select_query = select_query.where(
-            (Post.title.contains(query)) | (Post.text.contains(query))
-        )
+        try:
+            limit, offset = offset_args()
+        except ValueError as e:
+            return error(str(e), 400)
+        with span('search'):
+            hits = search.backend.search(current_user.id, query, limit + 1, offset)
+        next_cursor = encode_cursor([offset + limit]) if len(hits) > limit else None
+        with span('serialize'):
+            posts = [dict(post.to_dict(), rank=rank, snippet=snippet)
+                     for post, rank, snippet in hits[:limit]]
+        return page('posts', posts, next_cursor, limit)
+    own = Post.author == current_user
     try:
-        posts = [post.to_dict() for post in select_query]
-    except AttributeError:
-        return error('No such posts.', 404)
-    return jsonify(posts), 200
+        fmt = stream_format()
+        if fmt is not None:
+            rows = iterate(Post.compact().where(own), Post.pub_date, Post.id)
+            return stream(rows, post_serializer.serialize_row, fmt)
+        _, response = post_page(Post.select().where(own))
+    except ValueError as e:
+        return error(str(e), 400)
+    return response
 
 
 @api.route('/me/posts/others', methods=['GET'])
 @token_required()
+@read_only
 def get_others_posts(current_user):
-    posts = [post.to_dict() for post in
-             Post.select().where(Post.author != current_user)]
+    others = Post.author != current_user
+    try:
+        fmt = stream_format()
+        if fmt is not None:
+            rows = iterate(Post.compact().where(others), Post.pub_date, Post.id)
+            return stream(rows, post_serializer.serialize_row, fmt)
+        posts, response = feed_page(current_user.id) or post_page(Post.select().where(others))
+    except ValueError as e:
+        return error(str(e), 400)
     if not posts:
         return error('No posts from other users.', 404)
-    return jsonify(posts), 200
+    return response
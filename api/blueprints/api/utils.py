@@ -1,9 +1,36 @@
+import base64
+import binascii
+import datetime
 import functools
+import hashlib
+import itertools
+import json
+import math
 
-import jwt
-from flask import current_app, jsonify, request
+import peewee
+from flask import Response, g, jsonify, request, stream_with_context
+from playhouse.signals import post_delete, post_save
 
-from api.blueprints.models import Post, User
+from api.blueprints import ratelimit, search
+from api.blueprints.cache import LRUCache, TokenCache, UserCache
+from api.blueprints.feed import feed
+from api.blueprints.metrics import span
+from api.blueprints.models import Post, User, database, insert_batch_size, post_serializer
+from api.blueprints.tokens import keyring
+from . import api
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_SIZE = 1000
+STREAM_FORMATS = ('json', 'ndjson')
+BULK_CHUNK_SIZE = 1000
+POST_VERSION = (Post.id, Post.version, Post.updated_at)
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+token_cache = TokenCache()
+user_cache = UserCache()
+# rendered bodies are ASCII JSON, so their length is their size in bytes
+response_cache = LRUCache(2 ** 26, weigh=len)
 
 
 def error(msg: str, code: int):
@@ -21,14 +48,13 @@ def token_required(admin_required=False, return_user=True):
             token = request.headers.get('x-access-token')
             if token is None:
                 return error('Token is missing.', 401)
-            try:
-                data = jwt.decode(token, current_app.config['SECRET_KEY'],
-                                  algorithms=['HS256'])
-            except jwt.InvalidTokenError:
+            with span('auth'):
+                user = authenticate(token)
+            if user is None:
                 return error('Token is invalid.', 401)
-            user = User.get_by_id(data['id'])
             if admin_required and not user.is_admin:
                 return error('Admin rights required to perform this action.', 401)
+            g.user_id = user.id
             if return_user:
                 return func(user, *args, **kwargs)
             return func(*args, **kwargs)
@@ -36,10 +62,110 @@ def token_required(admin_required=False, return_user=True):
     return decorator
 
 
+def read_only(func):
+    """Serves the view from a replica, unless the user wrote within the sticky window.
+
+    Goes below `token_required`, so authentication reads the primary.
+    The choice is kept in `g.replica` for responses streamed after the
+    view has returned.
+    """
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        g.replica = not database.sticky(g.get('user_id'))
+        with database.reading(g.replica):
+            return func(*args, **kwargs)
+    return inner
+
+
+@api.after_request
+def remember_writes(response):
+    """Notes the time of an authenticated user's write, which `read_only` checks."""
+    if request.method not in READ_METHODS and response.status_code < 400 and g.get('user_id') is not None:
+        database.wrote(g.user_id)
+    return response
+
+
+def client_ip():
+    """The client's address; behind proxies it relies on `TRUSTED_PROXIES` being set."""
+    return request.remote_addr
+
+
+def login_accounts():
+    """Every identifier the login looks the account up by.
+
+    The lookup matches the username or the email, so each one supplied
+    counts; otherwise a fresh username next to the victim's email would
+    get a fresh bucket on every attempt.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None
+    return sorted({str(data[field]).lower() for field in ('username', 'email') if data.get(field)})
+
+
+def rate_limited(name, key=client_ip):
+    """Refuses the request with 429 once `key()` has used up limit `name`.
+
+    `key()` returns one value or a list of values, each counted against
+    its own bucket. Requests for which it returns None are not counted.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            values = key()
+            if values is not None:
+                values = values if isinstance(values, list) else [values]
+                wait = max([ratelimit.limiter.hit(name, value) for value in values], default=0)
+                if wait:
+                    response, code = error('Too many requests, try again later.', 429)
+                    response.headers['Retry-After'] = str(math.ceil(wait))
+                    return response, code
+            return func(*args, **kwargs)
+        return inner
+    return decorator
+
+
+def authenticate(token):
+    claims = token_cache.get(token)
+    if claims is None:
+        claims = keyring.decode(token)
+        if claims is None:
+            return None
+        token_cache.set(token, claims)
+    snapshot = user_cache.get(claims['id'])
+    if snapshot is not None:
+        return User(**snapshot)
+    user = User.get_or_none(User.id == claims['id'])
+    if user is not None:
+        user_cache.set(user.to_dict())
+    return user
+
+
+@api.record_once
+def configure_caches(state):
+    token_cache.configure(state.app.config.get('AUTH_CACHE_SIZE', 1024))
+    user_cache.configure(state.app.config.get('AUTH_CACHE_SIZE', 1024),
+                         state.app.config.get('AUTH_CACHE_TTL', 60))
+    response_cache.maxsize = state.app.config.get('RESPONSE_CACHE_BYTES', 2 ** 26)
+    response_cache.clear()
+
+
+@post_save(sender=User)
+def invalidate_saved_user(sender, instance, created):
+    user_cache.invalidate(instance.id)
+
+
+@post_delete(sender=User)
+def invalidate_deleted_user(sender, instance):
+    user_cache.invalidate(instance.id)
+
+
 def data_required(func):
     @functools.wraps(func)
     def inner(*args, **kwargs):
-        if not request.get_json():
+        with span('parse'):
+            data = request.get_json()
+        if not data:
             return error('Json-data was not provided.', 403)
         return func(*args, **kwargs)
     return inner
@@ -61,21 +187,347 @@ def create_user(data, admin=False):
     return jsonify(user.to_dict()), 201
 
 
-def user_exists(user_id, return_user=False):
+def validate_post(data):
+    if not isinstance(data, dict):
+        return 'Post must be an object.'
+    if None in (data.get('title'), data.get('text')):
+        return 'Both title and text are required.'
+    return parse_pub_date(data)
+
+
+def parse_pub_date(data):
+    """Replaces a `pub_date` string in `data` with its datetime; returns an error or None."""
+    value = data.get('pub_date')
+    if value is None:
+        return None
+    parsed = Post.pub_date.python_value(value) if isinstance(value, str) else None
+    if not isinstance(parsed, datetime.datetime):
+        return '"pub_date" must be a date and time, like "2018-01-31 12:00:00".'
+    data['pub_date'] = parsed
+    return None
+
+
+def bulk_items():
+    """Yields (item, parse error) pairs from a JSON array or NDJSON body.
+
+    NDJSON is read line by line from the request stream, so the body is
+    never held in memory as a whole.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line.decode('UTF-8')), None
+            except ValueError:
+                yield None, 'Line is not valid json.'
+        return
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError('Expected a json array or ndjson lines.')
+    for item in data:
+        yield item, None
+
+
+def bulk_chunk_size():
+    return insert_batch_size(Post, BULK_CHUNK_SIZE)
+
+
+def create_posts(author):
+    """Validates and inserts a bulk request body in `insert_many` chunks.
+
+    Valid items are written in one transaction; invalid ones are skipped
+    and reported by their position in the body.
+    """
+    created, errors, chunk = 0, [], []
+    size = bulk_chunk_size()
+    try:
+        with database.atomic():
+            for index, (item, parse_error) in enumerate(bulk_items()):
+                msg = parse_error or validate_post(item)
+                if msg is not None:
+                    errors.append({'index': index, 'error': msg})
+                    continue
+                chunk.append(Post.row(item, author))
+                if len(chunk) == size:
+                    Post.insert_many(chunk).execute()
+                    created, chunk = created + len(chunk), []
+            if chunk:
+                Post.insert_many(chunk).execute()
+                created += len(chunk)
+            if created:
+                User.count_posts(author.id, created)
+    except ValueError as e:
+        return error(str(e), 400)
+    except peewee.DataError:
+        return error('Posts contain invalid values.', 403)
+    search.backend.invalidate_author(author.id)
+    feed.invalidate()
+    return jsonify({'created': created, 'errors': errors}), 201 if created else 403
+
+
+def users_post(user_id, post_id, *columns):
+    """Looks up a user's post together with the user in one round trip.
+
+    The post is LEFT JOINed onto its owner, so the two misses stay apart:
+    None when the user does not exist, otherwise a dict of the post
+    `columns` that are all None when the user has no such post.
+    """
+    return (User
+            .select(User.id.alias('owner_id'), *columns)
+            .join(Post, peewee.JOIN.LEFT_OUTER, on=((Post.author == User.id) & (Post.id == post_id)))
+            .where(User.id == user_id)
+            .dicts()
+            .first())
+
+
+def missing_users_post(user_id):
+    """The 404 for a write scoped to a user's post that matched no row."""
+    if User.select().where(User.id == user_id).exists():
+        return error('Selected user does not have the post.', 404)
+    return error('User does not exist.', 404)
+
+
+def missing_own_post(post_id):
+    """The 403/404 for a write scoped to the caller's post that matched no row."""
+    if Post.select().where(Post.id == post_id).exists():
+        return error('Post belongs to another user.', 403)
+    return error('Post does not exist.', 404)
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=str).encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('UTF-8')
+
+
+def decode_cursor(cursor, *fields):
+    """The python values of `fields` encoded in `cursor`; ValueError unless they all parse."""
     try:
-        user = User.get_by_id(user_id)
-    except User.DoesNotExist:
-        return False
-    if return_user:
-        return user
-    return True
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('UTF-8')).decode('UTF-8'))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Cursor is invalid.')
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError('Cursor is invalid.')
+    return [cursor_value(field, value) for field, value in zip(fields, values)]
+
+
+def cursor_value(field, value):
+    if isinstance(field, peewee.IntegerField):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    elif isinstance(field, peewee.DateTimeField):
+        # python_value hands back strings it cannot parse unchanged
+        value = field.python_value(value) if isinstance(value, str) else None
+        if isinstance(value, datetime.datetime):
+            return value
+    elif isinstance(value, (str, int, float)):
+        return field.python_value(value)
+    raise ValueError('Cursor is invalid.')
 
 
-def post_exists(post_id, return_post=False):
+def page_args():
     try:
-        post = Post.get_by_id(post_id)
-    except Post.DoesNotExist:
-        return False
-    if return_post:
-        return post
-    return True
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Limit must be an integer.')
+    if limit < 1:
+        raise ValueError('Limit must be positive.')
+    return min(limit, MAX_PAGE_SIZE), request.args.get('cursor')
+
+
+def offset_args():
+    """Page arguments for ranked results, whose cursor is an encoded offset."""
+    limit, cursor = page_args()
+    offset = decode_cursor(cursor, peewee.IntegerField())[0] if cursor is not None else 0
+    if offset < 0:
+        raise ValueError('Cursor is invalid.')
+    return limit, offset
+
+
+def keyset(query, key, values, descending=True):
+    """Orders `query` by the `key` fields and resumes it after `values`."""
+    if values is not None:
+        values = [peewee.Value(field.python_value(value), converter=field.db_value)
+                  for field, value in zip(key, values)]
+        if descending:
+            query = query.where(peewee.Tuple(*key) < peewee.Tuple(*values))
+        else:
+            query = query.where(peewee.Tuple(*key) > peewee.Tuple(*values))
+    return query.order_by(*[field.desc() if descending else field.asc() for field in key])
+
+
+def paginate(query, *key, descending=True):
+    """Keyset pagination of `query` over the `key` fields.
+
+    The cursor is an opaque encoding of the key values of the last row
+    on the page, so every page is a single index range scan no matter
+    how deep the client pages. Raises ValueError on bad `limit`/`cursor`.
+    Returns (rows, next_cursor, limit).
+    """
+    limit, cursor = page_args()
+    if cursor is not None:
+        cursor = decode_cursor(cursor, *key)
+    rows = list(keyset(query, key, cursor, descending).limit(limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], field.name) for field in key])
+    return rows, next_cursor, limit
+
+
+def iterate(query, *key, descending=True, batch_size=None):
+    """Yields every row of `query` in keyset batches of `batch_size`.
+
+    Each batch is a separate bounded query read with `iterator()`, so
+    neither the driver nor peewee ever holds more than one batch.
+    """
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    values = None
+    while True:
+        count = 0
+        for row in keyset(query, key, values, descending).limit(batch_size).iterator():
+            count += 1
+            yield row
+        if count < batch_size:
+            return
+        values = [getattr(row, field.name) for field in key]
+
+
+def stream_format():
+    fmt = request.args.get('stream')
+    if fmt is not None and fmt not in STREAM_FORMATS:
+        raise ValueError('Stream must be one of: {}.'.format(', '.join(STREAM_FORMATS)))
+    return fmt
+
+
+def stream(rows, serialize, fmt):
+    """Streams `rows` as a JSON array or NDJSON, one batch per chunk.
+
+    The rows are read while the body is sent, after the view returned, so
+    a `read_only` view's replica is entered again for every batch; never
+    across a yield, as the server may resume the body on another thread.
+    """
+    replica = g.get('replica', False)
+
+    def batches():
+        rows_left = iter(rows)
+        while True:
+            with database.reading(replica):
+                batch = [json.dumps(serialize(row)) for row in itertools.islice(rows_left, STREAM_BATCH_SIZE)]
+            if not batch:
+                return
+            yield batch
+
+    def ndjson():
+        for batch in batches():
+            yield '\n'.join(batch) + '\n'
+
+    def array():
+        separator = '['
+        for batch in batches():
+            yield separator + ','.join(batch)
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+
+    if fmt == 'ndjson':
+        return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson'), 200
+    return Response(stream_with_context(array()), mimetype='application/json'), 200
+
+
+def page(name, items, next_cursor, limit):
+    return jsonify({name: items, 'limit': limit, 'next_cursor': next_cursor}), 200
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode('UTF-8')).hexdigest()
+
+
+def _utc(moment):
+    if moment is not None and moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def conditional(etag, last_modified, render):
+    """Answers a GET from a cheap version lookup.
+
+    Returns 304 when the client already holds `etag` (or, without
+    If-None-Match, a copy no older than `last_modified`). Otherwise the
+    body is taken from the rendered-response cache, keyed by the etag,
+    and `render()` only runs when nobody has rendered that version yet.
+    """
+    last_modified = _utc(last_modified)
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        since = _utc(request.if_modified_since)
+        not_modified = None not in (since, last_modified) and last_modified <= since
+    if not_modified:
+        response = Response(status=304)
+    else:
+        body = response_cache.get(etag)
+        if body is None:
+            with span('serialize'):
+                body = json.dumps(render())
+            if response_cache.maxsize:
+                response_cache.set(etag, body)
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def post_page(select_query):
+    """A conditional keyset page of the posts matched by `select_query`.
+
+    The page is first resolved to (id, version, updated_at) triples,
+    which is all the etag needs; `updated_at` tells apart posts that
+    reuse a deleted post's id. The joined rows are only loaded to render
+    a miss.
+    Returns (rows, response) so callers can inspect the page.
+    """
+    key = (Post.pub_date, Post.id)
+    rows, next_cursor, limit = paginate(select_query.select(Post.id, Post.version, Post.updated_at, *key), *key)
+    etag = make_etag('posts', [(row.id, row.version, row.updated_at) for row in rows], next_cursor, limit)
+
+    def render():
+        posts = Post.compact().where(Post.id.in_([row.id for row in rows]))
+        posts = posts.order_by(Post.pub_date.desc(), Post.id.desc())
+        return {'posts': [post_serializer.serialize_row(post) for post in posts], 'limit': limit,
+                'next_cursor': next_cursor}
+    return rows, conditional(etag, None, render)
+
+
+def feed_page(author_id):
+    """`post_page` of everyone else's posts, served from the feed.
+
+    Cursors and etags are the same as `post_page`'s, so a client can page
+    across both. Returns None when the feed cannot answer the page.
+    """
+    if not feed.enabled:
+        return None
+    limit, cursor = page_args()
+    if cursor is not None:
+        cursor = tuple(decode_cursor(cursor, Post.pub_date, Post.id))
+    found = feed.page(author_id, cursor, limit)
+    if found is None:
+        return None
+    entries, more = found
+    next_cursor = encode_cursor(list(entries[-1].key)) if more else None
+    etag = make_etag('posts', [(entry.id, entry.version, entry.updated_at) for entry in entries], next_cursor, limit)
+
+    def render():
+        return {'posts': [entry.data for entry in entries], 'limit': limit, 'next_cursor': next_cursor}
+    return entries, conditional(etag, None, render)
+
+
+def post_response(row):
+    """A conditional response for a post from its `POST_VERSION` columns."""
+    def render():
+        return post_serializer.serialize_row(Post.compact().where(Post.id == row['id']).get())
+    etag = make_etag('post', row['id'], row['version'], row['updated_at'])
+    return conditional(etag, row['updated_at'], render)
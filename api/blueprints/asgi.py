@@ -0,0 +1,161 @@
+"""WSGI -> ASGI adapter, so the Flask app can run under an ASGI server.
+
+The server's event loop owns the sockets, so idle keep-alive and polling
+clients cost a connection each instead of a worker thread; only the
+Flask handler itself runs on a bounded thread pool.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import io
+import sys
+
+
+def make_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('UTF-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('UTF-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # the body ends where the server says it does, with or without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        if key in environ:
+            # repeated headers fold into one, except Cookie, whose pairs are separated by semicolons
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+class Disconnected(Exception):
+    """The client went away before sending the whole request body."""
+
+
+class RequestBody(io.RawIOBase):
+    """`wsgi.input` that receives the body from the loop as the app reads it.
+
+    Nothing is read ahead, so an upload is never held in memory whole
+    and a slow app slows the client down. A disconnect raises
+    Disconnected from the read, which rolls back whatever transaction
+    the app had open.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.chunk = memoryview(b'')
+        self.more = True
+        self.disconnected = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk and self.more:
+            if self.disconnected:
+                raise Disconnected
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                self.disconnected = True
+                raise Disconnected
+            self.chunk = memoryview(message.get('body', b''))
+            self.more = message.get('more_body', False)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+
+class WsgiToAsgi:
+    """Runs a WSGI app under an ASGI server on a bounded thread pool.
+
+    The whole WSGI call, including reading the request body and
+    iterating a streamed response, stays on one pool thread (Flask's
+    request context is thread-local). Each body chunk is fetched from
+    the loop when the app asks for it, and each response chunk is handed
+    back to the loop and the thread waits until it is sent, so slow
+    peers apply backpressure instead of buffering.
+    """
+
+    def __init__(self, wsgi_app, threads=20):
+        self.wsgi_app = wsgi_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported scope type: {scope['type']}.")
+        loop = asyncio.get_running_loop()
+        body = RequestBody(receive, loop)
+        environ = make_environ(scope, io.BufferedReader(body))
+        await loop.run_in_executor(self.executor, self.run, environ, body, send, loop)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # off the loop: a streaming response still in flight needs the loop to finish
+                await asyncio.get_running_loop().run_in_executor(
+                    None, functools.partial(self.executor.shutdown, wait=True))
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run(self, environ, body, send, loop):
+        def emit(message):
+            # nobody is left to answer once the client has gone
+            if not body.disconnected:
+                asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return write
+
+        def start():
+            if not response.get('sent'):
+                response['sent'] = True
+                emit({'type': 'http.response.start', 'status': response['status'],
+                      'headers': response['headers']})
+
+        def write(chunk):
+            start()
+            emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except Disconnected:
+            return
+        try:
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        start()
+        emit({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,123 @@
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """Thread-safe LRU mapping with a per-entry time to live.
+
+    `maxsize` bounds the number of entries or, with `weigh(value)`, their
+    total weight, such as the bytes of cached bodies; a value heavier
+    than `maxsize` on its own is not stored. `on_evict(key, value)` is
+    called for entries dropped to make room or found expired, but not
+    for explicit `pop`/`clear`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, on_evict=None, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.weigh = weigh
+        self.weight = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires, weight = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                self.weight -= weight
+                self._evicted(key, value)
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl or ttl)
+        expires = time.monotonic() + ttl if ttl is not None else None
+        weight = self.weigh(value) if self.weigh is not None else 1
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.weight -= old[2]
+            if weight > self.maxsize:
+                return
+            self.entries[key] = (value, expires, weight)
+            self.weight += weight
+            while self.weight > self.maxsize:
+                old_key, (old_value, _, old_weight) = self.entries.popitem(last=False)
+                self.weight -= old_weight
+                self._evicted(old_key, old_value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.weight -= entry[2]
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def _evicted(self, key, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TokenCache:
+    """Verified token -> its claims, so a repeated token skips the signature check.
+
+    Entries never outlive the token's `exp`.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.configure(maxsize)
+
+    def configure(self, maxsize):
+        self.entries = LRUCache(maxsize)
+
+    def get(self, token):
+        return self.entries.get(token)
+
+    def set(self, token, claims):
+        ttl = claims['exp'] - time.time()
+        if ttl > 0:
+            self.entries.set(token, claims, ttl)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class UserCache:
+    """User id -> snapshot of the user, invalidated when the user changes.
+
+    A snapshot is the user's public fields (no password hash), enough to
+    rebuild a detached `User` for the request without a query.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.configure(maxsize, ttl)
+
+    def configure(self, maxsize, ttl):
+        self.entries = LRUCache(maxsize, ttl)
+
+    def get(self, user_id):
+        return self.entries.get(user_id)
+
+    def set(self, snapshot):
+        self.entries.set(snapshot['id'], snapshot)
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,191 @@
+"""Materialized feed of the newest posts, behind `GET /api/me/posts/others`.
+
+Listing everyone else's posts is an anti-join over the whole table. The
+feed keeps the newest `FEED_SIZE` posts, rendered, in a buffer ordered
+by (pub_date, id); a page walks it back from the cursor, skipping the
+caller's own posts, without a query. Saved posts are added through the
+`post_commit` and `post_delete` signals and the edit and delete routes
+call `add` and `remove`, as they do for the search index. Both run
+after the write and never raise: a failure drops the buffer, to be
+reloaded by the next page. Writes that bypass them (bulk inserts, user
+deletes, imports) call `invalidate`. Other processes' writes never reach
+this buffer, so every page checks the versions of its posts with one
+primary-key lookup and replaces the ones deleted or edited since; the
+posts other processes add show up with the reload every
+`FEED_RESYNC_SECONDS`. A reload is one scan of the (pub_date, id) index
+on the primary (a lagging replica would drop fresh posts), run by one
+thread while the others page the aged buffer. A page that runs past the
+oldest buffered post is left to the database.
+"""
+import bisect
+import collections
+import datetime
+import threading
+import time
+
+from playhouse.signals import post_delete
+
+from api.blueprints.models import Post, database, post_commit, post_serializer
+
+Entry = collections.namedtuple('Entry', 'key author_id id version updated_at data')
+
+
+class Feed:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.configure(0)
+
+    def configure(self, size, resync_seconds=30):
+        with self.lock:
+            self.size = size
+            self.resync_seconds = resync_seconds
+            self.keys, self.entries, self.ids = [], {}, {}
+            self.complete = False
+            self.loaded_at = None
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    @staticmethod
+    def entry(row):
+        return Entry((row.pub_date, row.id), row.author, row.id, row.version, row.updated_at,
+                     post_serializer.serialize_row(row))
+
+    def refresh(self):
+        """Reloads a stale buffer, one thread at a time.
+
+        While one thread reloads, the others keep paging the previous
+        buffer if it has merely aged, and wait for the reload if it was
+        invalidated.
+        """
+        if self.fresh() or not self.load_lock.acquire(blocking=self.loaded_at is None):
+            return
+        try:
+            if not self.fresh():
+                self._load()
+        finally:
+            self.load_lock.release()
+
+    def _load(self):
+        """Rebuilds the buffer from the newest posts in the database; hold `load_lock`."""
+        query = Post.compact().order_by(Post.pub_date.desc(), Post.id.desc()).limit(self.size)
+        with database.primary():
+            rows = list(query)
+        # a pub_date SQLite stored unparsed cannot be ordered against the others
+        entries = [self.entry(row) for row in reversed(rows) if isinstance(row.pub_date, datetime.datetime)]
+        with self.lock:
+            self.keys = [entry.key for entry in entries]
+            self.entries = {entry.key: entry for entry in entries}
+            self.ids = {entry.id: entry.key for entry in entries}
+            self.complete = len(rows) < self.size and len(entries) == len(rows)
+            self.loaded_at = time.monotonic()
+
+    def fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.resync_seconds
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def _insert(self, entry):
+        # posts older than the buffer only belong in it while it holds the whole table
+        if not self.complete and self.keys and entry.key < self.keys[0]:
+            return
+        bisect.insort(self.keys, entry.key)
+        self.entries[entry.key] = entry
+        self.ids[entry.id] = entry.key
+        if len(self.keys) > self.size:
+            del self.ids[self.entries.pop(self.keys.pop(0)).id]
+            self.complete = False
+
+    def _remove(self, post_id):
+        key = self.ids.pop(post_id, None)
+        if key is not None:
+            del self.entries[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def add(self, post_id):
+        """Puts a new or edited post in its place in the feed."""
+        if not self.enabled or self.loaded_at is None:
+            return
+        try:
+            post_id = int(post_id)
+            with database.primary():
+                row = Post.compact().where(Post.id == post_id).first()
+            with self.lock:
+                self._remove(post_id)
+                if row is not None and isinstance(row.pub_date, datetime.datetime):
+                    self._insert(self.entry(row))
+                elif row is not None:
+                    self.complete = False
+        except Exception:
+            self.invalidate()
+
+    def remove(self, post_id):
+        if not self.enabled or self.loaded_at is None:
+            return
+        try:
+            with self.lock:
+                self._remove(int(post_id))
+        except Exception:
+            self.invalidate()
+
+    def page(self, author_id, after, limit):
+        """Up to `limit` posts by others older than the `after` key, newest first.
+
+        Returns (entries, more), or None when the page reaches past the
+        buffer and has to come from the database.
+        """
+        self.refresh()
+        for _ in range(2):
+            entries = self._page(author_id, after, limit)
+            if entries is None:
+                return None
+            stale = self.stale(entries)
+            if not stale:
+                return entries[:limit], len(entries) > limit
+            for entry in stale:
+                self.add(entry.id)
+        return None
+
+    @staticmethod
+    def stale(entries):
+        """The entries whose post has been deleted or changed since it was buffered."""
+        if not entries:
+            return []
+        query = Post.select(Post.id, Post.version, Post.updated_at).where(Post.id.in_([entry.id for entry in entries]))
+        with database.primary():
+            current = {post_id: versions for post_id, *versions in query.tuples()}
+        return [entry for entry in entries if current.get(entry.id) != [entry.version, entry.updated_at]]
+
+    def _page(self, author_id, after, limit):
+        with self.lock:
+            index = len(self.keys) if after is None else bisect.bisect_left(self.keys, after)
+            entries = []
+            while index > 0 and len(entries) <= limit:
+                index -= 1
+                entry = self.entries[self.keys[index]]
+                if entry.author_id != author_id:
+                    entries.append(entry)
+            if len(entries) <= limit and not self.complete:
+                return None
+        return entries
+
+
+feed = Feed()
+
+
+@post_commit(sender=Post)
+def add_post(sender, instance):
+    feed.add(instance.id)
+
+
+@post_delete(sender=Post)
+def remove_post(sender, instance):
+    feed.remove(instance.id)
+
+
+def init_app(app):
+    feed.configure(app.config.get('FEED_SIZE', 10000), app.config.get('FEED_RESYNC_SECONDS', 30))
+    return feed
@@ -0,0 +1,74 @@
+import threading
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasher:
+    """Password hashing with configurable KDF parameters.
+
+    With `workers` > 0 the hashing runs in a process pool, so request
+    threads only wait on a future instead of holding the GIL for the
+    whole key derivation. At most `max_pending` jobs are queued at once;
+    further callers block until a slot frees up. `workers=0` hashes
+    inline on the calling thread.
+    """
+
+    def __init__(self, method='pbkdf2:sha256', salt_length=16, workers=0, max_pending=None):
+        self.pool = None
+        self.options = None
+        self.configure(method, salt_length, workers, max_pending)
+
+    def configure(self, method, salt_length=16, workers=0, max_pending=None):
+        options = (method, salt_length, workers, max_pending)
+        if options == self.options:
+            return
+        self.shutdown()
+        self.method, self.salt_length, self.workers = method, salt_length, workers
+        self._prefix = None
+        self.slots = threading.BoundedSemaphore(max_pending or max(workers, 1) * 4)
+        if workers:
+            import concurrent.futures
+            import multiprocessing
+            # spawned, not forked: a forked worker would inherit the web process's locks and connections
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                               mp_context=multiprocessing.get_context('spawn'))
+        self.options = options
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def _run(self, func, *args):
+        if self.pool is None:
+            return func(*args)
+        with self.slots:
+            return self.pool.submit(func, *args).result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    @property
+    def prefix(self):
+        # werkzeug fills in defaults (e.g. the iteration count), so take the
+        # prefix from a real hash rather than from `method` itself.
+        if self._prefix is None:
+            self._prefix = self.hash('').split('$', 1)[0]
+        return self._prefix
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.prefix
+
+
+hasher = PasswordHasher()
+
+
+def init_app(app):
+    hasher.configure(app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256'),
+                     app.config.get('PASSWORD_SALT_LENGTH', 16),
+                     app.config.get('PASSWORD_HASH_WORKERS', 0),
+                     app.config.get('PASSWORD_HASH_MAX_PENDING'))
+    return hasher
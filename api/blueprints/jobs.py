@@ -0,0 +1,269 @@
+"""Background jobs for admin work too slow for a request.
+
+A job is a row in `jobs` plus a call on a local process pool: the
+request only inserts the row and returns its id, and the O(N) part
+never runs on a web worker. Job functions are registered by name with
+`register` and called in a pool process as `func(job, *args)`, where
+`args` are JSON values. They report progress with `job.progress` and
+may write a file to `job.result_path(suffix)` and return its path,
+which `/api/admin/jobs/<id>/result` serves once the job is done.
+Registering an `after(*args)` callback runs it in the web process when
+the job has finished, for in-process state (caches, the memory search
+index) a pool process cannot reach.
+
+`JOB_EXECUTOR` is `process` (`JOB_WORKERS` spawned processes) or
+`thread`, which runs jobs on threads of the web process instead. A
+worker process that dies breaks its pool; the next job starts a new one.
+
+A web process stamps `heartbeat_at` on the jobs it queued every
+`JOB_HEARTBEAT_SECONDS`. `sweep`, run when a web process starts and
+after every heartbeat, fails the unfinished jobs whose process stopped
+stamping them, and deletes result files and uploads older than
+`JOB_RESULT_TTL` seconds.
+"""
+import datetime
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import peewee
+
+from api.blueprints.models import BaseModel, database, init_database
+from api.blueprints.serializers import Serializer
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+UNFINISHED = (PENDING, RUNNING)
+# missed heartbeats before a job counts as abandoned
+STALE_HEARTBEATS = 3
+
+JOBS = {}
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+
+class Job(BaseModel):
+    id = peewee.CharField(primary_key=True, default=new_id)
+    name = peewee.CharField()
+    args = peewee.TextField(default='[]')
+    status = peewee.CharField(default=PENDING)
+    done = peewee.IntegerField(default=0)
+    total = peewee.IntegerField(null=True)
+    error = peewee.TextField(null=True)
+    result = peewee.CharField(null=True)
+    created_at = peewee.DateTimeField(default=datetime.datetime.utcnow)
+    started_at = peewee.DateTimeField(null=True)
+    finished_at = peewee.DateTimeField(null=True)
+    heartbeat_at = peewee.DateTimeField(default=datetime.datetime.utcnow)
+
+    def to_dict(self):
+        data = job_serializer.serialize(self)
+        data['has_result'] = self.has_result
+        return data
+
+    @property
+    def has_result(self):
+        return self.status == DONE and self.result is not None
+
+    def progress(self, done, total):
+        self.done, self.total = done, total
+        Job.update(done=done, total=total).where(Job.id == self.id).execute()
+
+    def result_path(self, suffix):
+        os.makedirs(queue.result_dir, exist_ok=True)
+        return os.path.join(queue.result_dir, f'{self.id}{suffix}')
+
+    class Meta:
+        table_name = 'jobs'
+
+
+job_serializer = Serializer(Job, exclude=[Job.args, Job.result, Job.heartbeat_at])
+
+
+def register(name, after=None):
+    """Registers `func(job, *args)` as job `name`."""
+    def decorator(func):
+        JOBS[name] = (func, after)
+        return func
+    return decorator
+
+
+def process_pool(workers):
+    # imported here, like the pools themselves, so booting a web worker does not pay for it
+    import concurrent.futures
+    import multiprocessing
+    # spawned, not forked: a forked worker would share the web process's connections
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def thread_pool(workers):
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+EXECUTORS = {
+    'process': process_pool,
+    'thread': thread_pool,
+}
+
+
+class JobQueue:
+    def __init__(self):
+        self.pool = None
+        self.options = None
+        self.settings = None
+        self.active = set()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.configure({})
+
+    def configure(self, config, testing=False):
+        kind = config.get('JOB_EXECUTOR', 'process')
+        if kind not in EXECUTORS:
+            raise ValueError(f'Unknown job executor: {kind}.')
+        self.settings = (dict(config), testing)
+        self.result_dir = config.get('JOB_RESULT_DIR') or os.path.join(tempfile.gettempdir(), 'api-jobs')
+        self.result_ttl = config.get('JOB_RESULT_TTL', 86400)
+        self.heartbeat_seconds = config.get('JOB_HEARTBEAT_SECONDS', 30)
+        options = (kind, config.get('JOB_WORKERS', 2))
+        if options != self.options:
+            self.shutdown()
+            self.options = options
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.stopping.set()
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def executor(self):
+        # started on the first job, so booting a web worker does not spawn processes
+        with self.lock:
+            if self.pool is None:
+                self.pool = EXECUTORS[self.options[0]](self.options[1])
+                self.stopping = threading.Event()
+                threading.Thread(target=self.beat, args=(self.stopping,), name='job-heartbeat', daemon=True).start()
+            return self.pool
+
+    def restart(self, pool):
+        """Drops `pool` once a dead worker has broken it; the next job starts a new one."""
+        with self.lock:
+            if self.pool is pool:
+                self.stopping.set()
+                pool.shutdown(wait=False)
+                self.pool = None
+
+    def submit(self, *args):
+        from concurrent.futures.process import BrokenProcessPool
+        pool = self.executor()
+        try:
+            return pool.submit(*args)
+        except BrokenProcessPool:
+            self.restart(pool)
+            return self.executor().submit(*args)
+
+    def beat(self, stopping):
+        """Stamps this process's unfinished jobs and sweeps, until the pool shuts down."""
+        while not stopping.wait(self.heartbeat_seconds):
+            with database.connection_context():
+                active = list(self.active)
+                if active:
+                    Job.update(heartbeat_at=datetime.datetime.utcnow()).where(Job.id.in_(active)).execute()
+                self.sweep()
+
+    def sweep(self):
+        """Fails abandoned jobs and deletes expired result files; returns how many jobs failed."""
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.heartbeat_seconds * STALE_HEARTBEATS)
+        abandoned = (Job
+                     .update(status=FAILED, error='The process running the job stopped.', finished_at=now)
+                     .where(Job.status.in_(UNFINISHED) & (Job.heartbeat_at < stale))
+                     .execute())
+        if os.path.isdir(self.result_dir):
+            self.expire(time.time() - self.result_ttl)
+        return abandoned
+
+    def expire(self, cutoff):
+        # uploads are only named in the args of the import waiting for them
+        in_use = {arg for args, in Job.select(Job.args).where(Job.status.in_(UNFINISHED)).tuples()
+                  for arg in json.loads(args) if isinstance(arg, str)}
+        expired = []
+        for entry in os.scandir(self.result_dir):
+            if entry.is_file() and entry.path not in in_use and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                expired.append(entry.path)
+        if expired:
+            Job.update(result=None).where(Job.result.in_(expired)).execute()
+
+    def enqueue(self, name, *args):
+        if name not in JOBS:
+            raise ValueError(f'Unknown job: {name}.')
+        func, after = JOBS[name]
+        job = Job.create(name=name, args=json.dumps(args))
+        try:
+            future = self.submit(run, func, job.id, self.settings)
+        except Exception as e:
+            Job.update(status=FAILED, error=str(e) or type(e).__name__,
+                       finished_at=datetime.datetime.utcnow()).where(Job.id == job.id).execute()
+            return self.get(job.id)
+        # only now, so the heartbeat never keeps a job alive that no pool took
+        self.active.add(job.id)
+        future.add_done_callback(functools.partial(self._finished, job.id, after, args))
+        return job
+
+    def _finished(self, job_id, after, args, future):
+        self.active.discard(job_id)
+        error = future.exception()
+        if error is not None:
+            # the pool process died before it could record the failure itself
+            with database.connection_context():
+                Job.update(status=FAILED, error=str(error) or type(error).__name__,
+                           finished_at=datetime.datetime.utcnow()).where(Job.id == job_id).execute()
+        if after is not None:
+            after(*args)
+
+    def prepare(self, config, testing):
+        """Points a pool process at the web process's database."""
+        if self.settings == (config, testing):
+            return
+        from flask import Flask
+        app = Flask(__name__)
+        app.config.from_mapping(config)
+        init_database(app, testing=testing)
+        self.configure(config, testing)
+
+    def get(self, job_id):
+        return Job.get_or_none(Job.id == job_id)
+
+
+queue = JobQueue()
+
+
+def run(func, job_id, settings):
+    """Runs job `job_id` in a pool process and records how it went."""
+    queue.prepare(*settings)
+    with database.connection_context():
+        job = Job.get_by_id(job_id)
+        Job.update(status=RUNNING, started_at=datetime.datetime.utcnow()).where(Job.id == job_id).execute()
+        try:
+            changes = {'status': DONE, 'result': func(job, *json.loads(job.args))}
+        except Exception as e:
+            changes = {'status': FAILED, 'error': str(e) or type(e).__name__}
+        Job.update(finished_at=datetime.datetime.utcnow(), **changes).where(Job.id == job_id).execute()
+
+
+def init_app(app, testing=False):
+    queue.configure(app.config, testing)
+    if not testing:
+        with database.connection_context():
+            queue.sweep()
+    return queue
@@ -0,0 +1,279 @@
+"""Opt-in per-request instrumentation.
+
+With `METRICS` on, every request records named timing spans (`span`),
+the number and duration of the SQL statements it ran and its total
+time. The breakdown is sent back in a `Server-Timing` header and summed
+per endpoint for `/api/admin/metrics`. Spans can overlap: `auth`
+includes the SQL of the user lookup it does. Statement time covers
+`execute_sql` only, not rows fetched lazily afterwards.
+
+With `METRICS_PROFILE_DIR` set as well, request threads are sampled
+every `METRICS_PROFILE_INTERVAL_MS`, and requests slower than
+`METRICS_SLOW_MS` leave their stacks in that directory in collapsed
+(flamegraph) format.
+
+Counters live in the process, so every worker reports its own.
+"""
+import bisect
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+from flask import request
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAMILIES = collections.OrderedDict([
+    ('api_requests_total', ('counter', 'Requests handled.')),
+    ('api_request_duration_seconds', ('histogram', 'Time from the first request hook to the response.')),
+    ('api_slow_requests_total', ('counter', 'Requests slower than METRICS_SLOW_MS.')),
+    ('api_sql_statements_total', ('counter', 'SQL statements executed by requests.')),
+    ('api_sql_duration_seconds_total', ('counter', 'Time requests spent executing SQL statements.')),
+    ('api_span_duration_seconds_total', ('counter', 'Time requests spent in named spans.')),
+    ('api_db_pool_connections', ('gauge', 'Pooled database connections.')),
+    ('api_db_pool_max_connections', ('gauge', 'Connection pool size.')),
+])
+
+_local = threading.local()
+
+
+class RequestMetrics:
+    __slots__ = ('start', 'spans', 'sql_count', 'sql_time')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+
+def current():
+    return getattr(_local, 'request', None)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Adds the time spent in the block to the current request's `name` span."""
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - start)
+
+
+class InstrumentedMixin:
+    def execute_sql(self, sql, *args, **kwargs):
+        metrics = current()
+        if metrics is None:
+            return super().execute_sql(sql, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            metrics.sql_count += 1
+            metrics.sql_time += time.perf_counter() - start
+
+
+_instrumented = {}
+
+
+def instrumented(db_class):
+    """A subclass of the peewee database `db_class` that times its statements."""
+    if db_class not in _instrumented:
+        _instrumented[db_class] = type(f'Instrumented{db_class.__name__}', (InstrumentedMixin, db_class), {})
+    return _instrumented[db_class]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Registry:
+    """Counters and histograms keyed by (name, sorted label pairs)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.counters = collections.defaultdict(float)
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+
+    def render(self, gauges=()):
+        """The Prometheus text exposition of everything recorded, plus `gauges`.
+
+        `gauges` are (name, labels, value) triples sampled by the caller.
+        """
+        samples = collections.defaultdict(list)
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples[name].append(f'{name}{_labels(labels)} {value:g}')
+            for (name, labels), (counts, total) in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    samples[name].append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+                samples[name].append(f'{name}_sum{_labels(labels)} {total:g}')
+                samples[name].append(f'{name}_count{_labels(labels)} {cumulative}')
+        for name, labels, value in gauges:
+            samples[name].append(f'{name}{_labels(tuple(sorted(labels.items())))} {value:g}')
+        lines = []
+        for name, (kind, description) in FAMILIES.items():
+            if samples[name]:
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}'] + sorted(samples[name])
+        return '\n'.join(lines) + '\n'
+
+
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Sampler:
+    """Counts the collapsed stacks of registered threads every `interval` seconds.
+
+    A single daemon thread samples all registered threads and sleeps
+    while none are.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self, ident):
+        with self.lock:
+            self.stacks[ident] = collections.Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='metrics-sampler', daemon=True)
+                self.thread.start()
+            self.wake.set()
+
+    def stop(self, ident):
+        with self.lock:
+            return self.stacks.pop(ident, None)
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.stacks:
+                    self.wake.clear()
+                for ident, stacks in self.stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.slow = None
+        self.profile_dir = None
+        self.registry = Registry()
+        self.sampler = None
+
+    def configure(self, enabled=False, slow_ms=None, profile_dir=None, profile_interval_ms=5):
+        self.enabled = enabled
+        self.slow = slow_ms / 1000 if slow_ms is not None else None
+        self.profile_dir = profile_dir if enabled else None
+        if self.profile_dir:
+            if self.sampler is None:
+                self.sampler = Sampler()
+            self.sampler.interval = profile_interval_ms / 1000
+        self.registry.clear()
+
+    def start_request(self):
+        _local.request = RequestMetrics()
+        if self.profile_dir:
+            self.sampler.start(threading.get_ident())
+
+    def finish_request(self, response):
+        metrics = _local.__dict__.pop('request', None)
+        if metrics is None:
+            return response
+        elapsed = time.perf_counter() - metrics.start
+        timings = [f'{name};dur={seconds * 1000:.3f}' for name, seconds in metrics.spans.items()]
+        timings.append(f'sql;dur={metrics.sql_time * 1000:.3f};desc="{metrics.sql_count} statements"')
+        timings.append(f'total;dur={elapsed * 1000:.3f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        self.record(metrics, elapsed, response.status_code)
+        return response
+
+    def end_request(self, exc=None):
+        # only still set when the request failed before after_request
+        metrics = _local.__dict__.pop('request', None)
+        if metrics is not None:
+            self.record(metrics, time.perf_counter() - metrics.start, 500)
+
+    def record(self, metrics, elapsed, status):
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        registry = self.registry
+        registry.inc('api_requests_total', endpoint=endpoint, method=request.method, status=status)
+        registry.observe('api_request_duration_seconds', elapsed, endpoint=endpoint)
+        registry.inc('api_sql_statements_total', metrics.sql_count, endpoint=endpoint)
+        registry.inc('api_sql_duration_seconds_total', metrics.sql_time, endpoint=endpoint)
+        for name, seconds in metrics.spans.items():
+            registry.inc('api_span_duration_seconds_total', seconds, endpoint=endpoint, span=name)
+        slow = self.slow is not None and elapsed >= self.slow
+        if slow:
+            registry.inc('api_slow_requests_total', endpoint=endpoint)
+        if self.profile_dir:
+            stacks = self.sampler.stop(threading.get_ident())
+            if slow and stacks:
+                self.dump(stacks, elapsed)
+
+    def dump(self, stacks, elapsed):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f'{int(time.time() * 1000)}-{int(elapsed * 1000)}ms-{request.endpoint or "unmatched"}.folded'
+        with open(os.path.join(self.profile_dir, name), 'w') as file:
+            for stack, count in stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+
+metrics = Metrics()
+
+
+def init_app(app):
+    config = app.config
+    metrics.configure(config.get('METRICS', False), config.get('METRICS_SLOW_MS'),
+                      config.get('METRICS_PROFILE_DIR'), config.get('METRICS_PROFILE_INTERVAL_MS', 5))
+    if metrics.enabled:
+        app.before_request(metrics.start_request)
+        app.after_request(metrics.finish_request)
+        app.teardown_request(metrics.end_request)
+    return metrics
@@ -0,0 +1,150 @@
+"""Versioned schema migrations.
+
+The schema is not touched when the app boots. Apply pending migrations
+explicitly, before starting (or scaling) the workers:
+
+    python -m api.blueprints.migrations [--testing]
+
+`create_app` only checks that the recorded version is current, once per
+process and database. Migrations are appended to `MIGRATIONS`, never
+edited or reordered; each runs in its own transaction together with
+the row recording it.
+"""
+import argparse
+import datetime
+
+import peewee
+
+from api.blueprints.jobs import Job
+from api.blueprints.models import BaseModel, Post, Stats, User, database, init_database, recount_posts
+
+
+class SchemaVersion(BaseModel):
+    version = peewee.IntegerField(primary_key=True)
+    applied_at = peewee.DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        table_name = 'schema_version'
+
+
+def create_tables(config):
+    database.create_tables([User, Post])
+
+
+def add_missing_columns(config, models=(Post, User)):
+    """Adds model fields missing from tables created before they existed."""
+    from playhouse import migrate
+    migrator = migrate.SchemaMigrator.from_database(database.obj)
+    operations = []
+    for model in models:
+        table = model._meta.table_name
+        existing = {column.name for column in database.get_columns(table)}
+        operations.extend(migrator.add_column(table, field.column_name, field)
+                          for field in model._meta.sorted_fields
+                          if field.column_name not in existing)
+    if operations:
+        migrate.migrate(*operations)
+
+
+def add_search_vector(config):
+    if isinstance(database.obj, peewee.PostgresqlDatabase):
+        from api.blueprints.search import PostgresBackend
+        PostgresBackend(database, config.get('SEARCH_CONFIG', 'english')).create_schema()
+
+
+def add_post_counters(config):
+    add_missing_columns(config, [User])
+    database.create_tables([Stats])
+    recount_posts()
+
+
+def add_jobs(config):
+    database.create_tables([Job])
+
+
+def add_job_heartbeats(config):
+    add_missing_columns(config, [Job])
+
+
+def shard_stats(config):
+    add_missing_columns(config, [Stats])
+    Stats.reset(**Stats.totals())
+
+
+MIGRATIONS = [
+    create_tables,
+    add_missing_columns,
+    add_search_vector,
+    add_post_counters,
+    add_jobs,
+    shard_stats,
+    add_job_heartbeats,
+]
+LATEST = len(MIGRATIONS)
+
+_checked = set()
+
+
+def current_version():
+    if not database.table_exists(SchemaVersion._meta.table_name):
+        return 0
+    return SchemaVersion.select(peewee.fn.MAX(SchemaVersion.version)).scalar() or 0
+
+
+def migrate(config, reset=False):
+    """Applies pending migrations and returns the resulting version.
+
+    `reset` forgets the recorded version first, so everything is applied
+    again; the test suite uses it since test cases drop their tables.
+    """
+    with database.connection_context():
+        if reset:
+            database.drop_tables([SchemaVersion])
+        database.create_tables([SchemaVersion])
+        version = current_version()
+        sqlite = isinstance(database.obj, peewee.SqliteDatabase)
+        if sqlite:
+            # SQLite alters columns by rebuilding the table, which trips foreign keys
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+        try:
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                with database.atomic():
+                    migration(config)
+                    SchemaVersion.create(version=number)
+        finally:
+            if sqlite:
+                database.execute_sql('PRAGMA foreign_keys = ON')
+    _checked.add(database.database)
+    return max(version, LATEST)
+
+
+def check():
+    """Raises RuntimeError if the database lags behind `MIGRATIONS`."""
+    if database.database in _checked:
+        return
+    with database.connection_context():
+        version = current_version()
+    if version < LATEST:
+        raise RuntimeError(f'Database schema is at version {version}, the code needs {LATEST}. '
+                           'Run `python -m api.blueprints.migrations`.')
+    _checked.add(database.database)
+
+
+def main(argv=None):
+    from flask import Flask
+
+    from api.blueprints import get_config
+
+    parser = argparse.ArgumentParser(description='Apply pending schema migrations.')
+    parser.add_argument('--testing', action='store_true', help='migrate TEST_DATABASE')
+    args = parser.parse_args(argv)
+    app = Flask(__name__)
+    app.config.from_mapping(get_config())
+    init_database(app, testing=args.testing)
+    with database.connection_context():
+        before = current_version()
+    print(f'Schema version {before} -> {migrate(app.config)}.')
+
+
+if __name__ == '__main__':
+    main()
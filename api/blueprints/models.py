@@ -1,23 +1,42 @@
 import datetime
+import random
 
 import peewee
-from playhouse.shortcuts import model_to_dict
-from werkzeug.security import check_password_hash, generate_password_hash
+from playhouse import pool, signals
 
-database = peewee.PostgresqlDatabase(None)
+from api.blueprints import metrics
+from api.blueprints.hashing import hasher
+from api.blueprints.routing import WRITE_STORES, Router
+from api.blueprints.serializers import Serializer
 
+database = Router()
+# sent by `create_model` once the row is committed, for caches that must not fail the write
+post_commit = signals.Signal()
 
-class BaseModel(peewee.Model):
+STATS_SHARDS = 16
+
+ENGINES = {
+    'postgres': (peewee.PostgresqlDatabase, pool.PooledPostgresqlDatabase),
+    'sqlite': (peewee.SqliteDatabase, pool.PooledSqliteDatabase),
+}
+
+
+class BaseModel(signals.Model):
     @classmethod
     def create_model(cls, data):
         model_obj = cls(**data)
         try:
-            model_obj.save()
+            with cls._meta.database.atomic():
+                model_obj.save()
+                model_obj.on_created()
         except (peewee.IntegrityError, peewee.InternalError):
-            cls._meta.database.rollback()
             raise ValueError
+        post_commit.send(model_obj)
         return model_obj
 
+    def on_created(self):
+        """Runs in the transaction that inserted the row."""
+
     class Meta:
         database = database
 
@@ -27,21 +46,79 @@ class User(BaseModel):
     email = peewee.CharField(unique=True)
     password_hash = peewee.CharField()
     is_admin = peewee.BooleanField(default=False)
+    post_count = peewee.IntegerField(default=0)
+    last_post_at = peewee.DateTimeField(null=True)
 
     def to_dict(self) -> dict:
-        return model_to_dict(self, exclude=[type(self).password_hash])
+        return user_serializer.serialize(self)
+
+    @classmethod
+    def compact(cls):
+        """Users as `user_serializer.row_class` namedtuples rather than instances."""
+        return user_serializer.rows()
+
+    def on_created(self):
+        Stats.change(users=1)
+
+    @classmethod
+    def count_posts(cls, user_id, count):
+        """Adds `count` posts (negative for deletes) to the user's and the site's counters.
+
+        `last_post_at` is read back from the (author, pub_date) index in
+        the same statement. Call inside the transaction that wrote the posts.
+        """
+        counters = {cls.post_count: cls.post_count + count, cls.last_post_at: Post.latest(user_id)}
+        cls.update(counters).where(cls.id == user_id).execute()
+        Stats.change(posts=count)
 
     @classmethod
     def from_dict(cls, data: dict):
         is_admin = data.get('is_admin', False)
         data = {field: str(data[field]) for field in cls._meta.allowed_fields}
-        data['password_hash'] = generate_password_hash(data['password'])
+        data['password_hash'] = hasher.hash(data['password'])
         del data['password']
         data['is_admin'] = is_admin
         return super().create_model(data)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.password_hash = hasher.hash(password)
+            self.save(only=[User.password_hash])
+        return True
+
+    def delete_with_posts(self, chunk_size=None, progress=None):
+        """Deletes the user and all their posts with set-based DELETEs.
+
+        By default everything happens in one transaction. With `chunk_size`
+        posts go in batches of that size, each committed on its own, and
+        `progress(deleted, total)` is called after every batch; the user
+        row (and any posts written meanwhile) is removed in a final
+        transaction.
+        """
+        posts = Post.select(Post.id).where(Post.author == self)
+        if chunk_size:
+            total, deleted = posts.count(), 0
+            while True:
+                with self._meta.database.atomic():
+                    count = Post.delete().where(Post.id.in_(posts.limit(chunk_size))).execute()
+                    User.count_posts(self.id, -count)
+                deleted += count
+                if progress is not None:
+                    progress(deleted, total)
+                if count < chunk_size:
+                    break
+        with self._meta.database.atomic():
+            count = Post.delete().where(Post.author == self).execute()
+            self.delete_instance()
+            Stats.change(users=-1, posts=-count)
+
+    def delete_alone(self):
+        """Deletes a user without posts; raises IntegrityError if they have some."""
+        with self._meta.database.atomic():
+            self.delete_instance()
+            Stats.change(users=-1)
 
     def __repr__(self):
         return self.username
@@ -55,12 +132,28 @@ class Post(BaseModel):
     title = peewee.CharField()
     author = peewee.ForeignKeyField(User, backref='posts')
     text = peewee.TextField()
-    pub_date = peewee.DateTimeField(default=datetime.datetime.now())
+    pub_date = peewee.DateTimeField(default=datetime.datetime.now)
+    updated_at = peewee.DateTimeField(default=datetime.datetime.utcnow)
+    version = peewee.IntegerField(default=1)
 
     def to_dict(self):
-        post = model_to_dict(self, exclude=[User.password_hash])
-        post['pub_date'] = str(post['pub_date'])
-        return post
+        return post_serializer.serialize(self)
+
+    def on_created(self):
+        User.count_posts(self.author_id, 1)
+
+    @classmethod
+    def with_author(cls):
+        return cls.select(cls, *author_serializer.fields).join(User)
+
+    @classmethod
+    def compact(cls):
+        """`with_author` as `post_serializer.row_class` namedtuples rather than instances."""
+        return post_serializer.rows()
+
+    @classmethod
+    def latest(cls, author_id):
+        return cls.select(peewee.fn.MAX(cls.pub_date)).where(cls.author == author_id)
 
     @classmethod
     def from_dict(cls, data):
@@ -68,23 +161,207 @@ class Post(BaseModel):
         data['text'] = str(data['text'])
         return super().create_model(data)
 
+    @classmethod
+    def row(cls, data, author):
+        return {
+            'title': str(data['title']),
+            'text': str(data['text']),
+            'author': author,
+            'pub_date': data.get('pub_date') or datetime.datetime.now(),
+            'updated_at': datetime.datetime.utcnow(),
+            'version': 1,
+        }
+
+    @classmethod
+    def changes(cls, data):
+        """Update values for an edit: allowed fields plus a version bump."""
+        post_data = {field: data[field] for field in cls._meta.allowed_fields
+                     if data.get(field) is not None}
+        post_data.update(updated_at=datetime.datetime.utcnow(), version=cls.version + 1)
+        return post_data
+
+    @classmethod
+    def edit(cls, post_id, author_id, data):
+        """Applies an edit to `author_id`'s post and returns it, author attached.
+
+        With RETURNING this is one `UPDATE ... FROM users ... RETURNING`
+        statement doing the ownership check, the write and the read-back;
+        otherwise the row is read back with a second query. A new
+        `pub_date` also refreshes the author's `last_post_at`. Returns None
+        when the author has no such post.
+        """
+        changes = cls.changes(data)
+        if 'pub_date' not in changes:
+            return cls._edit(post_id, author_id, changes)
+        with cls._meta.database.atomic():
+            post = cls._edit(post_id, author_id, changes)
+            if post is not None:
+                User.update(last_post_at=cls.latest(author_id)).where(User.id == author_id).execute()
+        return post
+
+    @classmethod
+    def _edit(cls, post_id, author_id, changes):
+        query = cls.update(changes).where((cls.id == post_id) & (cls.author == author_id))
+        if not cls._meta.database.returning_clause:
+            if not query.execute():
+                return None
+            return cls.with_author().where(cls.id == post_id).get()
+        query = (query
+                 .from_(User)
+                 .where(User.id == cls.author)
+                 .returning(*post_serializer.columns())
+                 .dicts())
+        row = next(iter(query.execute()), None)
+        if row is None:
+            return None
+        post = cls(**{field.name: row[field.name] for field in cls._meta.sorted_fields})
+        post.author = User(**{field.name: row[f'author__{field.name}'] for field in author_serializer.fields})
+        return post
+
+    @classmethod
+    def delete_own(cls, post_id, author_id):
+        """Deletes `author_id`'s post; False when they have no such post."""
+        with cls._meta.database.atomic():
+            if not cls.delete().where((cls.id == post_id) & (cls.author == author_id)).execute():
+                return False
+            User.count_posts(author_id, -1)
+        return True
+
     def __repr__(self):
         return f'{self.author}: {self.title}'
 
     class Meta:
         table_name = 'posts'
         allowed_fields = 'title text pub_date'.split()
+        indexes = (
+            (('pub_date', 'id'), False),
+            (('author', 'pub_date', 'id'), False),
+        )
+
+
+class Stats(BaseModel):
+    """Site-wide counters, kept current by the writes.
+
+    They are spread over `STATS_SHARDS` rows and every write adds to a
+    random one, so concurrent writers rarely wait on the same row lock;
+    `totals()` sums the shards.
+    """
+    shard = peewee.IntegerField(default=0)
+    users = peewee.IntegerField(default=0)
+    posts = peewee.IntegerField(default=0)
+
+    @classmethod
+    def change(cls, users=0, posts=0):
+        shard = random.randrange(STATS_SHARDS)
+        cls.update(users=cls.users + users, posts=cls.posts + posts).where(cls.shard == shard).execute()
+
+    @classmethod
+    def totals(cls):
+        return cls.select(peewee.fn.COALESCE(peewee.fn.SUM(cls.users), 0).alias('users'),
+                          peewee.fn.COALESCE(peewee.fn.SUM(cls.posts), 0).alias('posts')).dicts().get()
+
+    @classmethod
+    def reset(cls, users, posts):
+        """Replaces the shards with the given totals."""
+        cls.delete().execute()
+        rows = [(shard, 0, 0) for shard in range(1, STATS_SHARDS)]
+        cls.insert_many([(0, users, posts)] + rows, fields=[cls.shard, cls.users, cls.posts]).execute()
+
+    class Meta:
+        table_name = 'stats'
+
+
+SQLITE_MAX_VARIABLES = 999
+
+
+def insert_batch_size(model, size):
+    """Rows of `model` per `insert_many`: `size`, fewer on SQLite, which caps a statement's variables."""
+    if isinstance(database.obj, peewee.SqliteDatabase):
+        return min(size, SQLITE_MAX_VARIABLES // len(model._meta.sorted_fields))
+    return size
+
+
+def recount_posts():
+    """Rebuilds every counter from the tables, for migrations and bulk loads."""
+    posts = Post.select(peewee.fn.COUNT(Post.id)).where(Post.author == User.id)
+    User.update(post_count=posts, last_post_at=Post.latest(User.id)).execute()
+    Stats.reset(users=User.select().count(), posts=Post.select().count())
+
+
+user_serializer = Serializer(User, exclude=[User.password_hash])
+# counters stay out of embedded authors, so a rendered post only changes with the post
+author_serializer = Serializer(User, exclude=[User.password_hash, User.post_count, User.last_post_at])
+post_serializer = Serializer(Post, related={'author': author_serializer})
+
+
+def database_options(config):
+    """The database class and connection options `config` asks for."""
+    engine = config.get('DB_ENGINE', 'postgres')
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown database engine: {engine}.')
+    pooled = config.get('DB_POOL', False)
+    db_class = ENGINES[engine][1 if pooled else 0]
+    if config.get('METRICS', False):
+        db_class = metrics.instrumented(db_class)
+    options = {}
+    if engine == 'postgres':
+        options.update(user=config['DB_USER'], password=config['DB_PASSWORD'], host=config['DB_HOST'])
+    else:
+        options.update(pragmas=[('foreign_keys', 1)])
+    if pooled:
+        options.update(max_connections=config.get('DB_MAX_CONNECTIONS', 20),
+                       stale_timeout=config.get('DB_STALE_TIMEOUT'),
+                       timeout=config.get('DB_WAIT_TIMEOUT'))
+        if engine == 'sqlite':
+            # pooled connections are handed from thread to thread
+            options.update(check_same_thread=False)
+    return db_class, options
+
+
+def init_database(app, testing=False):
+    """Points `database` at the primary and sets up `DB_REPLICAS`.
+
+    Each replica is a mapping of settings that differ from the primary's,
+    such as `DB_HOST` or `DATABASE` (`TEST_DATABASE` when testing).
+    """
+    config = app.config
+    key = 'DATABASE' if not testing else 'TEST_DATABASE'
+    db_class, options = database_options(config)
+    if type(database.obj) is db_class:
+        if not database.is_closed():
+            database.close()
+        database.init(config[key], **options)
+    else:
+        database.initialize(db_class(config[key], **options))
+    replicas = []
+    for replica in config.get('DB_REPLICAS') or []:
+        replica = dict(config, **replica)
+        replica_class, replica_options = database_options(replica)
+        replicas.append(replica_class(replica[key], **replica_options))
+    store = config.get('DB_STICKY_STORE', 'memory')
+    if store not in WRITE_STORES:
+        raise ValueError(f'Unknown sticky store: {store}.')
+    database.configure(replicas, config.get('DB_REPLICA_POLICY', 'round_robin'),
+                       config.get('DB_STICKY_SECONDS', 5), WRITE_STORES[store](config))
+    return database
+
+
+def open_connection():
+    database.connect(reuse_if_open=True)
+
+
+def close_connection(exc=None):
+    if not database.is_closed():
+        database.close()
+    database.close_replicas()
 
 
-def create_tables(app, drop_tables=False, testing=False):
-    db = app.config['DATABASE'] if not testing else app.config['TEST_DATABASE']
-    database.init(database=db,
-                  user=app.config['DB_USER'],
-                  password=app.config['DB_PASSWORD'],
-                  host=app.config['DB_HOST'])
-    with database:
-        if drop_tables:
-            database.drop_tables([Post, User])
-        database.create_tables([Post, User])
-    if testing:
-        return database
+def pool_stats():
+    db = database.obj
+    if not isinstance(db, pool.PooledDatabase):
+        return None
+    return {
+        'max_connections': db._max_connections,
+        'in_use': len(db._in_use),
+        'available': len(db._connections),
+    }
@@ -0,0 +1,143 @@
+"""Token-bucket rate limits.
+
+A limit like `10/minute` is a bucket of 10 tokens refilled at 10 per
+minute; every request takes one, and a request finding less than one
+is refused with the time until the next token. Buckets live in a store:
+`memory` keeps them in the process, so each worker counts on its own;
+`sqlite` keeps them in a file that every worker on the host shares, as
+a local stand-in for Redis.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from api.blueprints.cache import LRUCache
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(limit):
+    """'10/minute' -> (capacity, tokens per second)."""
+    try:
+        count, period = limit.split('/')
+        capacity, seconds = int(count), PERIODS[period.strip()]
+    except (AttributeError, KeyError, ValueError):
+        raise ValueError(f'Invalid rate limit: {limit!r}.')
+    if capacity < 1:
+        raise ValueError(f'Invalid rate limit: {limit!r}.')
+    return capacity, capacity / seconds
+
+
+def consume(state, capacity, rate, now):
+    """Takes a token from bucket `state` (tokens, updated) or None for a full one.
+
+    Returns the new state and the seconds to wait, 0 if the token was taken.
+    """
+    tokens = capacity if state is None else min(capacity, state[0] + (now - state[1]) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0.0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryStore:
+    """Buckets in an LRU map; a bucket is dropped once it would be full again."""
+
+    def __init__(self, maxsize=100000):
+        self.buckets = LRUCache(maxsize)
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            state, wait = consume(self.buckets.get(key), capacity, rate, now)
+            self.buckets.set(key, state, (capacity - state[0]) / rate)
+        return wait
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class SqliteFile:
+    """A SQLite file shared by the processes on one host, one connection per thread.
+
+    Its contents are only ever hints, so durability does not matter and
+    the file runs with `synchronous=OFF`. `schema` creates its table.
+    """
+    schema = None
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute(self.schema)
+            self.local.connection = connection
+        return connection
+
+
+class SqliteStore(SqliteFile):
+    """Buckets in a SQLite file shared by the processes on one host.
+
+    Every take is one `BEGIN IMMEDIATE` transaction, which serializes
+    the workers on the bucket file.
+    """
+    schema = 'CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+
+    def take(self, key, capacity, rate, now):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            state = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            state, wait = consume(state, capacity, rate, now)
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key,) + state)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return wait
+
+    def clear(self):
+        self.connection.execute('DELETE FROM buckets')
+
+
+STORES = {
+    'memory': lambda config: MemoryStore(config.get('RATE_LIMIT_MAX_KEYS', 100000)),
+    'sqlite': lambda config: SqliteStore(config.get('RATE_LIMIT_PATH')
+                                         or os.path.join(tempfile.gettempdir(), 'api-ratelimit.db')),
+}
+
+
+class RateLimiter:
+    def __init__(self):
+        self.limits = {}
+        self.store = MemoryStore()
+
+    def configure(self, limits, store):
+        self.limits = {name: parse_limit(limit) for name, limit in (limits or {}).items() if limit}
+        self.store = store
+
+    def hit(self, name, key):
+        """Counts a request against limit `name` for `key`; returns the seconds to wait."""
+        limit = self.limits.get(name)
+        if limit is None:
+            return 0.0
+        return self.store.take(f'{name}:{key}', *limit, time.time())
+
+
+limiter = RateLimiter()
+
+
+def init_app(app):
+    name = app.config.get('RATE_LIMIT_STORE', 'memory')
+    if name not in STORES:
+        raise ValueError(f'Unknown rate limit store: {name}.')
+    limiter.configure(app.config.get('RATE_LIMITS'), STORES[name](app.config))
+    return limiter
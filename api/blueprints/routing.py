@@ -0,0 +1,145 @@
+"""Read-replica routing for the model database.
+
+`models.database` is a `Router`: a peewee Proxy that resolves to the
+primary, except on a thread inside `reading()`, where it resolves to one
+of the `DB_REPLICAS`, picked round-robin or by fewest requests in
+flight (`DB_REPLICA_POLICY`). Read-only views enter it through
+`read_only` in the api utils; everything else, migrations and jobs
+included, stays on the primary. For `DB_STICKY_SECONDS` after a write
+the api keeps the user's reads on the primary, so they see their own
+changes whatever the replication lag. The time of each user's last
+write is kept in `DB_STICKY_STORE`: `memory` only covers the worker
+that took the write, `sqlite` (at `DB_STICKY_PATH`) every worker on the
+host, like the rate-limit stores.
+"""
+import contextlib
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+import peewee
+
+from api.blueprints.cache import LRUCache
+from api.blueprints.ratelimit import SqliteFile
+
+POLICIES = ('round_robin', 'least_connections')
+
+
+class MemoryWrites:
+    """Each user's last write time in an LRU map of this process."""
+
+    def __init__(self, maxsize=100000):
+        self.times = LRUCache(maxsize)
+
+    def set(self, user_id, wrote_at, ttl):
+        self.times.set(user_id, wrote_at, ttl)
+
+    def get(self, user_id):
+        return self.times.get(user_id)
+
+    def clear(self):
+        self.times.clear()
+
+
+class SqliteWrites(SqliteFile):
+    """Each user's last write time in a SQLite file shared by the processes on one host."""
+    schema = 'CREATE TABLE IF NOT EXISTS writes (user_id INTEGER PRIMARY KEY, wrote_at REAL NOT NULL)'
+
+    def set(self, user_id, wrote_at, ttl):
+        self.connection.execute('INSERT OR REPLACE INTO writes (user_id, wrote_at) VALUES (?, ?)',
+                                (user_id, wrote_at))
+
+    def get(self, user_id):
+        row = self.connection.execute('SELECT wrote_at FROM writes WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def clear(self):
+        self.connection.execute('DELETE FROM writes')
+
+
+WRITE_STORES = {
+    'memory': lambda config: MemoryWrites(),
+    'sqlite': lambda config: SqliteWrites(config.get('DB_STICKY_PATH')
+                                          or os.path.join(tempfile.gettempdir(), 'api-sticky.db')),
+}
+
+
+class Router(peewee.Proxy):
+    __slots__ = ('obj', '_callbacks', 'replicas', 'policy', 'active', 'turn', 'sticky_seconds', 'writes', 'local',
+                 'lock')
+
+    def __init__(self):
+        super().__init__()
+        self.replicas = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.configure([])
+
+    def __getattr__(self, attr):
+        replica = getattr(self.local, 'replica', None)
+        if replica is not None:
+            return getattr(replica, attr)
+        return super().__getattr__(attr)
+
+    def configure(self, replicas, policy='round_robin', sticky_seconds=5, writes=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown replica policy: {policy}.')
+        self.writes = writes or MemoryWrites()
+        self.close_replicas()
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.active = [0] * len(self.replicas)
+        self.turn = itertools.count()
+        self.sticky_seconds = sticky_seconds
+
+    def pick(self):
+        with self.lock:
+            if self.policy == 'round_robin':
+                index = next(self.turn) % len(self.replicas)
+            else:
+                index = min(range(len(self.replicas)), key=self.active.__getitem__)
+            self.active[index] += 1
+        return index
+
+    @contextlib.contextmanager
+    def reading(self, replica=True):
+        """Sends this thread's queries to a replica; a no-op when `replica` is false."""
+        if not replica or not self.replicas or getattr(self.local, 'replica', None) is not None:
+            yield
+            return
+        index = self.pick()
+        self.local.replica = self.replicas[index]
+        try:
+            yield
+        finally:
+            self.local.replica = None
+            with self.lock:
+                self.active[index] -= 1
+
+    @contextlib.contextmanager
+    def primary(self):
+        """Sends this thread's queries to the primary, even inside `reading()`."""
+        replica, self.local.replica = getattr(self.local, 'replica', None), None
+        try:
+            yield
+        finally:
+            self.local.replica = replica
+
+    def wrote(self, user_id):
+        """Notes a write by `user_id`, whose reads then stay on the primary for a while."""
+        if self.replicas and self.sticky_seconds:
+            self.writes.set(user_id, time.time(), self.sticky_seconds)
+
+    def sticky(self, user_id):
+        """Whether `user_id` wrote recently enough that their reads must stay on the primary."""
+        if not self.replicas or user_id is None:
+            return False
+        wrote_at = self.writes.get(user_id)
+        return wrote_at is not None and 0 <= time.time() - wrote_at < self.sticky_seconds
+
+    def close_replicas(self):
+        for replica in self.replicas:
+            if not replica.is_closed():
+                replica.close()
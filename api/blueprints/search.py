@@ -0,0 +1,337 @@
+import bisect
+import collections
+import math
+import re
+import threading
+
+from peewee import SQL, NodeList, PostgresqlDatabase, fn
+from playhouse.signals import post_delete, post_save
+
+from api.blueprints.models import Post
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+CLAUSE = re.compile(r'"([^"]*)"|(\w+)(\*)?', re.UNICODE)
+SNIPPET_WORDS = 30
+HIGHLIGHT = ('<b>', '</b>')
+
+backend = None
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def parse_query(query):
+    """Splits a user query into (kind, tokens) clauses.
+
+    `"exact phrase"` is a phrase, `term*` a prefix and anything else a
+    plain term; every clause has to match.
+    """
+    clauses = []
+    for phrase, term, star in CLAUSE.findall(query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) == 1:
+                clauses.append(('term', tokens))
+            elif tokens:
+                clauses.append(('phrase', tokens))
+        elif term:
+            clauses.append(('prefix' if star else 'term', [term.lower()]))
+    return clauses
+
+
+class PostgresBackend:
+    """Full-text search on a weighted `tsvector` column with a GIN index.
+
+    The column is kept up to date by a trigger on `posts`, so every
+    write path (`Post.from_dict`, the edit routes, bulk inserts) feeds
+    the index without a second statement.
+    """
+
+    def __init__(self, database, config='english'):
+        self.database = database
+        self.config = config
+
+    def setup(self):
+        pass
+
+    def create_schema(self):
+        """The search column, index and trigger; applied by a migration."""
+        vector = ("setweight(to_tsvector('{0}', coalesce({1}.title, '')), 'A') || "
+                  "setweight(to_tsvector('{0}', coalesce({1}.text, '')), 'B')")
+        statements = (
+            'ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector',
+            'CREATE INDEX IF NOT EXISTS posts_search_vector ON posts USING GIN (search_vector)',
+            'CREATE OR REPLACE FUNCTION posts_search_vector_update() RETURNS trigger AS $$ '
+            'BEGIN NEW.search_vector := {}; RETURN NEW; END $$ LANGUAGE plpgsql'.format(
+                vector.format(self.config, 'NEW')),
+            'DROP TRIGGER IF EXISTS posts_search_vector_update ON posts',
+            'CREATE TRIGGER posts_search_vector_update BEFORE INSERT OR UPDATE OF title, text '
+            'ON posts FOR EACH ROW EXECUTE PROCEDURE posts_search_vector_update()',
+            'UPDATE posts SET search_vector = {} WHERE search_vector IS NULL'.format(
+                vector.format(self.config, 'posts')),
+        )
+        with self.database.atomic():
+            for statement in statements:
+                self.database.execute_sql(statement)
+
+    def index(self, post):
+        pass
+
+    def invalidate_all(self):
+        pass
+
+    def remove(self, post_id):
+        pass
+
+    def invalidate_author(self, author_id):
+        pass
+
+    @staticmethod
+    def tsquery(clauses):
+        parts = []
+        for kind, tokens in clauses:
+            if kind == 'phrase':
+                parts.append('(' + ' <-> '.join(f"'{token}'" for token in tokens) + ')')
+            elif kind == 'prefix':
+                parts.append(f"'{tokens[0]}':*")
+            else:
+                parts.append(f"'{tokens[0]}'")
+        return ' & '.join(parts)
+
+    def search(self, author_id, query, limit, offset=0):
+        clauses = parse_query(query)
+        if not clauses:
+            return []
+        vector = SQL('search_vector')
+        tsquery = fn.to_tsquery(self.config, self.tsquery(clauses))
+        rank = fn.ts_rank_cd(vector, tsquery)
+        hits = (Post
+                .select(Post.id, rank.alias('rank'))
+                .where((Post.author == author_id) & NodeList((vector, SQL('@@'), tsquery)))
+                .order_by(rank.desc(), Post.id.desc())
+                .limit(limit)
+                .offset(offset)
+                .alias('hits'))
+        snippet = fn.ts_headline(self.config, Post.text, tsquery,
+                                 'StartSel={}, StopSel={}, MaxWords={}, MinWords=10'.format(
+                                     *HIGHLIGHT, SNIPPET_WORDS))
+        query = (Post.with_author()
+                 .select_extend(hits.c.rank, snippet.alias('snippet'))
+                 .switch(Post)
+                 .join(hits, on=(Post.id == hits.c.id))
+                 .order_by(hits.c.rank.desc(), Post.id.desc()))
+        return [(post, post.rank, post.snippet) for post in query]
+
+
+class _Document:
+    __slots__ = ('tokens', 'title_length', 'text')
+
+    def __init__(self, title, text):
+        self.tokens = tokenize(title) + [None] + tokenize(text)
+        self.title_length = self.tokens.index(None)
+        self.text = text
+
+
+class _AuthorIndex:
+    def __init__(self, title_weight):
+        self.title_weight = title_weight
+        self.documents = {}
+        self.postings = {}
+        self.terms = []
+        self.length = 0
+
+    def add(self, post_id, document):
+        self.documents[post_id] = document
+        self.length += len(document.tokens)
+        for position, token in enumerate(document.tokens):
+            if token is None:
+                continue
+            if token not in self.postings:
+                self.postings[token] = {}
+                bisect.insort(self.terms, token)
+            self.postings[token].setdefault(post_id, []).append(position)
+
+    def discard(self, post_id):
+        document = self.documents.pop(post_id)
+        self.length -= len(document.tokens)
+        for token in set(document.tokens):
+            if token is None:
+                continue
+            postings = self.postings[token]
+            del postings[post_id]
+            if not postings:
+                del self.postings[token]
+                del self.terms[bisect.bisect_left(self.terms, token)]
+
+    def frequency(self, post_id, positions):
+        title_length = self.documents[post_id].title_length
+        return sum(self.title_weight if position < title_length else 1 for position in positions)
+
+    def expand(self, prefix):
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + '\uffff')
+        return self.terms[start:end]
+
+    def match(self, kind, tokens):
+        """Returns {post_id: weighted term frequency} for one query clause."""
+        if kind == 'term':
+            return {post_id: self.frequency(post_id, positions)
+                    for post_id, positions in self.postings.get(tokens[0], {}).items()}
+        if kind == 'prefix':
+            matches = collections.Counter()
+            for term in self.expand(tokens[0]):
+                for post_id, positions in self.postings[term].items():
+                    matches[post_id] += self.frequency(post_id, positions)
+            return matches
+        matches = {}
+        for post_id, positions in self.postings.get(tokens[0], {}).items():
+            following = [set(self.postings.get(token, {}).get(post_id, ())) for token in tokens[1:]]
+            starts = [start for start in positions
+                      if all(start + offset in later for offset, later in enumerate(following, 1))]
+            if starts:
+                matches[post_id] = self.frequency(post_id, starts)
+        return matches
+
+
+class MemoryBackend:
+    """In-process inverted index with the same interface as PostgresBackend.
+
+    Meant for test and development setups without Postgres. Postings are
+    partitioned per author (searches are always scoped to one author) and
+    an author's partition is loaded from the database on first use, then
+    kept current by `index`/`remove`, or dropped with `invalidate_author`
+    after set-based writes. Ranking is BM25 with title terms
+    weighted `title_weight` times.
+    """
+    k1 = 1.2
+    b = 0.75
+    title_weight = 2
+
+    def __init__(self, database):
+        self.database = database
+        self.authors = {}
+        self.owners = {}
+        self.lock = threading.RLock()
+
+    def setup(self):
+        self.invalidate_all()
+
+    def invalidate_all(self):
+        """Drops every partition, after bulk loads."""
+        with self.lock:
+            self.authors.clear()
+            self.owners.clear()
+
+    def _author(self, author_id):
+        partition = self.authors.get(author_id)
+        if partition is None:
+            partition = _AuthorIndex(self.title_weight)
+            for post in Post.select().where(Post.author == author_id):
+                partition.add(post.id, _Document(str(post.title), str(post.text)))
+                self.owners[post.id] = author_id
+            self.authors[author_id] = partition
+        return partition
+
+    def index(self, post):
+        with self.lock:
+            self.remove(post.id)
+            partition = self.authors.get(post.author_id)
+            if partition is not None:
+                partition.add(post.id, _Document(str(post.title), str(post.text)))
+                self.owners[post.id] = post.author_id
+
+    def remove(self, post_id):
+        with self.lock:
+            author_id = self.owners.pop(post_id, None)
+            if author_id is not None:
+                self.authors[author_id].discard(post_id)
+
+    def invalidate_author(self, author_id):
+        """Drops an author's partition; it is reloaded on the next search."""
+        with self.lock:
+            partition = self.authors.pop(author_id, None)
+            if partition is not None:
+                for post_id in partition.documents:
+                    del self.owners[post_id]
+
+    def score(self, partition, matches):
+        total = len(partition.documents)
+        average = partition.length / total if total else 0
+        scores = collections.Counter()
+        for clause in matches:
+            idf = math.log(1 + (total - len(clause) + 0.5) / (len(clause) + 0.5))
+            for post_id, frequency in clause.items():
+                length = len(partition.documents[post_id].tokens)
+                norm = self.k1 * (1 - self.b + self.b * length / average)
+                scores[post_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return scores
+
+    def snippet(self, text, clauses):
+        words = text.split()
+        wanted = set()
+        prefixes = []
+        for kind, tokens in clauses:
+            if kind == 'prefix':
+                prefixes.append(tokens[0])
+            else:
+                wanted.update(tokens)
+
+        def hit(word):
+            token = ''.join(tokenize(word))
+            return token in wanted or any(token.startswith(prefix) for prefix in prefixes)
+
+        first = next((i for i, word in enumerate(words) if hit(word)), 0)
+        start = max(0, first - SNIPPET_WORDS // 3)
+        window = words[start:start + SNIPPET_WORDS]
+        return ' '.join(HIGHLIGHT[0] + word + HIGHLIGHT[1] if hit(word) else word for word in window)
+
+    def search(self, author_id, query, limit, offset=0):
+        clauses = parse_query(query)
+        if not clauses:
+            return []
+        with self.lock:
+            partition = self._author(author_id)
+            matches = [partition.match(kind, tokens) for kind, tokens in clauses]
+            found = set.intersection(*(set(clause) for clause in matches))
+            scores = self.score(partition, [{k: v for k, v in clause.items() if k in found}
+                                            for clause in matches])
+            ranked = sorted(found, key=lambda post_id: (scores[post_id], post_id), reverse=True)
+            ranked = ranked[offset:offset + limit]
+            texts = {post_id: partition.documents[post_id].text for post_id in ranked}
+        posts = {post.id: post for post in Post.with_author().where(Post.id.in_(ranked))} if ranked else {}
+        return [(posts[post_id], scores[post_id], self.snippet(texts[post_id], clauses))
+                for post_id in ranked if post_id in posts]
+
+
+BACKENDS = {
+    'postgres': PostgresBackend,
+    'memory': MemoryBackend,
+}
+
+
+def init_app(app, database):
+    global backend
+    name = app.config.get('SEARCH_BACKEND', 'postgres')
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown search backend: {name}.')
+    if name == 'postgres' and not isinstance(database.obj, PostgresqlDatabase):
+        # the search column and trigger only exist on Postgres
+        name = 'memory'
+    options = {'config': app.config['SEARCH_CONFIG']} if name == 'postgres' and 'SEARCH_CONFIG' in app.config \
+        else {}
+    backend = BACKENDS[name](database, **options)
+    backend.setup()
+    return backend
+
+
+@post_save(sender=Post)
+def index_post(sender, instance, created):
+    if backend is not None:
+        backend.index(instance)
+
+
+@post_delete(sender=Post)
+def unindex_post(sender, instance):
+    if backend is not None:
+        backend.remove(instance.id)
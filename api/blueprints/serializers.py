@@ -0,0 +1,140 @@
+import collections
+
+import peewee
+
+
+def _str(value):
+    return str(value) if value is not None else None
+
+
+class Serializer:
+    """Precompiled model -> dict serializer.
+
+    The field list is read from `model._meta.sorted_fields` once and
+    compiled into three plain functions, so serializing a row costs one
+    dict literal instead of `model_to_dict`'s per-call introspection:
+
+    * `serialize(instance)` reads `instance.__data__` directly; foreign
+      keys named in `related` are nested from `__rel__` when the row was
+      joined and only fall back to a lazy fetch when it was not;
+    * `serialize_row(row)` takes a tuple from `select().tuples()` or a
+      `row_class` namedtuple from `rows()`;
+    * `serialize_dict(row)` takes a dict from `select().dicts()`.
+
+    `select()` builds the query whose column layout the last two expect:
+    the model's own columns followed by each related serializer's
+    columns, aliased `<fk>__<field>`. `rows()` is the same query yielding
+    `row_class` namedtuples, named after those columns, for listings
+    that only read and serialize: a row holds its values in one tuple,
+    with no model instance, `__data__` dict or joined related instance.
+    """
+
+    def __init__(self, model, exclude=(), related=None):
+        self.model = model
+        self.related = dict(related or {})
+        exclude = {field.name for field in exclude}
+        self.fields = [field for field in model._meta.sorted_fields
+                       if field.name not in exclude]
+        self.width = len(self.fields) + sum(s.width for s in self.related.values())
+        self.row_class = collections.namedtuple(f'{model.__name__}Row', self.names())
+        self.serialize = self._compile_instance()
+        self.serialize_row = self._compile_row()
+        self.serialize_dict = self._compile_dict()
+
+    def columns(self, prefix=None):
+        columns = []
+        for field in self.fields:
+            columns.append(field.alias(f'{prefix}__{field.name}') if prefix else field)
+        for name, serializer in self.related.items():
+            name = f'{prefix}__{name}' if prefix else name
+            columns.extend(serializer.columns(prefix=name))
+        return columns
+
+    def names(self, prefix=None):
+        names = [f'{prefix}__{field.name}' if prefix else field.name for field in self.fields]
+        for name, serializer in self.related.items():
+            names.extend(serializer.names(prefix=f'{prefix}__{name}' if prefix else name))
+        return names
+
+    def select(self):
+        query = self.model.select(*self.columns())
+        for name in self.related:
+            fk = self.model._meta.fields[name]
+            query = query.join(fk.rel_model, on=(fk == fk.rel_field))
+        return query
+
+    def rows(self):
+        return self.select().objects(self.row_class)
+
+    def _converter(self, field):
+        if isinstance(field, (peewee.DateTimeField, peewee.DateField, peewee.TimeField)):
+            return '_str'
+        return None
+
+    def _namespace(self):
+        namespace = {'_str': _str}
+        for name, serializer in self.related.items():
+            namespace[f'_{name}'] = serializer
+        return namespace
+
+    def _build(self, signature, body, namespace):
+        source = f'def {signature}:\n' + '\n'.join(f'    {line}' for line in body)
+        exec(compile(source, f'<serializer {self.model.__name__}>', 'exec'), namespace)
+        return namespace[signature.split('(')[0]]
+
+    def _expression(self, field, value):
+        converter = self._converter(field)
+        return f'{converter}({value})' if converter else value
+
+    def _compile_instance(self):
+        namespace = self._namespace()
+        items = []
+        for field in self.fields:
+            if field.name in self.related:
+                value = f'_related(obj, {field.name!r}, _{field.name})'
+            else:
+                value = self._expression(field, f'data.get({field.name!r})')
+            items.append(f'{field.name!r}: {value}')
+        namespace['_related'] = _related
+        return self._build('serialize(obj)', [
+            'data = obj.__data__',
+            'return {' + ', '.join(items) + '}',
+        ], namespace)
+
+    def _compile_row(self):
+        namespace = self._namespace()
+        items = []
+        offsets, position = {}, len(self.fields)
+        for name, serializer in self.related.items():
+            offsets[name] = position
+            position += serializer.width
+        for index, field in enumerate(self.fields):
+            if field.name in self.related:
+                start, end = offsets[field.name], offsets[field.name] + self.related[field.name].width
+                value = (f'_{field.name}.serialize_row(row[{start}:{end}]) '
+                         f'if row[{index}] is not None else None')
+            else:
+                value = self._expression(field, f'row[{index}]')
+            items.append(f'{field.name!r}: {value}')
+        return self._build('serialize_row(row)', ['return {' + ', '.join(items) + '}'], namespace)
+
+    def _compile_dict(self):
+        namespace = self._namespace()
+        items = []
+        for field in self.fields:
+            if field.name in self.related:
+                value = (f'_{field.name}.serialize_dict(row, prefix + {field.name + "__"!r}) '
+                         f'if row[prefix + {field.name!r}] is not None else None')
+            else:
+                value = self._expression(field, f'row[prefix + {field.name!r}]')
+            items.append(f'{field.name!r}: {value}')
+        return self._build("serialize_dict(row, prefix='')", ['return {' + ', '.join(items) + '}'], namespace)
+
+
+def _related(obj, name, serializer):
+    related = obj.__rel__.get(name)
+    if related is None:
+        if obj.__data__.get(name) is None:
+            return None
+        related = getattr(obj, name)
+    return serializer.serialize(related)
@@ -1,9 +1,13 @@
+import json
+import time
 import unittest
+from unittest import mock
 
 import mimesis
 
 from api.blueprints import create_app
-from api.blueprints.models import Post, User
+from api.blueprints.api import utils as api_utils
+from api.blueprints.models import Post, User, pool_stats
 from api.blueprints.tests.api_tests import utils
 
 MODELS = [Post, User]
@@ -53,7 +57,8 @@ class AdminRegistrationTests(unittest.TestCase):
             self.headers
         )
         self.assertAlmostEqual(code, 200)
-        self.assertAlmostEqual(len(users), 11)
+        self.assertAlmostEqual(len(users['users']), 11)
+        self.assertIsNone(users['next_cursor'])
 
         code, user = utils.get(
             self.app,
@@ -80,6 +85,70 @@ class AdminRegistrationTests(unittest.TestCase):
         )
         self.assertAlmostEqual(code, 401)
 
+    def test_paginating_users(self):
+        utils.create_users(24)
+        ids, cursor = [], None
+        while True:
+            url = f'{self.link}/users?limit=10'
+            if cursor is not None:
+                url += f'&cursor={cursor}'
+            code, data = utils.get(self.app, url, self.headers)
+            self.assertAlmostEqual(code, 200)
+            self.assertAlmostEqual(data['limit'], 10)
+            ids.extend(user['id'] for user in data['users'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertListEqual(ids, sorted(user.id for user in User.select()))
+
+        for cursor in ('abc', api_utils.encode_cursor(['1']), api_utils.encode_cursor([True])):
+            code, _ = utils.get(self.app, f'{self.link}/users?cursor={cursor}', self.headers)
+            self.assertAlmostEqual(code, 400)
+        code, _ = utils.get(self.app, f'{self.link}/users?limit=none', self.headers)
+        self.assertAlmostEqual(code, 400)
+
+    def test_listing_query_count(self):
+        utils.create_users(3)
+        for quantity in (5, 40):
+            utils.create_posts(quantity, [User.get_by_id(2)])
+            # auth, page versions, rendered rows
+            with utils.assert_max_queries(self, self.db, 3):
+                code, _ = utils.get(self.app, f'{self.link}/user/2/posts', self.headers)
+            self.assertAlmostEqual(code, 200)
+            with utils.assert_max_queries(self, self.db, 2):
+                code, _ = utils.get(self.app, f'{self.link}/users', self.headers)
+            self.assertAlmostEqual(code, 200)
+
+    def test_streaming_users(self):
+        utils.create_users(10)
+        with mock.patch.object(api_utils, 'STREAM_BATCH_SIZE', 3):
+            r = self.app.get(f'{self.link}/users?stream=json', headers=self.headers)
+            self.assertAlmostEqual(r.status_code, 200)
+            users = json.loads(r.get_data())
+            self.assertListEqual(users, [user.to_dict() for user in User.select().order_by(User.id)])
+
+            r = self.app.get(f'{self.link}/users?stream=ndjson', headers=self.headers)
+            self.assertAlmostEqual(r.status_code, 200)
+            self.assertEqual(r.mimetype, 'application/x-ndjson')
+            lines = r.get_data(as_text=True).splitlines()
+            self.assertListEqual([json.loads(line) for line in lines], users)
+
+        utils.create_posts(20)
+        r = self.app.get(f'{self.link}/user/2/posts?stream=json', headers=self.headers)
+        self.assertAlmostEqual(len(json.loads(r.get_data())), User.get_by_id(2).posts.count())
+
+        code, _ = utils.get(self.app, f'{self.link}/users?stream=xml', self.headers)
+        self.assertAlmostEqual(code, 400)
+
+    def test_pool_stats(self):
+        code, stats = utils.get(self.app, f'{self.link}/db/pool', self.headers)
+        if pool_stats() is None:
+            self.assertAlmostEqual(code, 404)
+            return
+        self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(stats['in_use'], 1)
+        self.assertAlmostEqual(pool_stats()['in_use'], 0)
+
     def test_deleting_user(self):
         utils.create_users(10)
         code, msg = utils.delete(
@@ -115,6 +184,32 @@ class AdminRegistrationTests(unittest.TestCase):
         num_of_posts = Post.select().where(Post.author == seventh_user).count()
         self.assertAlmostEqual(num_of_posts, 0)
 
+        author = Post.select().first().author
+        code, _ = utils.delete(self.app, f'{self.link}/user/{author.id}', self.headers)
+        self.assertAlmostEqual(code, 403)
+        self.assertIsNotNone(User.get_or_none(User.id == author.id))
+
+    def test_deleting_user_in_background(self):
+        utils.create_users(2)
+        utils.create_posts(30, [User.get_by_id(2)])
+        with mock.patch('api.blueprints.api.admin.DELETE_CHUNK_SIZE', 7):
+            code, task = utils.delete(self.app, f'{self.link}/user/2', self.headers,
+                                      'application/json', {'delete_posts': True, 'background': True})
+            self.assertAlmostEqual(code, 202)
+            for _ in range(100):
+                code, task = utils.get(self.app, f'{self.link}/tasks/{task["id"]}', self.headers)
+                if task['status'] in ('done', 'failed'):
+                    break
+                time.sleep(0.05)
+        self.assertAlmostEqual(code, 200)
+        self.assertEqual(task['status'], 'done')
+        self.assertAlmostEqual(task['done'], 30)
+        self.assertIsNone(User.get_or_none(User.id == 2))
+        self.assertAlmostEqual(Post.select().where(Post.author == 2).count(), 0)
+
+        code, _ = utils.get(self.app, f'{self.link}/tasks/abc', self.headers)
+        self.assertAlmostEqual(code, 404)
+
     def test_getting_users_posts(self):
         utils.create_users(10)
         utils.create_posts(50)
@@ -131,7 +226,7 @@ class AdminRegistrationTests(unittest.TestCase):
             self.headers
         )
         self.assertAlmostEqual(code, 200)
-        self.assertTrue(len(posts) > 0)
+        self.assertTrue(len(posts['posts']) > 0)
 
         code, _ = utils.get(
             self.app,
@@ -155,18 +250,34 @@ class AdminRegistrationTests(unittest.TestCase):
         )
         self.assertAlmostEqual(code, 404)
 
+    def test_bulk_adding_users_posts(self):
+        utils.create_users(2)
+        items = [{'title': t.title(), 'text': t.text()} for _ in range(12)]
+        code, data = utils.post_json(self.app, f'{self.link}/user/2/posts/bulk', items, self.headers)
+        self.assertAlmostEqual(code, 201)
+        self.assertAlmostEqual(data['created'], 12)
+        self.assertAlmostEqual(User.get_by_id(2).posts.count(), 12)
+        code, _ = utils.post_json(self.app, f'{self.link}/user/40/posts/bulk', items, self.headers)
+        self.assertAlmostEqual(code, 404)
+
     def test_editing_users_post(self):
         utils.create_users(3)
         utils.create_posts(50)
         post_id = User.get_by_id(2).posts.first().get_id()
-        code, post = utils.post(
-            self.app,
-            f'{self.link}/user/2/post/{post_id}',
-            self.headers,
-            title=42
-        )
+        utils.get(self.app, f'{self.link}/users', self.headers)
+        # auth is cached; one UPDATE ... RETURNING, or UPDATE + SELECT without it
+        statements = 1 if self.db.returning_clause else 2
+        with utils.assert_max_queries(self, self.db, statements):
+            code, post = utils.post(
+                self.app,
+                f'{self.link}/user/2/post/{post_id}',
+                self.headers,
+                title=42
+            )
         self.assertAlmostEqual(code, 200)
         self.assertAlmostEqual(post['title'], '42')
+        self.assertAlmostEqual(post['author']['id'], 2)
+        self.assertAlmostEqual(post['version'], 2)
 
         code, _ = utils.post(
             self.app,
@@ -210,6 +321,62 @@ class AdminRegistrationTests(unittest.TestCase):
         self.assertAlmostEqual(code, 200)
         self.assertIs(None, Post.select().where(Post.id == post_id).first())
 
+    def test_users_post_lookup_queries(self):
+        utils.create_users(2)
+        utils.create_posts(5, [User.get_by_id(2)])
+        post_id = User.get_by_id(2).posts.first().get_id()
+        other_id = Post.create(title='t', text='t', author=User.get_by_id(3)).id
+        utils.get(self.app, f'{self.link}/users', self.headers)
+
+        with utils.assert_max_queries(self, self.db, 1):
+            code, data = utils.get(self.app, f'{self.link}/user/404/post/{post_id}', self.headers)
+        self.assertAlmostEqual((code, data['error']), (404, 'User does not exist.'))
+        with utils.assert_max_queries(self, self.db, 1):
+            code, data = utils.get(self.app, f'{self.link}/user/2/post/{other_id}', self.headers)
+        self.assertAlmostEqual((code, data['error']), (404, 'Selected user does not have the post.'))
+        # lookup, then the joined row to render it
+        with utils.assert_max_queries(self, self.db, 2):
+            code, _ = utils.get(self.app, f'{self.link}/user/2/post/{post_id}', self.headers)
+        self.assertAlmostEqual(code, 200)
+
+        # the delete, then the user's and the site's counters
+        with utils.assert_max_queries(self, self.db, 3):
+            code, _ = utils.delete(self.app, f'{self.link}/user/2/post/{post_id}', self.headers)
+        self.assertAlmostEqual(code, 200)
+        code, data = utils.delete(self.app, f'{self.link}/user/404/post/{other_id}', self.headers)
+        self.assertAlmostEqual((code, data['error']), (404, 'User does not exist.'))
+        code, data = utils.delete(self.app, f'{self.link}/user/2/post/{other_id}', self.headers)
+        self.assertAlmostEqual((code, data['error']), (404, 'Selected user does not have the post.'))
+        self.assertIsNotNone(Post.get_or_none(Post.id == other_id))
+
+    def test_stats(self):
+        utils.create_users(3)
+        utils.create_posts(9, [User.get_by_id(2), User.get_by_id(3)])
+        utils.post_json(self.app, f'{self.link}/user/4/posts/bulk',
+                        [{'title': t.title(), 'text': t.text(), 'pub_date': '2030-01-01 00:00:00'}] * 3,
+                        self.headers)
+        utils.delete(self.app, f'{self.link}/user/2/post/{User.get_by_id(2).posts.first().id}', self.headers)
+        utils.delete(self.app, f'{self.link}/user/3', self.headers, 'application/json', {'delete_posts': True})
+        utils.create_users(1)
+
+        code, stats = utils.get(self.app, f'{self.link}/stats?users=2,3,4', self.headers)
+        self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(stats['users'], User.select().count())
+        self.assertAlmostEqual(stats['posts'], Post.select().count())
+        for user in stats['per_user']:
+            posts = Post.select().where(Post.author == user['id'])
+            self.assertAlmostEqual(user['post_count'], posts.count())
+            latest = max((post.pub_date for post in posts), default=None)
+            self.assertAlmostEqual(user['last_post_at'], str(latest) if latest else None)
+        self.assertListEqual([user['id'] for user in stats['per_user']], [2, 4])
+        self.assertAlmostEqual(stats['per_user'][1]['last_post_at'], '2030-01-01 00:00:00')
+
+        code, _ = utils.get(self.app, f'{self.link}/stats?users=a', self.headers)
+        self.assertAlmostEqual(code, 400)
+        with utils.assert_max_queries(self, self.db, 1):
+            code, _ = utils.get(self.app, f'{self.link}/stats', self.headers)
+        self.assertAlmostEqual(code, 200)
+
 
 if __name__ == '__main__':
     unittest.main()
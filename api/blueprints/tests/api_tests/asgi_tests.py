@@ -0,0 +1,176 @@
+import asyncio
+import io
+import json
+import unittest
+from unittest import mock
+
+import mimesis
+
+from api.blueprints import create_app
+from api.blueprints.api import utils as api_utils
+from api.blueprints.asgi import WsgiToAsgi, make_environ
+from api.blueprints.models import Post, User
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+p = mimesis.Person()
+t = mimesis.Text()
+
+
+class AsgiTests(unittest.TestCase):
+    def setUp(self):
+        self.client, self.db = create_app(testing=True)
+        self.app = WsgiToAsgi(self.client.application, threads=2)
+        username, password = p.username(), p.password()
+        utils.post(self.client, f'{URL}/auth/register',
+                   username=username, email=p.email(), password=password)
+        self.credentials = {'username': username, 'password': password}
+
+    def tearDown(self):
+        self.app.executor.shutdown()
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def request(self, method, path, body=b'', headers=(), query=b''):
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                 'headers': [(name.lower().encode(), value.encode()) for name, value in headers]}
+        chunks = [body[i:i + 100] for i in range(0, len(body), 100)] or [b'']
+        incoming = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        self.received = 0
+        sent = []
+
+        async def receive():
+            self.received += 1
+            return incoming.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.app(scope, receive, send))
+        start, bodies = sent[0], sent[1:]
+        self.assertFalse(bodies[-1].get('more_body'))
+        headers = {name.decode(): value.decode() for name, value in start['headers']}
+        return start['status'], headers, b''.join(message['body'] for message in bodies)
+
+    def login(self):
+        body = json.dumps(self.credentials).encode()
+        _, _, data = self.request('POST', f'{URL}/auth/login', body, [('Content-Type', 'application/json')])
+        return [('x-access-token', json.loads(data)['token'])]
+
+    def test_json_round_trip(self):
+        headers = self.login()
+        body = json.dumps({'title': 'Title', 'text': t.text()}).encode()
+        code, _, data = self.request('POST', f'{URL}/me/post', body,
+                                     headers + [('Content-Type', 'application/json')])
+        self.assertAlmostEqual(code, 201)
+        post = json.loads(data)
+        code, response_headers, data = self.request('GET', f"{URL}/me/post/:{post['id']}", headers=headers)
+        self.assertAlmostEqual(code, 200)
+        self.assertDictEqual(json.loads(data), post)
+
+        code, _, data = self.request('GET', f"{URL}/me/post/:{post['id']}",
+                                     headers=headers + [('If-None-Match', response_headers['etag'])])
+        self.assertAlmostEqual(code, 304)
+        self.assertAlmostEqual(data, b'')
+
+    def test_query_string_and_streaming(self):
+        headers = self.login()
+        user = User.get(User.username == self.credentials['username'])
+        utils.create_posts(7, [user])
+        code, _, data = self.request('GET', f'{URL}/posts', headers=headers, query=b'limit=3')
+        self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(len(json.loads(data)['posts']), 3)
+
+        with mock.patch.object(api_utils, 'STREAM_BATCH_SIZE', 2):
+            code, response_headers, data = self.request('GET', f'{URL}/posts', headers=headers,
+                                                        query=b'stream=ndjson')
+        self.assertAlmostEqual(code, 200)
+        self.assertIn('ndjson', response_headers['content-type'])
+        self.assertAlmostEqual(len(data.splitlines()), 7)
+
+    def test_streamed_upload(self):
+        headers = self.login() + [('Content-Type', 'application/x-ndjson')]
+        body = b''.join(json.dumps({'title': f'Title {i}', 'text': t.text()}).encode() + b'\n' for i in range(300))
+        code, _, data = self.request('POST', f'{URL}/me/posts/bulk', body, headers)
+        self.assertAlmostEqual(code, 201)
+        self.assertDictEqual(json.loads(data), {'created': 300, 'errors': []})
+        self.assertAlmostEqual(self.received, len(range(0, len(body), 100)))
+
+        # a handler that never reads the body never waits for it
+        code, _, _ = self.request('GET', f'{URL}/posts', body, self.login())
+        self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(self.received, 0)
+
+    def test_shutdown_during_stream(self):
+        headers = self.login()
+        utils.create_posts(7, [User.get(User.username == self.credentials['username'])])
+        scope = {'type': 'http', 'method': 'GET', 'path': f'{URL}/posts', 'query_string': b'stream=ndjson',
+                 'headers': [(name.encode(), value.encode()) for name, value in headers]}
+        lifespan = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent, done = [], []
+
+        async def run():
+            unblock = asyncio.Event()
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 2:
+                    await unblock.wait()
+
+            async def lifespan_receive():
+                return lifespan.pop(0)
+
+            async def lifespan_send(message):
+                done.append(message['type'])
+
+            request = asyncio.ensure_future(self.app(scope, receive, send))
+            while len(sent) < 2:
+                await asyncio.sleep(0.01)
+            shutdown = asyncio.ensure_future(self.app({'type': 'lifespan'}, lifespan_receive, lifespan_send))
+            await asyncio.sleep(0.1)
+            # the loop is still free while the executor drains
+            self.assertNotIn('lifespan.shutdown.complete', done)
+            unblock.set()
+            await asyncio.gather(request, shutdown)
+
+        with mock.patch.object(api_utils, 'STREAM_BATCH_SIZE', 2):
+            asyncio.run(asyncio.wait_for(run(), 10))
+        self.assertListEqual(done, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertAlmostEqual(len(b''.join(message.get('body', b'') for message in sent[1:]).splitlines()), 7)
+
+    def test_disconnect_during_upload(self):
+        headers = self.login()
+        lines = [json.dumps({'title': 'Title', 'text': 'Text'}).encode() + b'\n'] * 3
+        incoming = [{'type': 'http.request', 'body': b''.join(lines), 'more_body': True},
+                    {'type': 'http.disconnect'}]
+        scope = {'type': 'http', 'method': 'POST', 'path': f'{URL}/me/posts/bulk', 'query_string': b'',
+                 'headers': [(name.encode(), value.encode())
+                             for name, value in headers + [('content-type', 'application/x-ndjson')]]}
+        sent = []
+
+        async def receive():
+            return incoming.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.app(scope, receive, send))
+        self.assertListEqual(sent, [])
+        self.assertAlmostEqual(Post.select().count(), 0)
+
+    def test_repeated_headers(self):
+        scope = {'method': 'GET', 'path': '/', 'headers': [(b'cookie', b'a=1'), (b'accept', b'text/html'),
+                                                           (b'cookie', b'b=2'), (b'accept', b'*/*')]}
+        environ = make_environ(scope, io.BytesIO())
+        self.assertEqual(environ['HTTP_COOKIE'], 'a=1; b=2')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/html,*/*')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import time
+import unittest
+from unittest import mock
+
+from api.blueprints.cache import LRUCache, TokenCache, UserCache
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_eviction(self):
+        evicted = []
+        cache = LRUCache(2, on_evict=lambda key, value: evicted.append(key))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertListEqual(evicted, ['b'])
+        self.assertAlmostEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_expiry(self):
+        cache = LRUCache(2, ttl=10)
+        with mock.patch('time.monotonic', return_value=100):
+            cache.set('a', 1)
+            cache.set('b', 2, ttl=1)
+        with mock.patch('time.monotonic', return_value=105):
+            self.assertAlmostEqual(cache.get('a'), 1)
+            self.assertIsNone(cache.get('b'))
+        with mock.patch('time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('a'))
+
+    def test_weight(self):
+        cache = LRUCache(10, weigh=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        cache.set('a', 'xxxxxxx')
+        self.assertIsNone(cache.get('b'))
+        self.assertAlmostEqual(cache.weight, 7)
+        cache.set('c', 'x' * 11)
+        self.assertIsNone(cache.get('c'))
+        self.assertAlmostEqual(cache.get('a'), 'xxxxxxx')
+        cache.pop('a')
+        self.assertAlmostEqual(cache.weight, 0)
+
+
+class UserCacheTests(unittest.TestCase):
+    def test_invalidation(self):
+        cache = UserCache(maxsize=2, ttl=60)
+        cache.set({'id': 1})
+        cache.set({'id': 2})
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        self.assertDictEqual(cache.get(2), {'id': 2})
+
+
+class TokenCacheTests(unittest.TestCase):
+    def test_expiry(self):
+        cache = TokenCache()
+        cache.set('t1', {'id': 1, 'exp': time.time() + 60})
+        cache.set('t2', {'id': 1, 'exp': time.time() - 1})
+        self.assertAlmostEqual(cache.get('t1')['id'], 1)
+        self.assertIsNone(cache.get('t2'))
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('t1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import threading
+import unittest
+from unittest import mock
+
+import mimesis
+
+from api.blueprints import create_app
+from api.blueprints.feed import feed
+from api.blueprints.models import Post, User
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+p = mimesis.Person()
+t = mimesis.Text()
+
+
+class FeedTests(unittest.TestCase):
+    link = f'{URL}/me/posts/others'
+
+    def setUp(self):
+        self.app, self.db = create_app(testing=True)
+        self.reader, self.headers = self.login()
+        self.writer, self.writer_headers = self.login()
+        utils.create_posts(12, [User.get_by_id(self.writer)])
+        utils.create_posts(5, [User.get_by_id(self.reader)])
+        utils.create_posts(8, [User.get_by_id(self.writer)])
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def login(self):
+        username, password = p.username(), p.password()
+        user = User.from_dict({'username': username, 'email': p.email(), 'password': password})
+        _, data = utils.post(self.app, f'{URL}/auth/login', username=username, password=password)
+        return user.id, {'x-access-token': data['token']}
+
+    def pages(self, limit=6):
+        pages, cursor = [], None
+        while True:
+            url = f'{self.link}?limit={limit}' + (f'&cursor={cursor}' if cursor else '')
+            r = self.app.get(url, headers=self.headers)
+            self.assertAlmostEqual(r.status_code, 200)
+            data = r.get_json()
+            pages.append((data, r.headers['ETag']))
+            cursor = data['next_cursor']
+            if cursor is None:
+                return pages
+
+    def titles(self):
+        return [post['title'] for data, _ in self.pages() for post in data['posts']]
+
+    def test_pages_match_database(self):
+        from_feed = self.pages()
+        feed.configure(0)
+        from_database = self.pages()
+        self.assertEqual(from_feed, from_database)
+        self.assertEqual(sum(len(data['posts']) for data, _ in from_feed), 20)
+
+    def test_incremental_updates(self):
+        self.pages()
+        post = Post.select().where(Post.author == self.writer).order_by(Post.id).first()
+        code, _ = utils.post(self.app, f'{URL}/me/post/:{post.id}', self.writer_headers, title='Edited')
+        self.assertAlmostEqual(code, 200)
+        code, _ = utils.post(self.app, f'{URL}/me/post', self.writer_headers, title='Added', text=t.text())
+        self.assertAlmostEqual(code, 201)
+        with utils.count_queries(self.db) as queries:
+            pages = self.pages()
+            titles = [post['title'] for data, _ in pages for post in data['posts']]
+        # a page only looks up the versions of its own posts
+        self.assertEqual(len(queries), len(pages))
+        self.assertEqual(titles[0], 'Added')
+        self.assertIn('Edited', titles)
+
+        code, _ = utils.delete(self.app, f'{URL}/me/post/:{post.id}', self.writer_headers)
+        self.assertAlmostEqual(code, 200)
+        self.assertNotIn('Edited', self.titles())
+
+        code, _ = utils.post_json(self.app, f'{URL}/me/posts/bulk', [{'title': 'Bulk', 'text': t.text()}],
+                                  self.writer_headers)
+        self.assertAlmostEqual(code, 201)
+        self.assertEqual(self.titles()[0], 'Bulk')
+
+    def test_writes_from_other_processes(self):
+        self.pages()
+        deleted, edited = Post.select().where(Post.author == self.writer).order_by(Post.id.desc()).limit(2)
+        # queries, unlike the routes, bypass this process's feed, as another worker's writes do
+        Post.delete().where(Post.id == deleted.id).execute()
+        Post.update(title='Edited elsewhere', version=Post.version + 1).where(Post.id == edited.id).execute()
+        from_feed = self.pages()
+        posts = {post['id']: post['title'] for data, _ in from_feed for post in data['posts']}
+        self.assertNotIn(deleted.id, posts)
+        self.assertEqual(posts[edited.id], 'Edited elsewhere')
+        feed.configure(0)
+        self.assertEqual(from_feed, self.pages())
+
+    def test_failures_do_not_fail_writes(self):
+        self.pages()
+        with mock.patch.object(feed, '_insert', side_effect=TypeError):
+            code, _ = utils.post(self.app, f'{URL}/me/post', self.writer_headers, title='Added', text=t.text())
+        self.assertAlmostEqual(code, 201)
+        self.assertIsNone(feed.loaded_at)
+        self.assertEqual(self.titles()[0], 'Added')
+
+    def test_unparsed_pub_date(self):
+        Post.insert(title='Garbage', text=t.text(), author=self.writer, pub_date='garbage').execute()
+        self.pages()
+        code, _ = utils.post(self.app, f'{URL}/me/post', self.writer_headers, title='Added', text=t.text())
+        self.assertAlmostEqual(code, 201)
+        self.assertIn('Added', self.titles())
+
+    def test_one_reload_at_a_time(self):
+        def page_concurrently():
+            threads = [threading.Thread(target=feed.page, args=(self.reader, None, 5)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.pages()
+        with mock.patch.object(feed, '_load', wraps=feed._load) as load:
+            feed.invalidate()
+            page_concurrently()
+            self.assertEqual(load.call_count, 1)
+            feed.loaded_at -= feed.resync_seconds
+            with feed.load_lock:
+                page_concurrently()
+            self.assertEqual(load.call_count, 1)
+
+    def test_pages_past_the_buffer(self):
+        feed.configure(7)
+        code, data = utils.get(self.app, f'{self.link}?cursor=WyJ4IiwgMV0=', self.headers)
+        self.assertAlmostEqual(code, 400)
+        self.assertEqual(data['error'], 'Cursor is invalid.')
+        pages = self.pages(limit=3)
+        feed.configure(0)
+        self.assertEqual(pages, self.pages(limit=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from api.blueprints import jobs
+from api.blueprints.models import Post, User
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+
+@jobs.register('count_to')
+def count_to(job, total):
+    for done in range(1, total + 1):
+        job.progress(done, total)
+
+
+@jobs.register('broken')
+def broken(job):
+    raise ValueError('Broken.')
+
+
+@jobs.register('crash')
+def crash(job):
+    os._exit(1)
+
+
+class JobTests(unittest.TestCase):
+    link = f'{URL}/admin'
+    executor = 'process'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app, self.db = utils.create_test_app(JOB_EXECUTOR=self.executor, JOB_RESULT_DIR=self.directory.name)
+        self.headers = utils.login_admin(self.app)
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+        self.directory.cleanup()
+
+    def wait(self, job):
+        return utils.wait_for_job(self, self.app, self.headers, job)
+
+    def result(self, job):
+        r = self.app.get(f'{self.link}/jobs/{job["id"]}/result', headers=self.headers)
+        return r.status_code, r.get_data(as_text=True)
+
+    def test_export_users(self):
+        utils.create_users(5)
+        code, job = utils.post(self.app, f'{self.link}/users/export', self.headers)
+        self.assertAlmostEqual(code, 202)
+        self.assertEqual(job['status'], jobs.PENDING)
+        self.assertFalse(job['has_result'])
+        job = self.wait(job)
+        self.assertEqual(job['status'], jobs.DONE)
+        self.assertEqual((job['done'], job['total']), (6, 6))
+        self.assertTrue(job['has_result'])
+        code, body = self.result(job)
+        self.assertAlmostEqual(code, 200)
+        users = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(users, [user.to_dict() for user in User.select().order_by(User.id)])
+
+    def test_export_posts(self):
+        utils.create_users(2)
+        utils.create_posts(12, [User.get_by_id(2)])
+        code, job = utils.post(self.app, f'{self.link}/user/2/posts/export', self.headers)
+        self.assertAlmostEqual(code, 202)
+        job = self.wait(job)
+        self.assertEqual((job['status'], job['done']), (jobs.DONE, 12))
+        _, body = self.result(job)
+        expected = Post.with_author().where(Post.author == 2).order_by(Post.pub_date.desc(), Post.id.desc())
+        self.assertEqual([json.loads(line) for line in body.splitlines()], [post.to_dict() for post in expected])
+
+        code, data = utils.post(self.app, f'{self.link}/user/99/posts/export', self.headers)
+        self.assertAlmostEqual(code, 404)
+        self.assertEqual(data['error'], 'User does not exist.')
+
+    def test_progress(self):
+        job = self.wait(jobs.queue.enqueue('count_to', 3).to_dict())
+        self.assertEqual((job['status'], job['done'], job['total']), (jobs.DONE, 3, 3))
+        self.assertIsNotNone(job['finished_at'])
+        code, data = self.result(job)
+        self.assertAlmostEqual(code, 404)
+        self.assertEqual(json.loads(data)['error'], 'Job has no result.')
+
+    def test_failure(self):
+        job = self.wait(jobs.queue.enqueue('broken').to_dict())
+        self.assertEqual((job['status'], job['error']), (jobs.FAILED, 'Broken.'))
+        with self.assertRaises(ValueError):
+            jobs.queue.enqueue('missing')
+
+    def test_dead_worker(self):
+        if self.executor != 'process':
+            self.skipTest('A crash would take the test process with it.')
+        job = self.wait(jobs.queue.enqueue('crash').to_dict())
+        self.assertEqual(job['status'], jobs.FAILED)
+        job = self.wait(jobs.queue.enqueue('count_to', 2).to_dict())
+        self.assertEqual(job['status'], jobs.DONE)
+        self.assertSetEqual(jobs.queue.active, set())
+
+        with mock.patch.object(jobs.queue, 'submit', side_effect=RuntimeError('No workers.')):
+            job = jobs.queue.enqueue('count_to', 2)
+        self.assertEqual((job.status, job.error), (jobs.FAILED, 'No workers.'))
+        self.assertNotIn(job.id, jobs.queue.active)
+
+    def test_sweep(self):
+        paths = {name: os.path.join(self.directory.name, name) for name in ('expired', 'upload', 'recent')}
+        for name, path in paths.items():
+            open(path, 'w').close()
+            if name != 'recent':
+                os.utime(path, (0, 0))
+        old = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        created = [
+            jobs.Job.create(name='count_to', args='[1]', status=jobs.RUNNING, heartbeat_at=old),
+            jobs.Job.create(name='count_to', args='[1]', status=jobs.RUNNING),
+            jobs.Job.create(name='import_table', args=json.dumps(['posts', 'csv', paths['upload']])),
+            jobs.Job.create(name='export_users', status=jobs.DONE, result=paths['expired']),
+        ]
+        self.assertEqual(jobs.queue.sweep(), 1)
+        abandoned, running, waiting, expired = [jobs.queue.get(job.id) for job in created]
+        self.assertEqual((abandoned.status, abandoned.error), (jobs.FAILED, 'The process running the job stopped.'))
+        self.assertEqual((running.status, waiting.status), (jobs.RUNNING, jobs.PENDING))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['recent', 'upload'])
+        self.assertFalse(expired.has_result)
+        jobs.Job.delete().where(jobs.Job.id.in_([job.id for job in created])).execute()
+
+    def test_missing_job(self):
+        code, data = utils.get(self.app, f'{self.link}/jobs/abc', self.headers)
+        self.assertAlmostEqual(code, 404)
+        self.assertEqual(data['error'], 'Job does not exist.')
+        code, _ = self.result({'id': 'abc'})
+        self.assertAlmostEqual(code, 404)
+
+
+class ThreadJobTests(JobTests):
+    executor = 'thread'
+
+
+if __name__ == '__main__':
+    unittest.main()
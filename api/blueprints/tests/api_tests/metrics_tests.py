@@ -0,0 +1,84 @@
+import glob
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from api.blueprints import create_app
+from api.blueprints.api import utils as api_utils
+from api.blueprints.metrics import metrics
+from api.blueprints.models import Post, User, pool_stats
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+
+def create_instrumented_app(**config):
+    return utils.create_test_app(**dict({'METRICS': True}, **config))
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.app, self.db = create_instrumented_app()
+        self.headers = utils.login_admin(self.app)
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def test_server_timing(self):
+        utils.create_posts(3)
+        r = self.app.get(f'{URL}/posts', headers=self.headers)
+        self.assertAlmostEqual(r.status_code, 200)
+        timings = dict(timing.split(';', 1) for timing in r.headers['Server-Timing'].split(', '))
+        self.assertIn('auth', timings)
+        self.assertIn('serialize', timings)
+        self.assertIn('total', timings)
+        with utils.count_queries(self.db) as queries:
+            r = self.app.get(f'{URL}/posts', headers=self.headers)
+        self.assertIn(f'desc="{len(queries)} statements"', r.headers['Server-Timing'])
+
+    def test_prometheus_endpoint(self):
+        for _ in range(2):
+            self.app.get(f'{URL}/posts', headers=self.headers)
+        r = self.app.get(f'{URL}/admin/metrics', headers=self.headers)
+        self.assertAlmostEqual(r.status_code, 200)
+        self.assertTrue(r.mimetype.startswith('text/plain'))
+        text = r.get_data(as_text=True)
+        self.assertIn('# TYPE api_request_duration_seconds histogram', text)
+        self.assertIn('api_requests_total{endpoint="/api/posts",method="GET",status="200"} 2', text)
+        self.assertIn('api_request_duration_seconds_count{endpoint="/api/posts"} 2', text)
+        self.assertIn('api_span_duration_seconds_total{endpoint="/api/posts",span="auth"}', text)
+        self.assertIn('api_sql_statements_total{endpoint="/api/posts"}', text)
+        if pool_stats() is not None:
+            self.assertIn('api_db_pool_connections{state="in_use"}', text)
+
+    def test_slow_request_profile(self):
+        authenticate = api_utils.authenticate
+
+        def slow_authenticate(token):
+            time.sleep(0.05)
+            return authenticate(token)
+
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.configure(True, 20, directory, 1)
+            with mock.patch.object(api_utils, 'authenticate', slow_authenticate):
+                self.app.get(f'{URL}/posts', headers=self.headers)
+            self.app.get(f'{URL}/posts', headers=self.headers)
+            dumps = glob.glob(f'{directory}/*.folded')
+            self.assertAlmostEqual(len(dumps), 1)
+            with open(dumps[0]) as file:
+                self.assertIn('slow_authenticate', file.read())
+        self.assertIn('api_slow_requests_total{endpoint="/api/posts"} 1', metrics.registry.render())
+
+    def test_disabled(self):
+        app, _ = create_app(testing=True)
+        r = app.get(f'{URL}/posts', headers=self.headers)
+        self.assertNotIn('Server-Timing', r.headers)
+        code, _ = utils.get(app, f'{URL}/admin/metrics', self.headers)
+        self.assertAlmostEqual(code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import unittest
+from unittest import mock
+
+import peewee
+from playhouse import migrate
+
+import api.blueprints
+from api.blueprints import create_app, migrations
+from api.blueprints.migrations import SchemaVersion
+from api.blueprints.models import STATS_SHARDS, Post, Stats, User
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User, SchemaVersion, Stats]
+
+
+class MigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.app, self.db = create_app(testing=True)
+        self.config = self.app.application.config
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def test_check(self):
+        migrations._checked.clear()
+        SchemaVersion.delete().where(SchemaVersion.version == migrations.LATEST).execute()
+        with self.assertRaises(RuntimeError):
+            migrations.check()
+        self.assertAlmostEqual(migrations.migrate(self.config), migrations.LATEST)
+        migrations._checked.clear()
+        migrations.check()
+
+    def test_upgrading_old_schema(self):
+        utils.create_users(3)
+        utils.create_posts(10, [User.get_by_id(1), User.get_by_id(2)])
+        self.db.drop_tables([SchemaVersion, Stats])
+        migrator = migrate.SchemaMigrator.from_database(self.db.obj)
+        sqlite = isinstance(self.db.obj, peewee.SqliteDatabase)
+        if sqlite:
+            # SQLite drops a column by rebuilding the table, which trips the posts foreign key
+            self.db.execute_sql('PRAGMA foreign_keys = OFF')
+        migrate.migrate(migrator.drop_column('posts', 'version'),
+                        migrator.drop_column('posts', 'updated_at'),
+                        migrator.drop_column('users', 'post_count'),
+                        migrator.drop_column('users', 'last_post_at'))
+        if sqlite:
+            self.db.execute_sql('PRAGMA foreign_keys = ON')
+        self.assertAlmostEqual(migrations.migrate(self.config), migrations.LATEST)
+        columns = {column.name for column in self.db.get_columns('posts')}
+        self.assertTrue({'version', 'updated_at'} <= columns)
+        for user in User.select():
+            posts = Post.select().where(Post.author == user)
+            self.assertAlmostEqual(user.post_count, posts.count())
+            self.assertAlmostEqual(user.last_post_at, max((post.pub_date for post in posts), default=None))
+        self.assertDictEqual(Stats.totals(), {'users': 3, 'posts': 10})
+        self.assertAlmostEqual(Stats.select().count(), STATS_SHARDS)
+        self.assertAlmostEqual(migrations.current_version(), migrations.LATEST)
+        self.assertAlmostEqual(SchemaVersion.select().count(), migrations.LATEST)
+
+    def test_sharding_stats(self):
+        utils.create_users(3)
+        utils.create_posts(10)
+        self.db.drop_tables([Stats])
+        self.db.execute_sql('CREATE TABLE stats (id INTEGER PRIMARY KEY, users INTEGER NOT NULL, '
+                            'posts INTEGER NOT NULL)')
+        self.db.execute_sql('INSERT INTO stats (users, posts) VALUES (3, 10)')
+        first = migrations.MIGRATIONS.index(migrations.shard_stats) + 1
+        SchemaVersion.delete().where(SchemaVersion.version >= first).execute()
+        self.assertAlmostEqual(migrations.migrate(self.config), migrations.LATEST)
+        self.assertDictEqual(Stats.totals(), {'users': 3, 'posts': 10})
+        self.assertAlmostEqual(Stats.select().count(), STATS_SHARDS)
+        for _ in range(20):
+            Stats.change(posts=1)
+        self.assertDictEqual(Stats.totals(), {'users': 3, 'posts': 30})
+
+
+class ConfigTests(unittest.TestCase):
+    def test_environment_overrides(self):
+        environ = {'API_AUTH_CACHE_TTL': '5', 'API_METRICS': 'true', 'API_DB_HOST': 'db.internal'}
+        with mock.patch.dict(os.environ, environ):
+            config = api.blueprints.get_config()
+        self.assertAlmostEqual(config['AUTH_CACHE_TTL'], 5)
+        self.assertIs(config['METRICS'], True)
+        self.assertAlmostEqual(config['DB_HOST'], 'db.internal')
+        self.assertIs(api.blueprints.get_config()['METRICS'], False)
+
+    def test_overrides_keep_types(self):
+        environ = {'API_DB_PASSWORD': '0777', 'API_SECRET_KEY': 'no', 'API_DB_USER': 'admin: x',
+                   'API_DB_MAX_CONNECTIONS': '0010', 'API_RATE_LIMITS': '{login_ip: 5/minute}',
+                   'API_DB_REPLICAS': '[replica-1]', 'API_UNKNOWN': 'true'}
+        with mock.patch.dict(os.environ, environ):
+            config = api.blueprints.get_config()
+        self.assertEqual(config['DB_PASSWORD'], '0777')
+        self.assertEqual(config['SECRET_KEY'], 'no')
+        self.assertEqual(config['DB_USER'], 'admin: x')
+        self.assertEqual(config['DB_MAX_CONNECTIONS'], 10)
+        self.assertEqual(config['RATE_LIMITS'], {'login_ip': '5/minute'})
+        self.assertEqual(config['DB_REPLICAS'], ['replica-1'])
+        self.assertEqual(config['UNKNOWN'], 'true')
+        for name, value in (('API_METRICS', 'maybe'), ('API_DB_MAX_CONNECTIONS', 'many'),
+                            ('API_DB_REPLICAS', 'replica-1')):
+            with mock.patch.dict(os.environ, {name: value}), self.assertRaises(ValueError):
+                api.blueprints.get_config()
+
+
+if __name__ == '__main__':
+    unittest.main()
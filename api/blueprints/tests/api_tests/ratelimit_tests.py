@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import mimesis
+
+from api.blueprints import create_app, ratelimit
+from api.blueprints.models import Post, User
+from api.blueprints.ratelimit import MemoryStore, SqliteStore, consume, parse_limit
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+p = mimesis.Person()
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit('10/minute'), (10, 10 / 60))
+        for limit in ('10', '10/fortnight', 'ten/minute', '0/second', None):
+            with self.assertRaises(ValueError):
+                parse_limit(limit)
+
+    def test_consume(self):
+        state, wait = None, 0
+        for _ in range(3):
+            state, wait = consume(state, 3, 1, 100.0)
+            self.assertAlmostEqual(wait, 0)
+        state, wait = consume(state, 3, 1, 100.0)
+        self.assertAlmostEqual(wait, 1)
+        state, wait = consume(state, 3, 1, 100.5)
+        self.assertAlmostEqual(wait, 0.5)
+        state, wait = consume(state, 3, 1, 101.0)
+        self.assertAlmostEqual(wait, 0)
+        self.assertAlmostEqual(consume(state, 3, 1, 1000.0)[0][0], 2)
+
+    def test_shared_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'buckets.db')
+            first, second = SqliteStore(path), SqliteStore(path)
+            self.assertAlmostEqual(first.take('login:a', 2, 1, 100.0), 0)
+            self.assertAlmostEqual(second.take('login:a', 2, 1, 100.0), 0)
+            self.assertAlmostEqual(first.take('login:a', 2, 1, 100.0), 1)
+            self.assertAlmostEqual(second.take('login:b', 2, 1, 100.0), 0)
+
+
+class RateLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.app, self.db = create_app(testing=True)
+        self.username, self.password = p.username(), p.password()
+        User.from_dict({'username': self.username, 'email': p.email(), 'password': self.password})
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def login(self, username, ip='10.0.0.1'):
+        r = self.app.post(f'{URL}/auth/login', data=json.dumps({'username': username, 'password': self.password}),
+                          content_type='application/json', environ_base={'REMOTE_ADDR': ip})
+        return r.status_code, r.headers.get('Retry-After')
+
+    def test_login_per_account(self):
+        ratelimit.limiter.configure({'login_account': '2/minute'}, MemoryStore())
+        self.assertAlmostEqual(self.login(self.username)[0], 200)
+        self.assertAlmostEqual(self.login(self.username.upper(), '10.0.0.2')[0], 403)
+        code, retry_after = self.login(self.username, '10.0.0.3')
+        self.assertAlmostEqual(code, 429)
+        self.assertAlmostEqual(retry_after, '30')
+        self.assertAlmostEqual(self.login(p.username())[0], 403)
+
+    def test_login_per_identifier(self):
+        email = User.get(User.username == self.username).email
+        ratelimit.limiter.configure({'login_account': '2/minute'}, MemoryStore())
+
+        def login(**data):
+            return self.app.post(f'{URL}/auth/login', data=json.dumps(dict(data, password='wrong')),
+                                 content_type='application/json').status_code
+
+        # the lookup matches either identifier, so a new username must not buy a new bucket
+        self.assertAlmostEqual(login(email=email, username=p.username()), 403)
+        self.assertAlmostEqual(login(email=email.upper(), username=p.username()), 403)
+        self.assertAlmostEqual(login(email=email, username=p.username()), 429)
+        self.assertAlmostEqual(login(username=self.username), 403)
+
+    def test_login_per_ip(self):
+        ratelimit.limiter.configure({'login_ip': '2/hour'}, MemoryStore())
+        self.assertAlmostEqual(self.login(self.username)[0], 200)
+        self.assertAlmostEqual(self.login(self.username)[0], 200)
+        code, retry_after = self.login(self.username)
+        self.assertAlmostEqual(code, 429)
+        self.assertAlmostEqual(retry_after, '1800')
+        self.assertAlmostEqual(self.login(self.username, '10.0.0.2')[0], 200)
+
+    def test_behind_proxy(self):
+        with mock.patch.dict(os.environ, {'API_TRUSTED_PROXIES': '1'}):
+            self.app, self.db = create_app(testing=True)
+        ratelimit.limiter.configure({'login_ip': '1/hour'}, MemoryStore())
+
+        def login(forwarded_for):
+            return self.app.post(f'{URL}/auth/login', content_type='application/json',
+                                 data=json.dumps({'username': self.username, 'password': self.password}),
+                                 headers={'X-Forwarded-For': forwarded_for},
+                                 environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+
+        self.assertAlmostEqual(login('192.0.2.1'), 200)
+        self.assertAlmostEqual(login('192.0.2.2'), 200)
+        self.assertAlmostEqual(login('192.0.2.1'), 429)
+        # only the hop added by the trusted proxy counts, not what the client sent
+        self.assertAlmostEqual(login('192.0.2.2, 192.0.2.3'), 200)
+
+    def test_registration(self):
+        ratelimit.limiter.configure({'register_ip': '1/minute'}, MemoryStore())
+        data = {'username': p.username(), 'email': p.email(), 'password': p.password()}
+        code, _ = utils.post(self.app, f'{URL}/auth/register', **data)
+        self.assertAlmostEqual(code, 201)
+        code, data = utils.post(self.app, f'{URL}/auth/register', **data)
+        self.assertAlmostEqual(code, 429)
+        self.assertAlmostEqual(data['error'], 'Too many requests, try again later.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import mimesis
+import peewee
+
+from api.blueprints.models import Post, User, database
+from api.blueprints.routing import Router, SqliteWrites
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+p = mimesis.Person()
+t = mimesis.Text()
+
+
+class RouterTests(unittest.TestCase):
+    def setUp(self):
+        self.primary = peewee.SqliteDatabase(':memory:')
+        self.replicas = [peewee.SqliteDatabase(':memory:'), peewee.SqliteDatabase(':memory:')]
+        self.router = Router()
+        self.router.initialize(self.primary)
+
+    def target(self):
+        return self.router.obj if getattr(self.router.local, 'replica', None) is None else self.router.local.replica
+
+    def test_round_robin(self):
+        self.router.configure(self.replicas)
+        self.assertIs(self.target(), self.primary)
+        picked = []
+        for _ in range(4):
+            with self.router.reading():
+                picked.append(self.target())
+                with self.router.reading():
+                    self.assertIs(self.target(), picked[-1])
+        self.assertEqual(picked, self.replicas * 2)
+        self.assertIs(self.target(), self.primary)
+
+    def test_least_connections(self):
+        self.router.configure(self.replicas, 'least_connections')
+        with self.router.reading():
+            self.assertIs(self.target(), self.replicas[0])
+            self.assertEqual(self.router.pick(), 1)
+            self.assertEqual(self.router.pick(), 0)
+            self.assertEqual(self.router.active, [2, 1])
+        self.assertEqual(self.router.active, [1, 1])
+        with self.assertRaises(ValueError):
+            self.router.configure(self.replicas, 'random')
+
+    def test_sticky(self):
+        self.router.configure(self.replicas, sticky_seconds=60)
+        self.router.wrote(1)
+        self.assertTrue(self.router.sticky(1))
+        self.assertFalse(self.router.sticky(2))
+        self.assertFalse(self.router.sticky(None))
+        with mock.patch('time.time', return_value=time.time() + 90):
+            self.assertFalse(self.router.sticky(1))
+        with self.router.reading(False):
+            self.assertIs(self.target(), self.primary)
+
+    def test_shared_writes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sticky.db')
+            other = Router()
+            other.initialize(self.primary)
+            self.router.configure(self.replicas, sticky_seconds=60, writes=SqliteWrites(path))
+            other.configure(self.replicas, sticky_seconds=60, writes=SqliteWrites(path))
+            self.router.wrote(1)
+            self.assertTrue(other.sticky(1))
+            self.assertFalse(other.sticky(2))
+
+    def test_without_replicas(self):
+        self.router.wrote(1)
+        self.assertFalse(self.router.sticky(1))
+        with self.router.reading():
+            self.assertIs(self.target(), self.primary)
+
+
+class ReplicaRoutingTests(unittest.TestCase):
+    """Two SQLite copies of the test database stand in for lagging replicas."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = [os.path.join(self.directory.name, f'replica{i}.db') for i in range(2)]
+        self.app, self.db = utils.create_test_app(DB_REPLICAS=[{'TEST_DATABASE': path} for path in self.paths],
+                                                  DB_STICKY_SECONDS=60)
+        if not isinstance(self.db.obj, peewee.SqliteDatabase):
+            self.skipTest('replica stand-ins are SQLite files')
+        username, password = p.username(), p.password()
+        User.from_dict(dict(username=username, email=p.email(), password=password))
+        _, data = utils.post(self.app, f'{URL}/auth/login', username=username, password=password)
+        self.headers = {'x-access-token': data['token']}
+        self.post = Post.from_dict({'title': 'Replicated', 'text': t.text(), 'author': User.get()})
+        self.db.close()
+        for path in self.paths:
+            shutil.copy(self.db.database, path)
+
+    def tearDown(self):
+        database.configure([])
+        self.db.drop_tables(MODELS)
+        self.db.close()
+        self.directory.cleanup()
+
+    def title(self):
+        code, post = utils.get(self.app, f'{URL}/me/post/:{self.post.id}', self.headers)
+        self.assertAlmostEqual(code, 200)
+        return post['title']
+
+    def test_reads_go_to_replicas(self):
+        Post.update(title='Primary only', version=Post.version + 1).where(Post.id == self.post.id).execute()
+        with utils.count_queries(database.replicas[0]) as first, utils.count_queries(database.replicas[1]) as second:
+            self.assertEqual([self.title(), self.title()], ['Replicated', 'Replicated'])
+        self.assertTrue(first and second)
+
+    def test_sticky_after_write(self):
+        code, _ = utils.post(self.app, f'{URL}/me/post/:{self.post.id}', self.headers, title='Edited')
+        self.assertAlmostEqual(code, 200)
+        self.assertEqual(self.title(), 'Edited')
+        # the window belongs to the user, whatever client they read from, and only to them
+        other_client = self.app.application.test_client()
+        code, post = utils.get(other_client, f'{URL}/me/post/:{self.post.id}', self.headers)
+        self.assertEqual(post['title'], 'Edited')
+        username, password = p.username(), p.password()
+        User.from_dict(dict(username=username, email=p.email(), password=password))
+        _, data = utils.post(other_client, f'{URL}/auth/login', username=username, password=password)
+        _, post = utils.get(other_client, f'{URL}/me/post/:{self.post.id}', {'x-access-token': data['token']})
+        self.assertEqual(post['title'], 'Replicated')
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(self.title(), 'Replicated')
+
+    def test_feed_reads_primary(self):
+        writer = User.from_dict(dict(username=p.username(), email=p.email(), password=p.password()))
+        post = Post.from_dict({'title': 'Fresh', 'text': t.text(), 'author': writer})
+        _, data = utils.get(self.app, f'{URL}/me/posts/others', self.headers)
+        # the replicas have not seen the post yet, but the feed buffer must not lose it
+        self.assertEqual([item['id'] for item in data['posts']], [post.id])
+
+    def test_streams_read_replicas(self):
+        Post.update(title='Primary only', version=Post.version + 1).where(Post.id == self.post.id).execute()
+        with utils.count_queries(database.obj) as primary:
+            r = self.app.get(f'{URL}/posts?stream=json', headers=self.headers)
+            titles = [post['title'] for post in r.get_json()]
+        self.assertEqual(titles, ['Replicated'])
+        # only authentication reads the primary
+        self.assertEqual([sql for sql in primary if '"posts"' in sql], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+from unittest import mock
+
+import mimesis
+from peewee import PostgresqlDatabase
+
+from api.blueprints import create_app, search
+from api.blueprints.models import Post, User, database
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+p = mimesis.Person()
+
+
+class SearchTests(unittest.TestCase):
+    def setUp(self):
+        self.app, self.db = create_app(testing=True)
+        username, password = p.username(), p.password()
+        utils.post(self.app, f'{URL}/auth/register',
+                   username=username, email=p.email(), password=password)
+        _, self.user = utils.post(self.app, f'{URL}/auth/login',
+                                  username=username, password=password)
+        self.headers = {'x-access-token': self.user['token']}
+        self.posts = {}
+        for key, title, text in (
+                ('title', 'Zebra sighting', 'Nothing else to report today.'),
+                ('text', 'Field notes', 'A purple zebra crossed the road near the river.'),
+                ('reversed', 'More notes', 'The zebra was purple, not striped.'),
+                ('prefix', 'Airships', 'The zeppelin drifted over the harbour.')):
+            _, post = utils.post(self.app, f'{URL}/me/post', self.headers, title=title, text=text)
+            self.posts[key] = post['id']
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def search(self, query, **args):
+        url = f'{URL}/posts?query={query}' + ''.join(f'&{k}={v}' for k, v in args.items())
+        return utils.get(self.app, url, self.headers)
+
+    def test_ranked_terms(self):
+        code, data = self.search('zebra')
+        self.assertAlmostEqual(code, 200)
+        ids = [post['id'] for post in data['posts']]
+        self.assertSetEqual(set(ids), {self.posts['title'], self.posts['text'], self.posts['reversed']})
+        self.assertAlmostEqual(ids[0], self.posts['title'])
+        ranks = [post['rank'] for post in data['posts']]
+        self.assertListEqual(ranks, sorted(ranks, reverse=True))
+        self.assertIn('<b>', data['posts'][1]['snippet'])
+
+    def test_phrase_and_prefix(self):
+        _, data = self.search('"purple zebra"')
+        self.assertListEqual([post['id'] for post in data['posts']], [self.posts['text']])
+        _, data = self.search('zep*')
+        self.assertListEqual([post['id'] for post in data['posts']], [self.posts['prefix']])
+        _, data = self.search('zebra purple')
+        self.assertAlmostEqual(len(data['posts']), 2)
+
+    def test_only_own_posts(self):
+        utils.create_users(1)
+        other = User.get(User.id != self.user['id'])
+        Post.from_dict({'title': 'Zebra', 'text': 'zebra zebra', 'author': other})
+        _, data = self.search('zebra')
+        self.assertNotIn(other.id, [post['author']['id'] for post in data['posts']])
+
+    def test_index_follows_writes(self):
+        utils.post(self.app, f'{URL}/me/post/:{self.posts["prefix"]}', self.headers,
+                   text='Now it is about a zebra.')
+        _, data = self.search('zeppelin')
+        self.assertListEqual(data['posts'], [])
+        _, data = self.search('zebra')
+        self.assertIn(self.posts['prefix'], [post['id'] for post in data['posts']])
+
+        utils.delete(self.app, f'{URL}/me/post/:{self.posts["title"]}', self.headers)
+        _, data = self.search('zebra')
+        self.assertNotIn(self.posts['title'], [post['id'] for post in data['posts']])
+
+    def test_pages(self):
+        _, first = self.search('zebra', limit=2)
+        self.assertAlmostEqual(len(first['posts']), 2)
+        _, second = self.search('zebra', limit=2, cursor=first['next_cursor'])
+        self.assertAlmostEqual(len(second['posts']), 1)
+        self.assertIsNone(second['next_cursor'])
+        code, _ = self.search('zebra', cursor='abc')
+        self.assertAlmostEqual(code, 400)
+
+    def test_postgres_backend_needs_postgres(self):
+        app = self.app.application
+        expected = search.PostgresBackend if isinstance(database.obj, PostgresqlDatabase) else search.MemoryBackend
+        try:
+            with mock.patch.dict(app.config, SEARCH_BACKEND='postgres'):
+                self.assertIsInstance(search.init_app(app, database), expected)
+            code, data = self.search('zebra')
+            self.assertAlmostEqual(code, 200)
+            self.assertAlmostEqual(len(data['posts']), 3)
+        finally:
+            search.init_app(app, database)
+
+
+class QueryParserTests(unittest.TestCase):
+    def test_parse(self):
+        self.assertListEqual(search.parse_query('Zebra "purple  zebra" zep* "one"'), [
+            ('term', ['zebra']),
+            ('phrase', ['purple', 'zebra']),
+            ('prefix', ['zep']),
+            ('term', ['one']),
+        ])
+        self.assertListEqual(search.parse_query('"" !!'), [])
+
+    def test_tsquery(self):
+        clauses = search.parse_query('zebra "purple zebra" zep*')
+        self.assertEqual(search.PostgresBackend.tsquery(clauses),
+                         "'zebra' & ('purple' <-> 'zebra') & 'zep':*")
+
+
+if __name__ == '__main__':
+    unittest.main()
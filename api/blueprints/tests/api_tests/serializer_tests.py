@@ -0,0 +1,68 @@
+import unittest
+
+from playhouse.shortcuts import model_to_dict
+
+from api.blueprints import create_app
+from api.blueprints.models import Post, User, post_serializer, user_serializer
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+
+
+class SerializerTests(unittest.TestCase):
+    def setUp(self):
+        self.app, self.db = create_app(testing=True)
+        utils.create_users(3)
+        utils.create_posts(10)
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def expected(self):
+        posts = []
+        for post in Post.select().order_by(Post.id):
+            post = model_to_dict(post, exclude=[User.password_hash, User.post_count, User.last_post_at])
+            post['pub_date'] = str(post['pub_date'])
+            post['updated_at'] = str(post['updated_at'])
+            posts.append(post)
+        return posts
+
+    def test_instances(self):
+        self.assertListEqual([post.to_dict() for post in Post.select().order_by(Post.id)],
+                             self.expected())
+        user = User.get_by_id(1)
+        expected = model_to_dict(user, exclude=[User.password_hash])
+        expected['last_post_at'] = str(expected['last_post_at']) if expected['last_post_at'] else None
+        self.assertDictEqual(user.to_dict(), expected)
+
+    def test_joined_instances(self):
+        query = Post.select(Post, User).join(User).order_by(Post.id)
+        self.assertListEqual([post_serializer.serialize(post) for post in query],
+                             self.expected())
+
+    def test_tuples(self):
+        query = post_serializer.select().order_by(Post.id).tuples()
+        self.assertListEqual([post_serializer.serialize_row(row) for row in query],
+                             self.expected())
+
+    def test_compact_rows(self):
+        posts = list(Post.compact().order_by(Post.id))
+        self.assertIsInstance(posts[0], post_serializer.row_class)
+        self.assertEqual(posts[0].author, posts[0].author__id)
+        self.assertListEqual([post_serializer.serialize_row(post) for post in posts], self.expected())
+        users = User.compact().where(User.id > 1).order_by(User.id)
+        self.assertListEqual([user_serializer.serialize_row(row) for row in users],
+                             [user.to_dict() for user in User.select().where(User.id > 1).order_by(User.id)])
+
+    def test_dicts(self):
+        query = post_serializer.select().order_by(Post.id).dicts()
+        self.assertListEqual([post_serializer.serialize_dict(row) for row in query],
+                             self.expected())
+        users = user_serializer.select().order_by(User.id).dicts()
+        self.assertListEqual([user_serializer.serialize_dict(row) for row in users],
+                             [user.to_dict() for user in User.select().order_by(User.id)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import gzip
+import tempfile
+import unittest
+from unittest import mock
+
+from api.blueprints import jobs, snapshots
+from api.blueprints.models import Post, Stats, User
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+
+def rows(model):
+    return list(model.select(*model._meta.sorted_fields).order_by(model.id).tuples())
+
+
+class SnapshotTests(unittest.TestCase):
+    link = f'{URL}/admin'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app, self.db = utils.create_test_app(JOB_EXECUTOR='thread', JOB_RESULT_DIR=self.directory.name)
+        self.headers = utils.login_admin(self.app)
+
+    def tearDown(self):
+        self.db.drop_tables(MODELS)
+        self.db.close()
+        self.directory.cleanup()
+
+    def wait(self, job):
+        return utils.wait_for_job(self, self.app, self.headers, job)
+
+    def export(self, table, fmt):
+        code, job = utils.post(self.app, f'{self.link}/export/{table}?format={fmt}', self.headers)
+        self.assertAlmostEqual(code, 202)
+        job = self.wait(job)
+        self.assertEqual(job['status'], jobs.DONE, job['error'])
+        return self.app.get(f'{self.link}/jobs/{job["id"]}/result', headers=self.headers).get_data()
+
+    def load(self, table, fmt, body):
+        r = self.app.post(f'{self.link}/import/{table}?format={fmt}', data=body, headers=self.headers,
+                          content_type='application/octet-stream')
+        self.assertAlmostEqual(r.status_code, 202)
+        return self.wait(r.get_json())
+
+    def test_round_trip(self):
+        utils.create_users(3)
+        utils.create_posts(25)
+        users, posts = rows(User), rows(Post)
+        for fmt in ['ndjson', 'csv'] + (['parquet'] if snapshots.PARQUET else []):
+            with self.subTest(fmt=fmt), mock.patch.object(snapshots, 'BATCH_SIZE', 10):
+                dumps = {table: self.export(table, fmt) for table in ('users', 'posts')}
+                Post.delete().execute()
+                User.delete().where(User.id > 1).execute()
+                for table in ('users', 'posts'):
+                    job = self.load(table, fmt, dumps[table])
+                    self.assertEqual(job['status'], jobs.DONE, job['error'])
+                self.assertEqual((rows(User), rows(Post)), (users, posts))
+                self.assertEqual(Stats.totals(), {'users': 4, 'posts': 25})
+                self.assertEqual(sum(count for count, in User.select(User.post_count).tuples()), 25)
+
+                # ids already present are skipped
+                job = self.load('posts', fmt, dumps['posts'])
+                self.assertEqual((job['status'], job['done']), (jobs.DONE, 25))
+                self.assertEqual(rows(Post), posts)
+
+    def test_invalid_requests(self):
+        code, data = utils.post(self.app, f'{self.link}/export/stats', self.headers)
+        self.assertAlmostEqual(code, 400)
+        self.assertEqual(data['error'], 'Table must be one of: users, posts.')
+        code, data = utils.post(self.app, f'{self.link}/export/users?format=xml', self.headers)
+        self.assertAlmostEqual(code, 400)
+        if not snapshots.PARQUET:
+            code, data = utils.post(self.app, f'{self.link}/export/users?format=parquet', self.headers)
+            self.assertAlmostEqual(code, 400)
+            self.assertEqual(data['error'], 'Parquet needs pyarrow, use csv or ndjson.')
+
+        job = self.load('users', 'csv', gzip.compress(b'id,name\n1,someone\n'))
+        self.assertEqual((job['status'], job['error']), (jobs.FAILED, 'Columns do not match the table.'))
+        self.assertAlmostEqual(User.select().count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
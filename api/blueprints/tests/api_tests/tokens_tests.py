@@ -0,0 +1,97 @@
+import datetime
+import unittest
+from unittest import mock
+
+import jwt
+import mimesis
+
+from api.blueprints import create_app, hashing, tokens
+from api.blueprints.api import utils as api_utils
+from api.blueprints.models import Post, User
+from api.blueprints.tests.api_tests import utils
+
+MODELS = [Post, User]
+URL = '/api'
+
+p = mimesis.Person()
+
+
+class TokenTests(unittest.TestCase):
+    def setUp(self):
+        self.app, self.db = create_app(testing=True)
+        self.config = self.app.application.config
+        username, password = p.username(), p.password()
+        User.from_dict({'username': username, 'email': p.email(), 'password': password})
+        _, self.user = utils.post(self.app, f'{URL}/auth/login', username=username, password=password)
+
+    def tearDown(self):
+        tokens.init_app(self.app.application)
+        self.db.drop_tables(MODELS)
+        self.db.close()
+
+    def get_posts(self, token):
+        return utils.get(self.app, f'{URL}/posts', {'x-access-token': token})[0]
+
+    def refresh(self, token):
+        return utils.post(self.app, f'{URL}/auth/refresh', refresh_token=token)
+
+    def test_token_pair(self):
+        self.assertAlmostEqual(self.user['expires_in'], self.config['ACCESS_TOKEN_TTL'])
+        self.assertAlmostEqual(self.get_posts(self.user['token']), 200)
+        self.assertAlmostEqual(self.get_posts(self.user['refresh_token']), 401)
+        code, _ = self.refresh(self.user['token'])
+        self.assertAlmostEqual(code, 401)
+        code, _ = self.refresh('abc')
+        self.assertAlmostEqual(code, 401)
+
+    def test_refresh(self):
+        with mock.patch.object(hashing.hasher, 'verify') as verify:
+            code, data = self.refresh(self.user['refresh_token'])
+        self.assertAlmostEqual(code, 200)
+        verify.assert_not_called()
+        self.assertAlmostEqual(data['username'], self.user['username'])
+        self.assertAlmostEqual(self.get_posts(data['token']), 200)
+
+        User.delete().execute()
+        code, _ = self.refresh(data['refresh_token'])
+        self.assertAlmostEqual(code, 401)
+
+    def test_key_rotation(self):
+        keyring = tokens.keyring
+        keyring.configure({'old': 'first secret'}, 'old')
+        old = keyring.encode(self.user['id'])
+        self.assertAlmostEqual(jwt.get_unverified_header(old)['kid'], 'old')
+        keyring.configure({'old': 'first secret', 'new': 'second secret'}, 'new')
+        new = keyring.encode(self.user['id'])
+        self.assertAlmostEqual(jwt.get_unverified_header(new)['kid'], 'new')
+        self.assertAlmostEqual(self.get_posts(old), 200)
+        self.assertAlmostEqual(self.get_posts(new), 200)
+
+        keyring.configure({'new': 'second secret'}, 'new')
+        api_utils.token_cache.clear()
+        self.assertAlmostEqual(self.get_posts(old), 401)
+        self.assertAlmostEqual(self.get_posts(new), 200)
+        forged = jwt.encode({'id': self.user['id'], 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                            'first secret', algorithm='HS256', headers={'kid': 'new'})
+        self.assertAlmostEqual(self.get_posts(forged.decode('UTF-8') if isinstance(forged, bytes) else forged), 401)
+
+    def test_legacy_token(self):
+        token = jwt.encode({'id': self.user['id'], 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                           self.config['SECRET_KEY'], algorithm='HS256')
+        token = token.decode('UTF-8') if isinstance(token, bytes) else token
+        self.assertAlmostEqual(self.get_posts(token), 200)
+        tokens.keyring.configure({'new': 'second secret'}, 'new', legacy_key=self.config['SECRET_KEY'])
+        api_utils.token_cache.clear()
+        self.assertAlmostEqual(self.get_posts(token), 401)
+
+    def test_memoized_verification(self):
+        with mock.patch.object(jwt, 'decode', wraps=jwt.decode) as decode:
+            for _ in range(3):
+                self.assertAlmostEqual(self.get_posts(self.user['token']), 200)
+            User.get_by_id(self.user['id']).save()
+            self.assertAlmostEqual(self.get_posts(self.user['token']), 200)
+        self.assertLessEqual(decode.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
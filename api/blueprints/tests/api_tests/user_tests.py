@@ -1,9 +1,16 @@
+import datetime
+import json
+import os
+import runpy
 import unittest
+from unittest import mock
 
 import mimesis
 from flask import request
 
-from api.blueprints import create_app
+import api
+from api.blueprints import create_app, hashing
+from api.blueprints.api import utils as api_utils
 from api.blueprints.models import Post, User
 from api.blueprints.tests.api_tests import utils
 
@@ -70,6 +77,39 @@ class RegistrationTests(unittest.TestCase):
         self.assertAlmostEqual(data['username'], username)
         self.assertAlmostEqual(data['is_admin'], False)
 
+    def test_rehash_on_login(self):
+        username, email, password = p.username(), p.email(), p.password()
+        self.register(username, email, password)
+        old_hash = User.get(User.username == username).password_hash
+        self.assertFalse(hashing.hasher.needs_rehash(old_hash))
+        try:
+            hashing.hasher.configure('pbkdf2:sha256:1000', 8)
+            self.assertTrue(hashing.hasher.needs_rehash(old_hash))
+            code, _ = self.login(username=username, password=password)
+            self.assertAlmostEqual(code, 200)
+            new_hash = User.get(User.username == username).password_hash
+            self.assertTrue(new_hash.startswith('pbkdf2:sha256:1000$'))
+            code, _ = self.login(username=username, password=password)
+            self.assertAlmostEqual(code, 200)
+        finally:
+            hashing.init_app(self.app.application)
+
+    def test_hashing_in_pool(self):
+        hasher = hashing.PasswordHasher(workers=1)
+        try:
+            self.assertEqual(hasher.pool._mp_context.get_start_method(), 'spawn')
+            password_hash = hasher.hash('secret')
+            self.assertTrue(hasher.verify(password_hash, 'secret'))
+            self.assertFalse(hasher.verify(password_hash, 'guess'))
+        finally:
+            hasher.shutdown()
+
+    def test_workers_do_not_build_the_app(self):
+        # spawned workers re-run the main module under this name
+        with mock.patch('api.blueprints.create_app') as create:
+            runpy.run_path(os.path.join(os.path.dirname(api.__file__), 'app.py'), run_name='__mp_main__')
+        create.assert_not_called()
+
 
 class PostUserRelatedTests(unittest.TestCase):
     link = f'{URL}/me/post'
@@ -121,17 +161,71 @@ class PostUserRelatedTests(unittest.TestCase):
         # no data
         code, _ = utils.post(self.app, f'{self.link}/:1', self.headers)
         self.assertAlmostEqual(code, 403)
-        code, _ = utils.post(self.app, f'{self.link}/:1', self.headers,
-                             title='New title')
+        statements = 1 if self.db.returning_clause else 2
+        with utils.assert_max_queries(self, self.db, statements):
+            code, post = utils.post(self.app, f'{self.link}/:1', self.headers,
+                                    title='New title')
         self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(post['title'], 'New title')
+        self.assertAlmostEqual(post['author']['id'], self.user['id'])
+        code, _ = utils.post(self.app, f'{self.link}/:15', self.headers, title='New title')
+        self.assertAlmostEqual(code, 404)
+        code, _ = utils.post(self.app, f'{self.link}/:1', self.headers, pub_date='garbage')
+        self.assertAlmostEqual(code, 403)
+        # someone else's post
+        utils.create_users(1)
+        other = User.select().where(User.id != self.user['id']).get()
+        utils.create_posts(1, [other])
+        post_id = other.posts.get().id
+        code, _ = utils.post(self.app, f'{self.link}/:{post_id}', self.headers, title='Mine')
+        self.assertAlmostEqual(code, 403)
+        self.assertNotEqual(Post.get_by_id(post_id).title, 'Mine')
 
     def test_delete_post(self):
         code, _ = utils.delete(self.app, f'{self.link}/:15', self.headers)
         self.assertAlmostEqual(code, 404)
+        utils.create_users(1)
+        other = User.select().where(User.id != self.user['id']).get()
+        utils.create_posts(1, [other])
+        code, _ = utils.delete(self.app, f'{self.link}/:{other.posts.get().id}', self.headers)
+        self.assertAlmostEqual(code, 403)
+        other.posts.get().delete_instance()
         code, _ = utils.delete(self.app, f'{self.link}/:1', self.headers)
         self.assertAlmostEqual(code, 200)
         self.assertAlmostEqual(Post.select().count(), 0)
 
+    def test_bulk_add_posts(self):
+        items = [{'title': t.title(), 'text': t.text()} for _ in range(30)]
+        items.insert(3, {'title': 'No text'})
+        items.insert(7, 'not an object')
+        items.insert(9, {'title': t.title(), 'text': t.text(), 'pub_date': 'garbage'})
+        items.insert(11, {'title': t.title(), 'text': t.text(), 'pub_date': 5})
+        items[0]['pub_date'] = '2018-01-31 12:00:00'
+        with mock.patch.object(api_utils, 'BULK_CHUNK_SIZE', 7):
+            code, data = utils.post_json(self.app, f'{URL}/me/posts/bulk', items, self.headers)
+        self.assertAlmostEqual(code, 201)
+        self.assertAlmostEqual(data['created'], 30)
+        self.assertListEqual([e['index'] for e in data['errors']], [3, 7, 9, 11])
+        self.assertIn('pub_date', data['errors'][2]['error'])
+        self.assertAlmostEqual(Post.select().where(Post.author == self.user['id']).count(), 31)
+        self.assertEqual(Post.select().where(Post.title == items[0]['title']).get().pub_date,
+                         datetime.datetime(2018, 1, 31, 12))
+
+        body = '\n'.join([json.dumps({'title': 'a', 'text': 'b'}), '{broken', '',
+                          json.dumps({'title': 'c', 'text': 'd'})])
+        r = self.app.post(f'{URL}/me/posts/bulk', data=body, headers=self.headers,
+                          mimetype='application/x-ndjson')
+        data = json.loads(r.get_data())
+        self.assertAlmostEqual(r.status_code, 201)
+        self.assertAlmostEqual(data['created'], 2)
+        self.assertListEqual(data['errors'], [{'index': 1, 'error': 'Line is not valid json.'}])
+
+        code, data = utils.post_json(self.app, f'{URL}/me/posts/bulk', [{'title': 'x'}], self.headers)
+        self.assertAlmostEqual(code, 403)
+        self.assertAlmostEqual(data['created'], 0)
+        code, _ = utils.post_json(self.app, f'{URL}/me/posts/bulk', {'title': 'x'}, self.headers)
+        self.assertAlmostEqual(code, 400)
+
     def test_search(self):
         utils.post(self.app, self.link, self.headers,
                    title='The_Title', text=t.text())
@@ -149,7 +243,110 @@ class PostUserRelatedTests(unittest.TestCase):
         utils.create_posts(10, users)
         code, data = utils.get(self.app, f'{URL}/me/posts/others', self.headers)
         self.assertAlmostEqual(code, 200)
-        self.assertAlmostEqual(len(data), 10)
+        self.assertAlmostEqual(len(data['posts']), 10)
+
+    def test_cached_authentication(self):
+        url = f'{URL}/posts'
+        api_utils.user_cache.clear()
+        with utils.count_queries(self.db) as queries:
+            utils.get(self.app, url, self.headers)
+        api_utils.response_cache.clear()
+        with utils.count_queries(self.db) as warm_queries:
+            code, _ = utils.get(self.app, url, self.headers)
+        self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(len(warm_queries), len(queries) - 1)
+
+        User.get_by_id(self.user['id']).delete_instance(recursive=True)
+        code, _ = utils.get(self.app, url, self.headers)
+        self.assertAlmostEqual(code, 401)
+
+    def test_listing_query_count(self):
+        utils.create_users(3)
+        users = list(User.select().where(User.id != self.user['id']))
+        for quantity in (5, 40):
+            utils.create_posts(quantity, users)
+            utils.create_posts(quantity, [User.get_by_id(self.user['id'])])
+            with utils.assert_max_queries(self, self.db, 2):
+                code, _ = utils.get(self.app, f'{URL}/me/posts/others', self.headers)
+            self.assertAlmostEqual(code, 200)
+            with utils.assert_max_queries(self, self.db, 2):
+                code, _ = utils.get(self.app, f'{URL}/posts', self.headers)
+            self.assertAlmostEqual(code, 200)
+
+    def test_others_posts_pages(self):
+        utils.create_users(3)
+        users = list(User.select().where(User.id != self.user['id']))
+        utils.create_posts(25, users)
+        code, first = utils.get(self.app, f'{URL}/me/posts/others?limit=10', self.headers)
+        self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(len(first['posts']), 10)
+        seen = [post['id'] for post in first['posts']]
+        cursor = first['next_cursor']
+        while cursor is not None:
+            code, data = utils.get(self.app, f'{URL}/me/posts/others?limit=10&cursor={cursor}',
+                                   self.headers)
+            self.assertAlmostEqual(code, 200)
+            seen.extend(post['id'] for post in data['posts'])
+            cursor = data['next_cursor']
+        self.assertAlmostEqual(len(seen), 25)
+        self.assertAlmostEqual(len(set(seen)), 25)
+        newest = Post.select().where(Post.author != self.user['id']) \
+            .order_by(Post.pub_date.desc(), Post.id.desc()).first()
+        self.assertAlmostEqual(seen[0], newest.id)
+
+    def test_tampered_cursors(self):
+        utils.create_posts(5, [User.get_by_id(self.user['id'])])
+        for values in (['x', 1], ['2018-01-31 12:00:00', '1'], ['2018-01-31 12:00:00', 1.5],
+                       [None, 1], [{}, []], ['2018-01-31 12:00:00']):
+            cursor = api_utils.encode_cursor(values)
+            for url in (f'{URL}/me/posts/others', f'{URL}/posts'):
+                code, data = utils.get(self.app, f'{url}?cursor={cursor}', self.headers)
+                self.assertAlmostEqual(code, 400)
+                self.assertEqual(data['error'], 'Cursor is invalid.')
+        cursor = api_utils.encode_cursor(['2100-01-01 00:00:00', 1])
+        code, data = utils.get(self.app, f'{URL}/posts?cursor={cursor}', self.headers)
+        self.assertAlmostEqual(code, 200)
+        self.assertAlmostEqual(len(data['posts']), Post.select().where(Post.author == self.user['id']).count())
+
+    def test_conditional_get(self):
+        url = f'{self.link}/:1'
+        r = self.app.get(url, headers=self.headers)
+        etag, last_modified = r.headers['ETag'], r.headers['Last-Modified']
+        self.assertAlmostEqual(r.status_code, 200)
+        r = self.app.get(url, headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertAlmostEqual(r.status_code, 304)
+        self.assertAlmostEqual(r.get_data(), b'')
+        r = self.app.get(url, headers=dict(self.headers, **{'If-Modified-Since': last_modified}))
+        self.assertAlmostEqual(r.status_code, 304)
+
+        utils.post(self.app, url, self.headers, title='New title')
+        r = self.app.get(url, headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertAlmostEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+        self.assertAlmostEqual(json.loads(r.get_data())['title'], 'New title')
+
+    def test_reused_id(self):
+        _, post = utils.post(self.app, self.link, self.headers, title='first', text=t.text())
+        url = f'{self.link}/:{post["id"]}'
+        self.assertEqual(utils.get(self.app, url, self.headers)[1]['title'], 'first')
+        utils.delete(self.app, url, self.headers)
+        _, post = utils.post(self.app, self.link, self.headers, title='second', text=t.text())
+        code, data = utils.get(self.app, f'{self.link}/:{post["id"]}', self.headers)
+        self.assertAlmostEqual(code, 200)
+        self.assertEqual(data['title'], 'second')
+
+    def test_conditional_listing(self):
+        url = f'{URL}/posts'
+        r = self.app.get(url, headers=self.headers)
+        etag = r.headers['ETag']
+        with utils.assert_max_queries(self, self.db, 1):
+            r = self.app.get(url, headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertAlmostEqual(r.status_code, 304)
+
+        utils.post(self.app, self.link, self.headers, title=t.title(), text=t.text())
+        r = self.app.get(url, headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertAlmostEqual(r.status_code, 200)
+        self.assertAlmostEqual(len(json.loads(r.get_data())['posts']), 2)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,45 @@
+import contextlib
 import json
+import time
 from random import choice
+from unittest import mock
 
 import mimesis
 
+import api.blueprints
+from api.blueprints import jobs
 from api.blueprints.models import Post, User
 
 p = mimesis.Person()
 t = mimesis.Text()
 
 
+def create_test_app(**config):
+    """`create_app(testing=True)` with `config` over config.yml."""
+    get_config = api.blueprints.get_config
+    with mock.patch.object(api.blueprints, 'get_config', lambda: dict(get_config(), **config)):
+        return api.blueprints.create_app(testing=True)
+
+
+def login_admin(app):
+    """Creates an admin and returns the headers that authenticate as them."""
+    username, password = p.username(), p.password()
+    User.from_dict(dict(username=username, email=p.email(), password=password, is_admin=True))
+    _, data = post(app, '/api/auth/login', username=username, password=password)
+    return {'x-access-token': data['token']}
+
+
+def wait_for_job(test, app, headers, job):
+    """Polls the job until it is done or failed and returns it."""
+    for _ in range(200):
+        code, job = get(app, f'/api/admin/jobs/{job["id"]}', headers)
+        test.assertAlmostEqual(code, 200)
+        if job['status'] in (jobs.DONE, jobs.FAILED):
+            return job
+        time.sleep(0.05)
+    test.fail(f'Job {job["id"]} did not finish.')
+
+
 def post(app, url, headers=None, **data):
     data = json.dumps(data)
     r = app.post(url, data=data, headers=headers,
@@ -16,6 +47,12 @@ def post(app, url, headers=None, **data):
     return r.status_code, json.loads(r.get_data())
 
 
+def post_json(app, url, data, headers=None):
+    r = app.post(url, data=json.dumps(data), headers=headers,
+                 mimetype='application/json')
+    return r.status_code, json.loads(r.get_data())
+
+
 def get(app, url, headers):
     r = app.get(url, headers=headers)
     return r.status_code, json.loads(r.get_data())
@@ -45,3 +82,28 @@ def create_posts(quantity, users_list=None):
             'text': t.text(),
             'author': choice(users),
         })
+
+
+@contextlib.contextmanager
+def count_queries(db):
+    db = getattr(db, 'obj', db)
+    queries = []
+    execute_sql = db.execute_sql
+
+    def counted(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    db.execute_sql = counted
+    try:
+        yield queries
+    finally:
+        del db.execute_sql
+
+
+@contextlib.contextmanager
+def assert_max_queries(test, db, limit):
+    with count_queries(db) as queries:
+        yield queries
+    test.assertLessEqual(len(queries), limit,
+                         'Too many queries:\n' + '\n'.join(queries))
@@ -0,0 +1,237 @@
+"""End-to-end API benchmark with a stored baseline.
+
+Seeds the test database with `--posts` posts (bulk `insert_many`,
+reproducible text from a Zipf-weighted vocabulary), then drives the
+login, list, get, search, edit and delete endpoints through the Flask
+test client and through a threaded werkzeug server on a real socket.
+Every scenario reports p50/p95/p99 latency, throughput and SQL
+statements per request; the run reports peak RSS. Results are printed
+as JSON and, with `--baseline`, compared against a stored run: the
+exit status is 1 when p50/p95, throughput or peak RSS got worse by more
+than `--tolerance`, or statements per request went up at all.
+
+    python -m api.blueprints.tests.benchmarks.api_bench --posts 100000 --baseline baseline.json
+    python -m api.blueprints.tests.benchmarks.api_bench --posts 100000 --save-baseline baseline.json
+
+Uses the same config.yml and TEST_DATABASE as the test suite.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from api.blueprints import create_app, ratelimit
+from api.blueprints.api.utils import bulk_chunk_size
+from api.blueprints.hashing import hasher
+from api.blueprints.models import Post, User, recount_posts
+from api.blueprints.tests.api_tests import utils
+
+SEED = 1
+POSTS = 10000
+POSTS_PER_USER = 100
+REQUESTS = 200
+PASSWORD = 'benchmark'
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api_tests')
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'pa', 'do', 'ri', 'mu', 'te', 'an', 'el']
+
+
+def vocabulary(rng, size=5000):
+    words = sorted({''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(size * 2)})[:size]
+    rng.shuffle(words)
+    return words, [1 / rank for rank in range(1, len(words) + 1)]
+
+
+def sentence(rng, words, weights, length):
+    return ' '.join(rng.choices(words, weights, k=length))
+
+
+def seed(quantity, rng):
+    """Bulk-inserts users and `quantity` posts; user 1 is the benchmark user."""
+    words, weights = vocabulary(rng)
+    password_hash = hasher.hash(PASSWORD)
+    users = max(2, quantity // POSTS_PER_USER)
+    size = bulk_chunk_size()
+    fields = [User.username, User.email, User.password_hash, User.is_admin]
+    for start in range(0, users, size):
+        User.insert_many([(f'user{i}', f'user{i}@example.com', password_hash, False)
+                          for i in range(start, min(start + size, users))], fields=fields).execute()
+    for start in range(0, quantity, size):
+        rows = [Post.row({'title': sentence(rng, words, weights, rng.randint(3, 8)),
+                          'text': sentence(rng, words, weights, rng.randint(40, 200))},
+                         1 + i % users)
+                for i in range(start, min(start + size, quantity))]
+        Post.insert_many(rows).execute()
+    recount_posts()
+    return words
+
+
+class TestClientDriver:
+    name = 'test_client'
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, path, headers=None, body=None):
+        data = json.dumps(body) if body is not None else None
+        r = self.client.open(path, method=method, headers=headers, data=data, content_type='application/json')
+        return r.status_code, r.get_data()
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class HttpDriver:
+    name = 'wsgi_server'
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, path, headers=None, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port)
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return response.status, data
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def scenarios(driver, words, rng, requests):
+    """Yields (name, request callables) for one driver."""
+    credentials = {'username': 'user0', 'password': PASSWORD}
+    _, data = driver.request('POST', '/api/auth/login', body=credentials)
+    headers = {'x-access-token': json.loads(data)['token']}
+    own = [post.id for post in Post.select(Post.id).where(Post.author == 1).order_by(Post.id)]
+    rng.shuffle(own)
+    edits, deletes = own[:len(own) // 2], own[len(own) // 2:]
+
+    def call(method, path, body=None, expected=(200,)):
+        def run():
+            status, _ = driver.request(method, path, headers, body)
+            if status not in expected:
+                raise RuntimeError(f'{method} {path} returned {status}.')
+        return run
+
+    yield 'login', [call('POST', '/api/auth/login', credentials)] * min(requests, 20)
+    yield 'list_own', [call('GET', '/api/posts?limit=50')] * requests
+    yield 'list_others', [call('GET', '/api/me/posts/others?limit=50')] * requests
+    yield 'get', [call('GET', f'/api/me/post/:{post_id}') for post_id in itertools.islice(itertools.cycle(own), requests)]
+    yield 'search', [call('GET', f'/api/posts?query={rng.choice(words[:200])}') for _ in range(requests)]
+    yield 'edit', [call('POST', f'/api/me/post/:{post_id}', {'title': f'edited {i}'})
+                   for i, post_id in enumerate(itertools.islice(itertools.cycle(edits), requests))]
+    yield 'delete', [call('DELETE', f'/api/me/post/:{post_id}') for post_id in deletes[:requests]]
+
+
+def measure(db, calls):
+    latencies = []
+    with utils.count_queries(db) as queries:
+        started = time.perf_counter()
+        for run in calls:
+            start = time.perf_counter()
+            run()
+            latencies.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(calls),
+        'p50_ms': round(quantiles[49] * 1000, 3),
+        'p95_ms': round(quantiles[94] * 1000, 3),
+        'p99_ms': round(quantiles[98] * 1000, 3),
+        'throughput': round(len(calls) / elapsed, 1),
+        'sql_per_request': round(len(queries) / len(calls), 2),
+    }
+
+
+def run(posts, requests):
+    os.chdir(TESTS_DIR)
+    results = {'posts': posts, 'drivers': {}}
+    for make_driver in (lambda client: TestClientDriver(client), lambda client: HttpDriver(client.application)):
+        rng = random.Random(SEED)
+        client, db = create_app(testing=True)
+        # one client logging in over and over is exactly what the login limits refuse
+        ratelimit.limiter.configure({}, ratelimit.MemoryStore())
+        try:
+            words = seed(posts, rng)
+            driver = make_driver(client)
+            try:
+                results['drivers'][driver.name] = {name: measure(db, calls)
+                                                   for name, calls in scenarios(driver, words, rng, requests) if calls}
+            finally:
+                driver.close()
+        finally:
+            db.drop_tables([Post, User])
+            db.close()
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    # p99 of a few hundred samples is too noisy to gate on
+    worse_if_higher = ('p50_ms', 'p95_ms')
+    for driver, scenario_results in results['drivers'].items():
+        for scenario, metrics in scenario_results.items():
+            before = baseline.get('drivers', {}).get(driver, {}).get(scenario)
+            if before is None:
+                continue
+            for metric in worse_if_higher:
+                if metrics[metric] > before[metric] * (1 + tolerance):
+                    found.append(f'{driver}.{scenario}.{metric}: {before[metric]} -> {metrics[metric]}')
+            if metrics['throughput'] < before['throughput'] * (1 - tolerance):
+                found.append(f"{driver}.{scenario}.throughput: {before['throughput']} -> {metrics['throughput']}")
+            if metrics['sql_per_request'] > before['sql_per_request']:
+                found.append(f"{driver}.{scenario}.sql_per_request: "
+                             f"{before['sql_per_request']} -> {metrics['sql_per_request']}")
+    if 'peak_rss_kb' in baseline and results['peak_rss_kb'] > baseline['peak_rss_kb'] * (1 + tolerance):
+        found.append(f"peak_rss_kb: {baseline['peak_rss_kb']} -> {results['peak_rss_kb']}")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--posts', type=int, default=POSTS)
+    parser.add_argument('--requests', type=int, default=REQUESTS)
+    parser.add_argument('--baseline', help='compare against this stored run')
+    parser.add_argument('--save-baseline', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.baseline:
+        with open(os.path.abspath(args.baseline)) as file:
+            baseline = json.load(file)
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    results = run(args.posts, args.requests)
+    print(json.dumps(results, indent=2))
+    if save_path:
+        with open(save_path, 'w') as file:
+            json.dump(results, file, indent=2)
+    if baseline is not None:
+        found = regressions(results, baseline, args.tolerance)
+        for line in found:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""Many mostly idle polling clients against the WSGI and ASGI deployments.
+
+Starts each server in turn (threaded werkzeug for `create_app()`, uvicorn
+for `api.asgi:application`) against the configured database, then holds
+`clients` connections (kept alive where the server allows it) that each
+poll `GET /api/posts` with If-None-Match every `interval` seconds.
+Reports latency percentiles, failed polls, and the server's peak thread
+count and RSS.
+
+    python -m api.blueprints.tests.benchmarks.asgi_bench [clients] [seconds] [interval_ms]
+
+Run from the repository root with the database in `config.yml` up.
+"""
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+CLIENTS = 500
+SECONDS = 20
+INTERVAL_MS = 1000
+HOST = '127.0.0.1'
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+SERVERS = {
+    'wsgi': lambda port: [sys.executable, '-c',
+                          'from werkzeug.serving import run_simple; from api.blueprints import create_app; '
+                          f'run_simple({HOST!r}, {port}, create_app(), threaded=True)'],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'api.asgi:application',
+                          '--host', HOST, '--port', str(port), '--no-access-log', '--backlog', '4096'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def proc_status(pid):
+    status = {}
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            name, _, value = line.partition(':')
+            if name in ('Threads', 'VmHWM'):
+                status[name] = value.split()[0]
+    return int(status['Threads']), int(status['VmHWM'])
+
+
+class Connection:
+    """A keep-alive HTTP/1.1 client connection, reopened if the server closes it."""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, headers=None, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(HOST, self.port)
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {HOST}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        if body is not None:
+            body = json.dumps(body).encode()
+            lines += ['Content-Type: application/json', f'Content-Length: {len(body)}']
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b''))
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.lower()] = value.strip()
+        if response_headers.get('transfer-encoding') == 'chunked':
+            data = b''
+            while True:
+                size = int(await self.reader.readline(), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await self.reader.readexactly(int(response_headers.get('content-length', 0)))
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, response_headers, data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def login(port):
+    connection = Connection(port)
+    name = uuid.uuid4().hex[:12]
+    credentials = {'username': name, 'email': f'{name}@example.com', 'password': name}
+    await connection.request('POST', '/api/auth/register', body=credentials)
+    _, _, data = await connection.request('POST', '/api/auth/login', body=credentials)
+    headers = {'x-access-token': json.loads(data)['token']}
+    for i in range(20):
+        await connection.request('POST', '/api/me/post', headers, {'title': f'post {i}', 'text': 'text ' * 50})
+    connection.close()
+    return headers
+
+
+async def client(port, headers, deadline, interval, latencies, failures):
+    connection = Connection(port)
+    etag = None
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            poll_headers = dict(headers, **({'If-None-Match': etag} if etag else {}))
+            status, response_headers, _ = await connection.request('GET', '/api/posts', poll_headers)
+            latencies.append(time.perf_counter() - start)
+            if status not in (200, 304):
+                failures.append(status)
+            etag = response_headers.get('etag', etag)
+            await asyncio.sleep(interval)
+    except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+        failures.append('connection')
+    finally:
+        connection.close()
+
+
+async def sample(pid, stop, peaks):
+    while not stop.is_set():
+        threads, rss = proc_status(pid)
+        peaks['threads'] = max(peaks['threads'], threads)
+        peaks['rss_kb'] = max(peaks['rss_kb'], rss)
+        await asyncio.sleep(0.2)
+
+
+async def drive(port, pid, clients, seconds, interval):
+    headers = await login(port)
+    latencies, failures, peaks = [], [], {'threads': 0, 'rss_kb': 0}
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample(pid, stop, peaks))
+    deadline = time.monotonic() + seconds
+    started = time.perf_counter()
+    await asyncio.gather(*(client(port, headers, deadline, interval, latencies, failures)
+                           for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        'requests': len(latencies),
+        'failures': len(failures),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        **peaks,
+    }
+
+
+def wait_until_listening(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}.')
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Server did not start.')
+
+
+def run(name, clients, seconds, interval):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    process = subprocess.Popen(SERVERS[name](port), cwd=os.path.join(ROOT, 'api', 'blueprints'), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_listening(port, process)
+        return asyncio.run(drive(port, process.pid, clients, seconds, interval))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(clients=CLIENTS, seconds=SECONDS, interval_ms=INTERVAL_MS):
+    print(f'{clients} polling clients, {seconds}s, one poll per {interval_ms} ms each')
+    results = {name: run(name, clients, seconds, interval_ms / 1000) for name in SERVERS}
+    for name, result in results.items():
+        print(f"{name}: {result['throughput']:8.1f} req/s  p50 {result['p50_ms']:7.2f} ms  "
+              f"p95 {result['p95_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  "
+              f"failed {result['failures']:>5}  threads {result['threads']:>4}  "
+              f"peak RSS {result['rss_kb'] / 1024:6.1f} MiB")
+    return results
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
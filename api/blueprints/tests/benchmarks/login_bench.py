@@ -0,0 +1,58 @@
+"""Login throughput at different hashing pool sizes.
+
+Simulates a threaded worker: `threads` request threads each verify a
+password the way `auth_login` does, while the hasher runs inline
+(pool size 0) or in a process pool of the given size. Also reports how
+long a cheap request waits behind the burst, which is what the other
+users of the worker feel.
+
+    python -m api.blueprints.tests.benchmarks.login_bench [logins] [threads]
+"""
+import concurrent.futures
+import os
+import sys
+import time
+
+from api.blueprints.hashing import PasswordHasher
+
+METHOD = 'pbkdf2:sha256:150000'
+LOGINS = 64
+THREADS = 16
+
+
+def cheap_request_latency(stop):
+    latencies = []
+    while not stop.done():
+        start = time.perf_counter()
+        sum(range(1000))
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.001)
+    return max(latencies) if latencies else 0.0
+
+
+def run(workers, logins, threads):
+    hasher = PasswordHasher(METHOD, workers=workers)
+    password_hash = hasher.hash('secret')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads + 1) as executor:
+        start = time.perf_counter()
+        futures = [executor.submit(hasher.verify, password_hash, 'secret') for _ in range(logins)]
+        burst = concurrent.futures.wait(futures, return_when=concurrent.futures.ALL_COMPLETED)
+        elapsed = time.perf_counter() - start
+        assert all(future.result() for future in burst.done)
+        probe = executor.submit(cheap_request_latency, executor.submit(
+            lambda: [hasher.verify(password_hash, 'secret') for _ in range(threads)]))
+        stall = probe.result()
+    hasher.shutdown()
+    return logins / elapsed, stall
+
+
+def main(logins=LOGINS, threads=THREADS):
+    print(f'{logins} logins, {threads} request threads, {METHOD}')
+    for workers in sorted({0, 1, 2, 4, os.cpu_count() or 1}):
+        throughput, stall = run(workers, logins, threads)
+        print(f'pool={workers:>2}: {throughput:8.1f} logins/s, '
+              f'worst cheap-request latency {stall * 1000:7.2f} ms')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
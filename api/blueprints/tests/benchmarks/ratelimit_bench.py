@@ -0,0 +1,58 @@
+"""Per-request cost of the rate limiter.
+
+Times `limiter.hit` for each store, from one thread and from `threads`
+threads at once, over `keys` distinct clients (half of them flooding a
+single bucket, which is the refused path). Reports microseconds per
+call; the budget is well under a millisecond.
+
+    python -m api.blueprints.tests.benchmarks.ratelimit_bench [calls] [threads]
+"""
+import concurrent.futures
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from api.blueprints.ratelimit import MemoryStore, RateLimiter, SqliteStore
+
+CALLS = 20000
+THREADS = 8
+KEYS = 1000
+
+
+def timed_calls(limiter, calls, seed):
+    rng = random.Random(seed)
+    latencies = []
+    for i in range(calls):
+        key = 'flood' if i % 2 else f'client{rng.randrange(KEYS)}'
+        start = time.perf_counter()
+        limiter.hit('login_ip', key)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run(store, calls, threads):
+    limiter = RateLimiter()
+    limiter.configure({'login_ip': '30/minute'}, store)
+    results = {}
+    for workers in (1, threads):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            latencies = sum(executor.map(timed_calls, [limiter] * workers, [calls // workers] * workers,
+                                         range(workers)), [])
+        quantiles = statistics.quantiles(latencies, n=100)
+        results[workers] = (quantiles[49] * 1e6, quantiles[98] * 1e6)
+    return results
+
+
+def main(calls=CALLS, threads=THREADS):
+    with tempfile.TemporaryDirectory() as directory:
+        stores = {'memory': MemoryStore(), 'sqlite': SqliteStore(os.path.join(directory, 'buckets.db'))}
+        for name, store in stores.items():
+            for workers, (p50, p99) in run(store, calls, threads).items():
+                print(f'{name:>6} store, {workers} thread(s): p50 {p50:7.1f} us  p99 {p99:7.1f} us per call')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
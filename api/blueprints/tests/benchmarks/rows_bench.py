@@ -0,0 +1,60 @@
+"""Memory and time per row: model instances vs compact rows.
+
+Seeds the test database with `posts` posts, then loads every user and
+every post (with its author) once as model instances serialized with
+`to_dict`, and once as `compact()` namedtuples serialized with
+`serialize_row`. The time covers the query and the serialization; a
+second, untimed load under tracemalloc reports the bytes each loaded
+row keeps alive and the peak while loading.
+
+    python -m api.blueprints.tests.benchmarks.rows_bench [posts]
+
+Uses the same config.yml and TEST_DATABASE as the test suite.
+"""
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+from api.blueprints import create_app
+from api.blueprints.models import Post, User, post_serializer, user_serializer
+from api.blueprints.tests.benchmarks.api_bench import seed
+
+POSTS = 20000
+
+
+def measure(query, serialize):
+    start = time.perf_counter()
+    for row in query.clone():
+        serialize(row)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    rows = list(query.clone())
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(rows), size, peak, seconds
+
+
+def main(posts=POSTS):
+    _, db = create_app(testing=True)
+    try:
+        seed(posts, random.Random(1))
+        cases = [
+            ('users', 'models', User.select().order_by(User.id), User.to_dict),
+            ('users', 'compact', User.compact().order_by(User.id), user_serializer.serialize_row),
+            ('posts', 'models', Post.with_author().order_by(Post.id), Post.to_dict),
+            ('posts', 'compact', Post.compact().order_by(Post.id), post_serializer.serialize_row),
+        ]
+        for table, mode, query, serialize in cases:
+            count, size, peak, seconds = measure(query, serialize)
+            print(f'{table:>5} {mode:>7}: {size / count:7.0f} B/row kept  {peak / count:7.0f} B/row peak  '
+                  f'{seconds / count * 1e6:6.2f} us/row  ({count} rows)')
+    finally:
+        db.drop_tables([Post, User])
+        db.close()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,58 @@
+"""Micro-benchmark: precompiled serializers vs `model_to_dict`.
+
+Runs without a database; rows are built in memory the way a joined
+`Post.select(Post, User).join(User)` query would return them.
+
+    python -m api.blueprints.tests.benchmarks.serializer_bench [rows]
+"""
+import datetime
+import sys
+import timeit
+
+from playhouse.shortcuts import model_to_dict
+
+from api.blueprints.models import Post, User, post_serializer
+
+ROWS = 10000
+REPEAT = 5
+
+
+def make_rows(quantity):
+    users = [User(id=i, username=f'user{i}', email=f'user{i}@example.com',
+                  password_hash='x', is_admin=False) for i in range(1, 101)]
+    now = datetime.datetime.now()
+    posts = [Post(id=i, title=f'title {i}', text='text ' * 20, author=users[i % 100],
+                  pub_date=now - datetime.timedelta(seconds=i), updated_at=now, version=1) for i in range(quantity)]
+    rows = [(post.id, post.title, post.author.id, post.text, post.pub_date,
+             post.updated_at, post.version,
+             post.author.id, post.author.username, post.author.email, post.author.is_admin)
+            for post in posts]
+    return posts, rows
+
+
+def old_to_dict(post):
+    post = model_to_dict(post, exclude=[User.password_hash])
+    post['pub_date'] = str(post['pub_date'])
+    post['updated_at'] = str(post['updated_at'])
+    return post
+
+
+def best(func):
+    return min(timeit.repeat(func, number=1, repeat=REPEAT))
+
+
+def main(quantity=ROWS):
+    posts, rows = make_rows(quantity)
+    results = {
+        'model_to_dict': best(lambda: [old_to_dict(post) for post in posts]),
+        'serialize': best(lambda: [post_serializer.serialize(post) for post in posts]),
+        'serialize_row': best(lambda: [post_serializer.serialize_row(row) for row in rows]),
+    }
+    baseline = results['model_to_dict']
+    print(f'{quantity} rows, best of {REPEAT}')
+    for name, seconds in results.items():
+        print(f'{name:>15}: {seconds * 1000:8.2f} ms  {baseline / seconds:6.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else ROWS)
@@ -0,0 +1,66 @@
+"""Export and import throughput of table snapshots.
+
+Seeds the test database with `posts` posts, then for every available
+format exports the posts table, deletes it and imports it back, calling
+the job functions directly. Reports rows per second each way, the
+snapshot size and the process's peak RSS, which should not grow with
+`posts` beyond what seeding took.
+
+    python -m api.blueprints.tests.benchmarks.snapshot_bench [posts]
+
+Uses the same config.yml and TEST_DATABASE as the test suite.
+"""
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from api.blueprints import create_app, snapshots
+from api.blueprints.models import Post, User
+from api.blueprints.tests.benchmarks.api_bench import seed
+
+POSTS = 100000
+
+
+class BenchJob:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def progress(self, done, total):
+        pass
+
+    def result_path(self, suffix):
+        return os.path.join(self.directory, f'posts{suffix}')
+
+
+def main(posts=POSTS):
+    _, db = create_app(testing=True)
+    directory = tempfile.mkdtemp()
+    try:
+        seed(posts, random.Random(1))
+        job = BenchJob(directory)
+        formats = [fmt for fmt in snapshots.FORMATS if fmt != 'parquet' or snapshots.PARQUET]
+        for fmt in formats:
+            start = time.perf_counter()
+            path = snapshots.export_table(job, 'posts', fmt)
+            exported = time.perf_counter() - start
+            size = os.path.getsize(path)
+            Post.delete().execute()
+            start = time.perf_counter()
+            snapshots.import_table(job, 'posts', fmt, path)
+            imported = time.perf_counter() - start
+            assert Post.select().count() == posts
+            print(f'{fmt:>8}: export {posts / exported:9.0f} rows/s  import {posts / imported:9.0f} rows/s  '
+                  f'{size / 2 ** 20:7.1f} MiB')
+        print(f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB')
+    finally:
+        shutil.rmtree(directory)
+        db.drop_tables([Post, User])
+        db.close()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
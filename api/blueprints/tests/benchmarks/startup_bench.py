@@ -0,0 +1,68 @@
+"""Cold start: process spawn to the first response of a fresh worker.
+
+Applies pending migrations once, then starts `runs` fresh interpreters
+that each import the app, call `create_app()` and serve one request
+that touches the database (a login for an unknown user). Reports the
+median import, `create_app` and first-request times, the wall time per
+process, and how many SQL statements the worker ran before serving.
+
+    python -m api.blueprints.tests.benchmarks.startup_bench [runs]
+
+Run from the repository root with the database in `config.yml` up.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RUNS = 20
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+WORKER = '''
+import json, time
+start = time.perf_counter()
+import peewee
+statements = []
+execute_sql = peewee.Database.execute_sql
+
+def counted(self, sql, *args, **kwargs):
+    statements.append(sql)
+    return execute_sql(self, sql, *args, **kwargs)
+
+peewee.Database.execute_sql = counted
+from api.blueprints import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+boot_statements = len(statements)
+app.test_client().post('/api/auth/login', data=json.dumps({'username': 'nobody', 'password': 'nobody'}),
+                       content_type='application/json')
+responded = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (responded - created) * 1000, 'boot_statements': boot_statements}))
+'''
+
+
+def run(env):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', WORKER], cwd=os.path.join(ROOT, 'api', 'blueprints'), env=env,
+                            stdout=subprocess.PIPE, check=True).stdout
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def main(runs=RUNS):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    subprocess.run([sys.executable, '-m', 'api.blueprints.migrations'], cwd=ROOT, env=env, check=True)
+    results = [run(env) for _ in range(runs)]
+    summary = {name: statistics.median(result[name] for result in results) for name in results[0]}
+    print(f"{runs} cold starts (medians): import {summary['import_ms']:.1f} ms  "
+          f"create_app {summary['create_app_ms']:.1f} ms  first request {summary['first_request_ms']:.1f} ms  "
+          f"process {summary['process_ms']:.1f} ms  statements at boot {summary['boot_statements']:.0f}")
+    return summary
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,76 @@
+"""Access and refresh tokens signed with rotating keys.
+
+Login hands out a short-lived access token and a long-lived refresh
+token; `/api/auth/refresh` trades a refresh token for a new pair
+without a password check. `JWT_KEYS` maps key ids to secrets. Tokens
+are signed with `JWT_SIGNING_KEY` and carry its id in the `kid` header,
+and every listed key verifies. To rotate, add a key, make it the
+signing key, and drop the old one once its refresh tokens have expired.
+Without `JWT_KEYS`, `SECRET_KEY` is the only key. Tokens without a `kid`
+were signed with `SECRET_KEY` and verify while that secret is listed.
+"""
+import datetime
+
+import jwt
+
+ALGORITHM = 'HS256'
+ACCESS = 'access'
+REFRESH = 'refresh'
+DEFAULT_KID = 'default'
+
+
+class KeyRing:
+    def __init__(self):
+        self.configure({DEFAULT_KID: ''}, DEFAULT_KID)
+
+    def configure(self, keys, signing_kid, access_ttl=900, refresh_ttl=1209600, legacy_key=None):
+        if signing_kid not in keys:
+            raise ValueError(f'Unknown signing key: {signing_kid}.')
+        self.keys = dict(keys)
+        self.signing_kid = signing_kid
+        self.legacy_key = legacy_key if legacy_key in self.keys.values() else None
+        self.ttls = {ACCESS: access_ttl, REFRESH: refresh_ttl}
+
+    def encode(self, user_id, kind=ACCESS):
+        payload = {
+            'id': user_id,
+            'type': kind,
+            'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttls[kind]),
+        }
+        token = jwt.encode(payload, self.keys[self.signing_kid], algorithm=ALGORITHM,
+                           headers={'kid': self.signing_kid})
+        return token.decode('UTF-8') if isinstance(token, bytes) else token
+
+    def issue(self, user_id):
+        return {
+            'token': self.encode(user_id, ACCESS),
+            'refresh_token': self.encode(user_id, REFRESH),
+            'expires_in': self.ttls[ACCESS],
+        }
+
+    def decode(self, token, kind=ACCESS):
+        """The claims of a valid `kind` token, else None."""
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            key = self.legacy_key if kid is None else self.keys.get(str(kid))
+            if key is None:
+                return None
+            claims = jwt.decode(token, key, algorithms=[ALGORITHM])
+        except jwt.InvalidTokenError:
+            return None
+        # tokens from before refresh tokens existed are access tokens
+        if claims.get('type', ACCESS) != kind:
+            return None
+        return claims
+
+
+keyring = KeyRing()
+
+
+def init_app(app):
+    config = app.config
+    secret = config['SECRET_KEY']
+    keys = config.get('JWT_KEYS') or {DEFAULT_KID: secret}
+    keyring.configure(keys, config.get('JWT_SIGNING_KEY') or DEFAULT_KID,
+                      config.get('ACCESS_TOKEN_TTL', 900), config.get('REFRESH_TOKEN_TTL', 1209600), secret)
+    return keyring
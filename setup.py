@@ -12,4 +12,8 @@ setup(
         'PyJWT',
         'PyYAML',
     ],
+    extras_require={
+        'asgi': ['uvicorn'],
+        'parquet': ['pyarrow'],
+    },
 )